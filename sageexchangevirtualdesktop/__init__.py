@@ -0,0 +1,2 @@
+# Django < 3.2 does not find the AppConfig in apps.py by itself
+default_app_config = 'sageexchangevirtualdesktop.apps.SEVDConfig'
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class SEVDConfig(AppConfig):
+    name = 'sageexchangevirtualdesktop'
+    verbose_name = 'Sage Exchange Virtual Desktop'
+
+    def ready(self):
+        # the vault card index is only kept when asked for
+        if getattr(settings, 'SEVD_VAULT_CARD_INDEX', False):
+            from . import sevd
+            from .models import VaultCard
+            sevd.add_response_listener(VaultCard.objects.record_response)
@@ -0,0 +1,171 @@
+'''Compares the XML backends on the documents sevd sends and receives.
+
+Run with:
+
+    python -m sageexchangevirtualdesktop.benchmark [--number N]
+
+For every document type the time to build and serialize (requests) or parse
+(responses) is reported for each installed backend. The output of every
+backend is checked to be identical first. "lazy" is the time to parse a
+response with lazy_from_xml() and read one ResponseIndicator, and "extract"
+the time to pull a few fields with a FieldExtractor (which does not use a
+backend). Its speedup is given against a full parse and, in brackets,
+against the fastest lazy parse.
+'''
+import argparse
+import timeit
+import warnings
+
+from . import sevd
+
+VAULT_STATUS_RESPONSE = b'''\xef\xbb\xbf<?xml version="1.0" encoding="UTF-8"?>
+<Response_v1>
+    <VaultStatusQueryResponse>
+        <Response>
+            <ResponseIndicator>A</ResponseIndicator>
+            <ResponseMessage>SUCCESS</ResponseMessage>
+        </Response>
+        <VaultResponse>
+            <Response>
+                <ResponseIndicator>A</ResponseIndicator>
+                <ResponseMessage>SUCCESS</ResponseMessage>
+            </Response>
+            <GUID>74e7b7c14839486484071a91f4367bd6</GUID>
+            <ExpirationDate>0716</ExpirationDate>
+            <Last4>XXXXXXXXXXXX1111</Last4>
+            <PaymentDescription>411111XXXXXX1111</PaymentDescription>
+            <PaymentTypeID>4</PaymentTypeID>
+        </VaultResponse>
+    </VaultStatusQueryResponse>
+</Response_v1>
+'''
+
+PAYMENT_RESPONSE = '''
+    <PaymentResponseType>
+        <Response>
+            <ResponseIndicator>A</ResponseIndicator>
+            <ResponseCode>000001</ResponseCode>
+            <ResponseMessage>APPROVED 000001</ResponseMessage>
+        </Response>
+        <TransactionResponse>
+            <AuthCode>000001</AuthCode>
+            <CVVResult>M</CVVResult>
+            <VANReference>F7KFBmgfX0</VANReference>
+            <TransactionID>8aa39248-0c47-4a57-bcae-9b90048107e0</TransactionID>
+            <Last4>XXXXXXXXXXXX1111</Last4>
+            <PaymentDescription>411111XXXXXX1111</PaymentDescription>
+            <Amount>1</Amount>
+            <PaymentTypeID>4</PaymentTypeID>
+            <TransactionDate>7/20/2015 11:47:41 AM</TransactionDate>
+            <EntryMode>K</EntryMode>
+            <TaxAmount>0</TaxAmount>
+            <ShippingAmount>0</ShippingAmount>
+        </TransactionResponse>
+        <Customer>
+            <Name>
+                <FirstName>David</FirstName>
+                <MI>I</MI>
+                <LastName>Dorothy</LastName>
+            </Name>
+            <Address>
+                <AddressLine1>502 W. Pippen Street</AddressLine1>
+                <City>Whitakers</City>
+                <State>NC</State>
+                <ZipCode>27891</ZipCode>
+            </Address>
+        </Customer>
+    </PaymentResponseType>'''
+
+def payment_responses(count):
+    return ('<?xml version="1.0" encoding="UTF-8"?><Response_v1><PaymentResponses>%s</PaymentResponses></Response_v1>' % (PAYMENT_RESPONSE * count)).encode('utf-8')
+
+CREDENTIALS = dict(app_id='DEMO', merchant_id='999999999999', merchant_key='AAAAAAAAAAA', lang_id='EN')
+
+# name: Request
+REQUESTS = [
+    ('vault_operation', sevd.build_vault_operation_request(service='DELETE', vault_guid='dd83d7559a274fb2b66e774a4febced7', vault_id='e856a127-8527-431c-807f-6efacd8bdf83', **CREDENTIALS)),
+    ('auth_with_vault', sevd.build_auth_with_vault_request(
+        trans_id='e856a127-8527-431c-807f-6efacd8bdf83', vault_guid='dd83d7559a274fb2b66e774a4febced7', amount='2152.92',
+        street1='12345 Street', city='South Padre Island', state='TX', zip_code='78597', first_name='John', last_name='Doe', **CREDENTIALS)),
+    ('batch', sevd.build_batch_request(net='10.50', count='2', **CREDENTIALS)),
+]
+
+# name: raw response body
+RESPONSES = [
+    ('vault_status_response', VAULT_STATUS_RESPONSE),
+    ('payment_response', payment_responses(1)),
+    ('payment_responses_x100', payment_responses(100)),
+]
+
+def parse(backend, content):
+    response = sevd.Response()
+    response.from_xml(backend.fromstring(sevd.xml_body(content)))
+    return response
+
+def read_lazy(backend, content):
+    response = sevd.lazy_from_xml(sevd.Response, backend.fromstring(sevd.xml_body(content)))
+    if response.payment_responses is None:
+        return response.vault_query_response.response.response_indicator
+    payment = response.payment_responses.payment_responses
+    if isinstance(payment, list):
+        payment = payment[0]
+    return payment.response.response_indicator
+
+def check(backends):
+    '''Raises AssertionError unless every backend gives the same output.'''
+    for name, request in REQUESTS:
+        outputs = set(sevd.serialize_request(request, backend) for backend in backends)
+        assert len(outputs) == 1, 'Backends serialize %s differently.' % name
+    for name, content in RESPONSES:
+        outputs = set(sevd.serialize_request(parse(backend, content), backends[0]) for backend in backends)
+        assert len(outputs) == 1, 'Backends parse %s differently.' % name
+
+def run(number=2000):
+    '''Returns a list of (document, operation, backend name, microseconds per call).'''
+    backends = [sevd.get_xml_backend(name) for name in sorted(sevd.XML_BACKENDS)]
+    check(backends)
+    results = []
+    for name, request in REQUESTS:
+        for backend in backends:
+            seconds = timeit.timeit(lambda: sevd.serialize_request(request, backend), number=number)
+            results.append((name, 'serialize', backend.name, seconds / number * 1e6))
+    for name, content in RESPONSES:
+        # fewer runs for the big documents
+        runs = max(1, number // max(1, len(content) // 2000))
+        for backend in backends:
+            seconds = timeit.timeit(lambda: parse(backend, content), number=runs)
+            results.append((name, 'parse', backend.name, seconds / runs * 1e6))
+        for backend in backends:
+            seconds = timeit.timeit(lambda: read_lazy(backend, content), number=runs)
+            results.append((name, 'lazy', backend.name, seconds / runs * 1e6))
+        extractor = sevd.PAYMENT_RESULT if name.startswith('payment') else sevd.VAULT_STATUS_RESULT
+        seconds = timeit.timeit(lambda: extractor.extract(content), number=runs)
+        results.append((name, 'extract', 'scan', seconds / runs * 1e6))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the sevd XML backends.')
+    parser.add_argument('--number', '-n', type=int, default=2000, help='calls to time for each document (default 2000)')
+    args = parser.parse_args(argv)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        results = run(args.number)
+
+    # responses are compared with a full parse
+    baseline = dict(((document, operation), micros) for document, operation, backend, micros in results if backend == 'etree')
+    baseline.update(((document, 'extract'), micros) for document, operation, backend, micros in results if backend == 'etree' and operation == 'parse')
+    # and with the fastest lazy parse, which reads fields on demand as well
+    lazy = {}
+    for document, operation, backend, micros in results:
+        if operation == 'lazy':
+            lazy[document] = min(micros, lazy.get(document, micros))
+    print('%-24s %-10s %-6s %12s %8s' % ('document', 'operation', 'engine', 'us per call', 'speedup'))
+    for document, operation, backend, micros in results:
+        line = '%-24s %-10s %-6s %12.1f %7.2fx' % (document, operation, backend, micros, baseline[(document, operation)] / micros)
+        if operation == 'extract':
+            line += ' (%.2fx lazy)' % (lazy[document] / micros)
+        print(line)
+
+if __name__ == '__main__':
+    main()
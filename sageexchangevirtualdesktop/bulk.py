@@ -0,0 +1,270 @@
+'''Bulk vault operations.
+
+Runs DELETE or RETRIEVE (status) operations over a stream of vault GUIDs with
+bounded concurrency. Progress is checkpointed so an interrupted job can be
+resumed and results are yielded as they complete so they can be written out
+as a stream.
+
+Example, purging a list of GUIDs and writing the results as JSON lines:
+
+    with Checkpoint('purge.done') as checkpoint, open('purge.jsonl', 'a') as f:
+        job = BulkVaultJob(app_id, merchant_id, merchant_key, concurrency=16, checkpoint=checkpoint)
+        write_results(job.delete(guids), f)
+
+BulkCodec spreads the CPU work of serializing many requests and parsing many
+response bodies over a process pool:
+
+    with BulkCodec(workers=4) as codec:
+        for response in codec.parse(bodies):
+            ...
+'''
+import collections
+from concurrent import futures
+import datetime
+import itertools
+import json
+import os
+import threading
+
+from . import client as sevd_client
+from . import sevd
+
+OPERATIONS = ('delete', 'retrieve')
+
+
+class BulkResult(collections.namedtuple('BulkResult', 'guid operation ok response_indicator response_code response_message expiration_date error')):
+    '''Outcome of one operation in a bulk job.'''
+
+    def to_dict(self):
+        return self._asdict()
+
+
+class Checkpoint(object):
+    '''Remembers which operations a job has finished in an append-only file.
+
+    Each line is an `operation:guid` key (see checkpoint_key()), so one file
+    can be shared by jobs running different operations on the same GUIDs.
+    Close it with close() or use it as a context manager.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done.update(line.strip() for line in f if line.strip())
+        self._file = open(path, 'a')
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def mark(self, key):
+        with self._lock:
+            self.done.add(key)
+            self._file.write(key + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def checkpoint_key(operation, guid):
+    '''The key a Checkpoint records `operation` on `guid` under.'''
+    return '%s:%s' % (operation, guid)
+
+def write_results(results, f):
+    '''Writes each BulkResult to the file `f` as a line of JSON as soon as it is available.'''
+    for result in results:
+        f.write(json.dumps(result.to_dict()) + '\n')
+        f.flush()
+
+
+class BulkVaultJob(object):
+    '''Runs vault operations for many GUIDs with at most `concurrency` in flight.
+
+    `client` is the client.Client used to send requests. When `probe_uuid` is
+    False (the default) the VaultID of each operation is a random UUID instead
+    of one checked with a status query first, saving a round trip per GUID.
+    `checkpoint` is a Checkpoint; GUIDs it already holds for the same
+    operation are skipped.
+    `timeout` bounds each operation. Requests are sent with the client's
+    Scheduler (if any) in the `priority` class.
+
+    With `adaptive` (client.AdaptiveConcurrency) the number of operations in
+    flight follows the AdaptiveLimit of the operation, up to `concurrency`.
+    '''
+
+    def __init__(self, app_id, merchant_id, merchant_key, client=None, concurrency=8, checkpoint=None, probe_uuid=False, timeout=None, lang_id='EN', priority=sevd_client.BULK, adaptive=None):
+        self.app_id = app_id
+        self.merchant_id = merchant_id
+        self.merchant_key = merchant_key
+        self.client = client or sevd_client.Client()
+        self.concurrency = concurrency
+        self.checkpoint = checkpoint
+        self.probe_uuid = probe_uuid
+        self.timeout = timeout
+        self.lang_id = lang_id
+        self.priority = priority
+        self.adaptive = adaptive
+
+    def _call(self, operation, guid):
+        query_first = 'vault' if self.probe_uuid else None
+        if operation == 'delete':
+            return self.client.vault_delete(self.app_id, self.merchant_id, self.merchant_key, guid, query_first, self.lang_id, self.timeout, priority=self.priority)
+        return self.client.vault_retrieve(self.app_id, self.merchant_id, self.merchant_key, guid, query_first, self.lang_id, self.timeout, priority=self.priority)
+
+    def _execute(self, operation, guid):
+        try:
+            if self.adaptive is None:
+                response = self._call(operation, guid)
+            else:
+                with self.adaptive.limiter('vault_%s' % operation).measure():
+                    response = self._call(operation, guid)
+        except Exception as ex:
+            return BulkResult(guid, operation, False, None, None, None, None, '%s: %s' % (type(ex).__name__, ex))
+
+        vault_response = response.vault_response
+        if vault_response is None or vault_response.response is None:
+            return BulkResult(guid, operation, False, None, None, None, None, 'No VaultResponse returned.')
+        status = vault_response.response
+        return BulkResult(guid, operation, status.response_indicator == 'A', status.response_indicator,
+                          status.response_code, status.response_message, vault_response.expiration_date, None)
+
+    def run(self, operation, guids):
+        '''Yields a BulkResult for every GUID in `guids` as operations complete.
+
+        `guids` may be any iterable and is consumed lazily.
+        '''
+        if operation not in OPERATIONS:
+            raise ValueError('%s: operation must be one of %s.' % (operation, ', '.join(OPERATIONS)))
+
+        with futures.ThreadPoolExecutor(self.concurrency) as executor:
+            pending = set()
+            for guid in guids:
+                guid = guid.strip()
+                if not guid or (self.checkpoint is not None and checkpoint_key(operation, guid) in self.checkpoint):
+                    continue
+                if len(pending) >= self.concurrency:
+                    done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for result in self._finish(done):
+                        yield result
+                pending.add(executor.submit(self._execute, operation, guid))
+            while pending:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for result in self._finish(done):
+                    yield result
+
+    def _finish(self, done):
+        for future in done:
+            result = future.result()
+            # failures are not checkpointed so they are retried when the job is resumed
+            if result.ok and self.checkpoint is not None:
+                self.checkpoint.mark(checkpoint_key(result.operation, result.guid))
+            yield result
+
+    def delete(self, guids):
+        return self.run('delete', guids)
+
+    def retrieve(self, guids):
+        return self.run('retrieve', guids)
+
+    def expiring_cards(self, guids, before=None):
+        '''Yields the BulkResult of every card that expires before the month of `before` (today by default).
+
+        The ExpirationDate is read from the VaultResponse of a RETRIEVE.
+        '''
+        before = (before or datetime.date.today()).replace(day=1)
+        for result in self.retrieve(guids):
+            expiration = sevd.parse_expiration_date(result.expiration_date)
+            if result.ok and expiration is not None and expiration < before:
+                yield result
+
+
+def serialize_chunk(requests):
+    '''Renders a chunk of requests with sevd.to_xml_string(). Runs in a BulkCodec worker.'''
+    return [sevd.to_xml_string(request) for request in requests]
+
+def parse_chunk(bodies, unknown=None):
+    '''Parses a chunk of raw bodies into eager Responses. Runs in a BulkCodec worker.'''
+    return [sevd.parse_response(body, lazy=False, unknown=unknown) for body in bodies]
+
+
+class BulkCodec(object):
+    '''Serializes requests and parses response bodies in a process pool.
+
+    Items are sent to the workers in chunks of `chunk_size`, and at most
+    `prefetch` chunks per worker are in flight, so the input can be any
+    iterable and is consumed lazily. Objects cross the process boundary in
+    the compact format of sevd.pack(). `executor` may be an existing
+    concurrent.futures executor to use instead of a new ProcessPoolExecutor
+    with `workers` processes (the number of CPUs by default). It is not shut
+    down by close().
+
+    Workers use the sevd settings (VALIDATE_REQUESTS, XML_BACKEND...) they
+    were started with. Unknown elements are counted in the UNKNOWN_ELEMENTS
+    of the worker, not of the caller.
+    '''
+
+    def __init__(self, workers=None, chunk_size=64, prefetch=2, executor=None):
+        if chunk_size < 1:
+            raise ValueError('chunk_size must be at least 1.')
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self._owns_executor = executor is None
+        self.executor = executor or futures.ProcessPoolExecutor(self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown()
+
+    def map(self, fn, items, ordered=True, args=()):
+        '''Yields the results of `fn(chunk, *args)` for every chunk of `items`, one at a time.
+
+        With `ordered` the results follow the order of `items`. Otherwise
+        each chunk's results are yielded as soon as it is done. An exception
+        raised by a worker is raised here when its chunk is reached.
+        '''
+        items = iter(items)
+        limit = max(1, self.workers * self.prefetch)
+        pending = collections.deque() if ordered else set()
+        while True:
+            chunk = list(itertools.islice(items, self.chunk_size))
+            if chunk:
+                future = self.executor.submit(fn, chunk, *args)
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+                if len(pending) < limit:
+                    continue
+            elif not pending:
+                return
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    yield result
+
+    def serialize(self, requests, ordered=True):
+        '''Yields the XML document of every request in `requests` (see sevd.to_xml_string()).'''
+        return self.map(serialize_chunk, requests, ordered)
+
+    def parse(self, bodies, ordered=True, unknown=None):
+        '''Yields a Response for every raw body in `bodies` (see sevd.parse_response()).'''
+        return self.map(parse_chunk, bodies, ordered, (unknown,))
@@ -0,0 +1,1015 @@
+'''Client for Sage Exchange Virtual Desktop that adds latency controls on top of sevd.
+
+The `execute_*` functions in sevd are stateless. A Client keeps the state
+needed to do better than a single blocking POST per call, such as the
+latencies observed for each operation and cached query results.
+'''
+import asyncio
+import collections
+from concurrent import futures
+import contextlib
+import functools
+import heapq
+import threading
+import time
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import sevd
+
+# Only these operations may ever be sent more than once. Payments and vault
+# operations change state at Sage and must never be hedged.
+READ_ONLY_OPERATIONS = ('vault_status_query', 'transaction_status_query')
+
+# Response code Sage returns when a VaultID or TransactionID is unknown.
+NOT_FOUND_RESPONSE_CODE = '411411'
+
+# Priority classes of the Scheduler, highest first, and their default weights.
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BACKGROUND, BULK)
+DEFAULT_WEIGHTS = {INTERACTIVE: 100, BACKGROUND: 10, BULK: 1}
+
+# Highest concurrency an AdaptiveLimit grows to unless told otherwise.
+DEFAULT_MAX_LIMIT = 64
+
+# Clients with a cache. See invalidate_written_vault().
+CACHING_CLIENTS = weakref.WeakSet()
+
+
+class LatencyTracker(object):
+    '''Keeps a sliding window of observed latencies for one operation.'''
+
+    def __init__(self, window=200, min_samples=20):
+        self.min_samples = min_samples
+        self._samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percentile):
+        '''Returns the observed latency at `percentile` (0-1) or None if there are too few samples.'''
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+
+class HedgeBudget(object):
+    '''Caps hedged requests to a fraction of all requests.
+
+    Every request earns `ratio` tokens (up to `burst`) and every hedge spends
+    one, so in the long run hedging adds at most `ratio` extra load.
+    '''
+
+    def __init__(self, ratio=0.1, burst=10):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = 0.0
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def spend(self):
+        '''Returns True and spends a token if a hedge is allowed.'''
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class HedgePolicy(object):
+    '''Settings for hedging read-only queries.
+
+    A duplicate request is sent when no response has arrived within the
+    observed `percentile` latency for the operation, as long as `budget`
+    allows it. Until enough latencies are observed nothing is hedged.
+    '''
+
+    def __init__(self, percentile=0.95, budget=None, min_delay=0.01, window=200, min_samples=20, max_workers=8):
+        self.percentile = percentile
+        self.budget = budget or HedgeBudget()
+        self.min_delay = min_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+
+
+def first(value):
+    '''Returns the first item of a `multiple=True` member, which may or may not be a list.'''
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
+
+def is_final_vault_status(response):
+    '''True if a vault status query Response will not change and so may be cached.'''
+    query_response = response.vault_query_response
+    if query_response is None or query_response.response is None:
+        return False
+    return (query_response.response.response_indicator == 'A'
+            and query_response.response.response_code != NOT_FOUND_RESPONSE_CODE
+            and query_response.vault_response is not None)
+
+def is_final_transaction_status(response):
+    '''True if a transaction status query Response will not change and so may be cached.
+
+    Declined transactions are final. Approved transactions are only final once
+    they have settled.
+    '''
+    if response.transaction_query_responses is None:
+        return False
+    status = first(response.transaction_query_responses.transaction_status_query_responses)
+    if status is None or status.response is None or status.response.response_code == NOT_FOUND_RESPONSE_CODE:
+        return False
+    if status.response.response_indicator == 'D':
+        return True
+    settlement = status.transaction_settlement_status
+    return status.response.response_indicator == 'A' and settlement is not None and settlement.settlement_date is not None
+
+def invalidate_written_vault(sage_request, sage_response):
+    '''sevd response listener that invalidates the vault entries a request updated or deleted.
+
+    It runs once the response to the write arrives, for requests sent through
+    a Client and for direct sevd.execute_* and send_request() calls alike.
+    '''
+    if sage_response.vault_response is None and sage_response.payment_responses is None:
+        return
+    for client in list(CACHING_CLIENTS):
+        client._invalidate_request(sage_request)
+
+sevd.add_response_listener(invalidate_written_vault)
+
+
+class LRUCache(object):
+    '''In-process cache backend that evicts the least recently used entry and expires entries after `ttl` seconds.
+
+    Cached objects are shared between callers and must not be modified.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class DjangoCache(object):
+    '''Cache backend that stores entries in one of the Django caches (settings.CACHES).'''
+
+    def __init__(self, alias='default', ttl=300, prefix='sevd'):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def make_key(self, key):
+        return ':'.join([self.prefix] + [str(part) for part in key])
+
+    def get(self, key):
+        return self.cache.get(self.make_key(key))
+
+    def set(self, key, value):
+        self.cache.set(self.make_key(key), value, self.ttl)
+
+    def delete(self, key):
+        self.cache.delete(self.make_key(key))
+
+
+class SingleFlight(object):
+    '''Lets concurrent callers asking for the same key share one call and its result.'''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, call, deadline=None):
+        '''Runs `call` unless a call for `key` is already in flight, in which case its result is shared.'''
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = futures.Future()
+
+        if not leader:
+            try:
+                return future.result(deadline.remaining() if deadline is not None else None)
+            except futures.TimeoutError:
+                raise sevd.DeadlineExceeded('Deadline of %ss exceeded waiting for %s.' % (deadline.timeout, key[0]))
+
+        try:
+            result = call()
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+class AsyncSingleFlight(object):
+    '''SingleFlight for coroutines running on one asyncio event loop.'''
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key, coroutine_function):
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(coroutine_function())
+            task.add_done_callback(lambda t: self._tasks.pop(key, None))
+        # a cancelled caller must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+
+class RateLimitExceeded(sevd.DeadlineExceeded):
+    '''Raised when a rate limit would hold a request past its deadline.'''
+
+
+class TokenBucket(object):
+    '''Token bucket allowing `rate` requests per second with bursts of up to `burst`.
+
+    A `rate` of None means unlimited. Tokens are reserved ahead of time, so a
+    caller that has to wait knows how long up front and callers are served in
+    the order they arrive. The limits can be changed at any time with
+    configure().
+    '''
+
+    def __init__(self, rate=None, burst=None):
+        self.acquired = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.rate = None
+        self.burst = None
+        self.tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def configure(self, rate=None, burst=None):
+        '''Sets the limit. `burst` defaults to one second's worth of requests (at least 1).'''
+        if rate is not None and rate <= 0:
+            raise ValueError('rate must be greater than 0 (or None for no limit).')
+        with self._lock:
+            self._refill(time.monotonic())
+            unlimited = self.rate is None
+            self.rate = rate
+            self.burst = burst if burst is not None else (max(1.0, float(rate)) if rate is not None else None)
+            if rate is not None:
+                # a bucket that was unlimited starts full
+                self.tokens = self.burst if unlimited else min(self.tokens, self.burst)
+
+    def reserve(self, max_wait=None):
+        '''Takes a token and returns the number of seconds to wait before using it.
+
+        Returns None, without taking a token, if the wait would be `max_wait`
+        seconds or more.
+        '''
+        with self._lock:
+            if self.rate is None:
+                self.acquired += 1
+                return 0.0
+            self._refill(time.monotonic())
+            wait = max(0.0, (1 - self.tokens) / self.rate)
+            if wait and max_wait is not None and wait >= max_wait:
+                self.rejected += 1
+                return None
+            self.tokens -= 1
+            self.acquired += 1
+            if wait:
+                self.throttled += 1
+                self.wait_seconds += wait
+            return wait
+
+    def refund(self):
+        '''Returns a token taken by reserve() that was not used.'''
+        with self._lock:
+            self.acquired -= 1
+            if self.rate is not None:
+                self.tokens = min(self.burst, self.tokens + 1)
+
+    def metrics(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': self.tokens if self.rate is not None else None,
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'rejected': self.rejected,
+                'wait_seconds': self.wait_seconds,
+            }
+
+
+class RateLimitedSession(object):
+    '''Session for one merchant that waits for its rate limits before every POST.
+
+    Used as the `session` of the sevd functions. When the POST has a
+    `timeout` (the time its deadline has left) and the limits would hold it
+    longer, RateLimitExceeded is raised without waiting.
+    '''
+
+    def __init__(self, pools, merchant_id, session):
+        self.pools = pools
+        self.merchant_id = merchant_id
+        self.session = session
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        wait = self.pools.reserve(self.merchant_id, timeout)
+        if wait is None:
+            raise RateLimitExceeded('Rate limit for merchant %s would be exceeded within the %.3fs left.' % (self.merchant_id, timeout))
+        if wait:
+            time.sleep(wait)
+            if timeout is not None:
+                timeout -= wait
+        return self.session.post(url, data=data, timeout=timeout, **kwargs)
+
+
+class MerchantPools(object):
+    '''A connection pool and rate limit for each merchant, with an optional global limit.
+
+    Every merchant gets its own requests.Session with an HTTPAdapter of up to
+    `pool_maxsize` connections, so one merchant's bulk job cannot use up the
+    connections another merchant's checkout needs. `rate` and `burst` are the
+    default per-merchant TokenBucket limits (None for unlimited) and can be
+    overridden per merchant with set_limit(). `global_rate` and
+    `global_burst` limit all merchants together.
+    '''
+
+    def __init__(self, pool_maxsize=10, rate=None, burst=None, global_rate=None, global_burst=None):
+        self.pool_maxsize = pool_maxsize
+        self.rate = rate
+        self.burst = burst
+        self.global_limit = TokenBucket(global_rate, global_burst)
+        self.limits = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def limit(self, merchant_id):
+        '''Returns the TokenBucket of `merchant_id`.'''
+        with self._lock:
+            bucket = self.limits.get(merchant_id)
+            if bucket is None:
+                bucket = self.limits[merchant_id] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    def set_limit(self, merchant_id, rate, burst=None):
+        self.limit(merchant_id).configure(rate, burst)
+
+    def set_global_limit(self, rate, burst=None):
+        self.global_limit.configure(rate, burst)
+
+    def session(self, merchant_id):
+        '''Returns the RateLimitedSession of `merchant_id`.'''
+        with self._lock:
+            session = self._sessions.get(merchant_id)
+            if session is None:
+                session = self._sessions[merchant_id] = RateLimitedSession(self, merchant_id, self._new_session())
+            return session
+
+    def reserve(self, merchant_id, max_wait=None):
+        '''Reserves a request with both the merchant's and the global limit. See TokenBucket.reserve().'''
+        bucket = self.limit(merchant_id)
+        wait = bucket.reserve(max_wait)
+        if wait is None:
+            return None
+        global_wait = self.global_limit.reserve(max_wait)
+        if global_wait is None:
+            bucket.refund()
+            return None
+        return max(wait, global_wait)
+
+    def metrics(self):
+        '''Returns the TokenBucket metrics of the global limit and of every merchant.'''
+        with self._lock:
+            limits = list(self.limits.items())
+        return {
+            'global': self.global_limit.metrics(),
+            'merchants': dict((merchant_id, bucket.metrics()) for merchant_id, bucket in limits),
+        }
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.session.close()
+
+
+class QueueTimeout(sevd.DeadlineExceeded):
+    '''Raised when a request cannot be given a slot by the Scheduler before its deadline.'''
+
+
+class Scheduler(object):
+    '''Shares `slots` concurrent requests between priority classes with weighted fair queuing.
+
+    While every slot is in use, waiting requests are admitted in order of
+    their virtual finish time, so each class with waiting requests gets
+    slots in proportion to its weight (see DEFAULT_WEIGHTS). `reserve` slots
+    are held back for INTERACTIVE requests only. A checkout then never waits
+    behind a bulk run that has filled the other slots.
+    '''
+
+    def __init__(self, slots=10, weights=None, reserve=1):
+        if reserve >= slots:
+            raise ValueError('reserve must leave at least one slot for every class.')
+        self.slots = slots
+        self.reserve = reserve
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self._last_finish = dict.fromkeys(PRIORITIES, 0.0)
+        self._queues = dict((priority, []) for priority in PRIORITIES)
+        self._sequence = 0
+        self._admitted = dict.fromkeys(PRIORITIES, 0)
+        self._wait_seconds = dict.fromkeys(PRIORITIES, 0.0)
+        self._lock = threading.Lock()
+
+    def _capacity(self, priority):
+        limit = self.slots if priority == INTERACTIVE else self.slots - self.reserve
+        return self.in_flight < limit
+
+    def _admit(self, priority, waited):
+        self.in_flight += 1
+        self._admitted[priority] += 1
+        self._wait_seconds[priority] += waited
+
+    def _dispatch(self):
+        '''Admits waiting requests while there are free slots. Must be called with the lock held.'''
+        while True:
+            best = None
+            for priority in PRIORITIES:
+                queue = self._queues[priority]
+                # drop requests that gave up waiting
+                while queue and queue[0][3].cancelled:
+                    heapq.heappop(queue)
+                if queue and self._capacity(priority) and (best is None or queue[0] < best[0]):
+                    best = (queue[0], priority)
+            if best is None:
+                return
+            entry, priority = best
+            heapq.heappop(self._queues[priority])
+            finish, sequence, enqueued, ticket = entry
+            self.virtual_time = max(self.virtual_time, finish)
+            self._admit(priority, time.monotonic() - enqueued)
+            ticket.granted = True
+            ticket.event.set()
+
+    def acquire(self, priority=INTERACTIVE, timeout=None):
+        '''Waits for a slot for a request of class `priority`.
+
+        Raises QueueTimeout if none is free within `timeout` seconds.
+        '''
+        if priority not in PRIORITIES:
+            raise ValueError('%s: priority must be one of %s.' % (priority, ', '.join(PRIORITIES)))
+        with self._lock:
+            if not self._queues[priority] and self._capacity(priority) and not any(self._queues.values()):
+                self._admit(priority, 0.0)
+                return
+            start = max(self.virtual_time, self._last_finish[priority])
+            finish = self._last_finish[priority] = start + 1.0 / self.weights[priority]
+            self._sequence += 1
+            ticket = _Ticket()
+            heapq.heappush(self._queues[priority], (finish, self._sequence, time.monotonic(), ticket))
+            self._dispatch()
+
+        if ticket.event.wait(timeout):
+            return
+        with self._lock:
+            if ticket.granted:
+                return
+            ticket.cancelled = True
+        raise QueueTimeout('No %s slot became free within %.3fs.' % (priority, timeout))
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._dispatch()
+
+    @contextlib.contextmanager
+    def slot(self, priority=INTERACTIVE, timeout=None):
+        '''Context manager holding a slot for the duration of a request.'''
+        self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'slots': self.slots,
+                'in_flight': self.in_flight,
+                'queued': dict((priority, sum(1 for entry in queue if not entry[3].cancelled)) for priority, queue in self._queues.items()),
+                'admitted': dict(self._admitted),
+                'wait_seconds': dict(self._wait_seconds),
+            }
+
+
+class _Ticket(object):
+    __slots__ = ('event', 'granted', 'cancelled')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+
+class ScheduledSession(object):
+    '''Session that takes a Scheduler slot of class `priority` for every POST.
+
+    The time spent waiting for the slot comes out of the POST's `timeout`.
+    '''
+
+    def __init__(self, scheduler, priority, session=None):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.session = session or requests
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        start = time.monotonic()
+        with self.scheduler.slot(self.priority, timeout):
+            if timeout is not None:
+                timeout = max(0.001, timeout - (time.monotonic() - start))
+            return self.session.post(url, data=data, timeout=timeout, **kwargs)
+
+
+class AdaptiveLimit(object):
+    '''Concurrency limit for one endpoint adjusted by AIMD from observed round trips.
+
+    Every successful request that finds the limit in use raises it by
+    `increase` / limit, which is about `increase` per round trip. A request
+    that fails, or whose round trip is more than `tolerance` times the
+    fastest of the last `window`, multiplies the limit by `backoff`. This
+    happens at most once per smoothed round trip, so one slow burst only
+    counts once. The limit stays between `min_limit` and `max_limit`.
+    '''
+
+    def __init__(self, initial=4, min_limit=1, max_limit=DEFAULT_MAX_LIMIT, increase=1.0, backoff=0.5, tolerance=2.0, window=100, smoothing=0.2):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.rtt = None
+        self.successes = 0
+        self.errors = 0
+        self.decreases = 0
+        self._rtts = collections.deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._waiters = []
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        '''The number of requests currently allowed in flight.'''
+        return max(self.min_limit, int(self.limit))
+
+    def try_acquire(self, waiter=None):
+        '''Takes a slot if one is free. Otherwise `waiter` is called once the next slot is released.'''
+        with self._lock:
+            if self.in_flight < self.current:
+                self.in_flight += 1
+                return True
+            if waiter is not None:
+                self._waiters.append(waiter)
+            return False
+
+    def acquire(self, timeout=None):
+        '''Waits for a slot. Raises QueueTimeout if none is free within `timeout` seconds.'''
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            event = threading.Event()
+            if self.try_acquire(event.set):
+                return
+            remaining = expires_at - time.monotonic() if expires_at is not None else None
+            if (remaining is not None and remaining <= 0) or not event.wait(remaining):
+                raise QueueTimeout('No slot under the concurrency limit of %d became free within %.3fs.' % (self.current, timeout))
+
+    async def acquire_async(self):
+        '''Waits for a slot without blocking the event loop.'''
+        loop = asyncio.get_running_loop()
+        while True:
+            future = loop.create_future()
+            def wake():
+                loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+            if self.try_acquire(wake):
+                return
+            await future
+
+    def release(self, rtt, error=False):
+        '''Gives back a slot and adjusts the limit from the request's round trip `rtt` (seconds).'''
+        now = time.monotonic()
+        with self._lock:
+            saturated = self.in_flight >= self.current
+            self.in_flight -= 1
+            self.rtt = rtt if self.rtt is None else self.smoothing * rtt + (1 - self.smoothing) * self.rtt
+            if error:
+                self.errors += 1
+                congested = True
+            else:
+                self.successes += 1
+                self._rtts.append(rtt)
+                congested = rtt > self.tolerance * min(self._rtts)
+            if congested:
+                if now - self._last_decrease >= self.rtt:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self.decreases += 1
+                    self._last_decrease = now
+            elif saturated:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            waiter()
+
+    @contextlib.contextmanager
+    def measure(self, timeout=None):
+        '''Holds a slot for the duration of the block, timing it and counting exceptions as errors.'''
+        self.acquire(timeout)
+        start = time.monotonic()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.release(time.monotonic() - start, error)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'limit': self.current,
+                'in_flight': self.in_flight,
+                'rtt': self.rtt,
+                'min_rtt': min(self._rtts) if self._rtts else None,
+                'successes': self.successes,
+                'errors': self.errors,
+                'decreases': self.decreases,
+            }
+
+
+class AdaptiveConcurrency(object):
+    '''An AdaptiveLimit for every endpoint (operation), created on first use with `limit_options`.'''
+
+    def __init__(self, **limit_options):
+        self.limit_options = limit_options
+        self.max_limit = limit_options.get('max_limit', DEFAULT_MAX_LIMIT)
+        self.limits = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, endpoint):
+        with self._lock:
+            limit = self.limits.get(endpoint)
+            if limit is None:
+                limit = self.limits[endpoint] = AdaptiveLimit(**self.limit_options)
+            return limit
+
+    def current(self, endpoint):
+        '''The number of requests currently allowed in flight for `endpoint`.'''
+        return self.limiter(endpoint).current
+
+    def metrics(self):
+        with self._lock:
+            limits = list(self.limits.items())
+        return dict((endpoint, limit.metrics()) for endpoint, limit in limits)
+
+
+class Client(object):
+    '''Sends requests to Sage Exchange Virtual Desktop.
+
+    `hedging` is a HedgePolicy enabling hedged read-only queries. `cache` is
+    a cache backend (LRUCache, DjangoCache or anything with get, set and
+    delete) for final status query results, keyed by operation, merchant and
+    ID. Vault status is stored under the entry's GUID, which is dropped when
+    an UPDATE or DELETE of it gets a response (see invalidate_written_vault()).
+    Concurrent identical read-only queries share one POST unless
+    `coalesce` is False. `session` is passed on to sevd.post() for every call
+    unless `pools` (MerchantPools) is given, in which case each merchant's
+    requests go through its own rate limited connection pool.
+
+    With a `scheduler` every POST waits for a Scheduler slot of its priority
+    class, after any rate limit of its merchant. Calls take a `priority` argument; `priority` here is the default.
+    '''
+
+    def __init__(self, hedging=None, session=None, cache=None, coalesce=True, pools=None, scheduler=None, priority=INTERACTIVE):
+        self.hedging = hedging
+        self.session = session
+        self.pools = pools
+        self.scheduler = scheduler
+        self.priority = priority
+        self.cache = cache
+        if cache is not None:
+            CACHING_CLIENTS.add(self)
+        self.flights = SingleFlight() if coalesce else None
+        self.latencies = {}
+        self.hedges_sent = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        '''Stops the worker threads used for hedging and closes the connection pools.'''
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self.pools is not None:
+            self.pools.close()
+
+    def session_for(self, merchant_id, priority=None):
+        '''Returns the session requests for `merchant_id` of class `priority` are sent with.'''
+        session = self.session
+        if self.pools is not None:
+            session = self.pools.session(merchant_id)
+            if self.scheduler is not None:
+                # wait for the rate limit first so a throttled merchant does not hold a slot while it sleeps
+                scheduled = ScheduledSession(self.scheduler, priority or self.priority, session.session)
+                session = RateLimitedSession(self.pools, merchant_id, scheduled)
+        elif self.scheduler is not None:
+            session = ScheduledSession(self.scheduler, priority or self.priority, session)
+        return session
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(self.hedging.max_workers)
+            return self._executor
+
+    def _get_latency_tracker(self, operation):
+        with self._lock:
+            if operation not in self.latencies:
+                self.latencies[operation] = LatencyTracker(self.hedging.window, self.hedging.min_samples)
+            return self.latencies[operation]
+
+    def _hedged(self, operation, call, deadline):
+        '''Runs `call` and, if it is slow, a duplicate of it, returning whichever finishes first.'''
+        if operation not in READ_ONLY_OPERATIONS:
+            raise ValueError('%s: only read-only operations may be hedged.' % operation)
+
+        tracker = self._get_latency_tracker(operation)
+        budget = self.hedging.budget
+        executor = self._get_executor()
+
+        def timed_call():
+            start = time.monotonic()
+            result = call()
+            tracker.observe(time.monotonic() - start)
+            return result
+
+        budget.earn()
+        pending = set([executor.submit(timed_call)])
+        delay = tracker.percentile(self.hedging.percentile)
+        if delay is not None:
+            delay = max(delay, self.hedging.min_delay)
+            if deadline is not None:
+                delay = min(delay, deadline.remaining())
+            done, pending = futures.wait(pending, timeout=delay)
+            if not done and budget.spend():
+                with self._lock:
+                    self.hedges_sent += 1
+                pending.add(executor.submit(timed_call))
+            elif done:
+                return done.pop().result()
+
+        error = None
+        while pending:
+            timeout = deadline.remaining() if deadline is not None else None
+            done, pending = futures.wait(pending, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+            if not done:
+                raise sevd.DeadlineExceeded('Deadline of %ss exceeded waiting for %s.' % (deadline.timeout, operation))
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def _query(self, operation, merchant_id, query_id, call, deadline, is_final):
+        '''Runs a read-only `call`, using the cache, coalescing and hedging when they are enabled.'''
+        key = (operation, merchant_id, query_id)
+        if self.cache is not None:
+            response = self._cache_get(key)
+            if response is not None:
+                return response
+
+        fetch = functools.partial(self._fetch, key, call, deadline, is_final)
+        if self.flights is None:
+            return fetch()
+        return self.flights.do(key, fetch, deadline)
+
+    def _fetch(self, key, call, deadline, is_final):
+        operation, merchant_id, query_id = key
+        if self.hedging is None:
+            response = call()
+        else:
+            response = self._hedged(operation, call, deadline)
+
+        if self.cache is not None and is_final(response):
+            self._cache_set(key, response)
+        return response
+
+    def _cache_get(self, key):
+        operation, merchant_id, query_id = key
+        if operation != 'vault_status_query':
+            return self.cache.get(key)
+        # vault status is stored under its GUID; the query only points at it
+        guid = self.cache.get(key)
+        if guid is None:
+            return None
+        return self.cache.get(('vault_guid', merchant_id, guid))
+
+    def _cache_set(self, key, response):
+        operation, merchant_id, query_id = key
+        if operation != 'vault_status_query':
+            self.cache.set(key, response)
+            return
+        guid = response.vault_query_response.vault_response.guid
+        self.cache.set(('vault_guid', merchant_id, guid), response)
+        self.cache.set(key, guid)
+
+    def invalidate_vault(self, merchant_id, vault_guid):
+        '''Removes any cached status of the vault entry identified by `vault_guid`.
+
+        Every VaultID whose status query returned the entry is invalidated.
+        '''
+        if self.cache is not None:
+            self.cache.delete(('vault_guid', merchant_id, vault_guid))
+
+    def _invalidate_request(self, sage_request):
+        '''Invalidates every vault entry that `sage_request` updates or deletes.'''
+        storages = []
+        if sage_request.vault_operation is not None:
+            storages.append((sage_request.vault_operation.merchant, sage_request.vault_operation.vault_storage))
+        if sage_request.payments is not None and sage_request.payments.payment_type is not None:
+            payments = sage_request.payments.payment_type
+            for payment in payments if isinstance(payments, (list, tuple)) else [payments]:
+                storages.append((payment.merchant, payment.vault_storage))
+        for merchant, storage in storages:
+            if merchant is not None and storage is not None and storage.guid is not None and storage.service in ('UPDATE', 'DELETE'):
+                self.invalidate_vault(merchant.merchant_id, storage.guid)
+
+    def vault_status_query(self, app_id, merchant_id, merchant_key, vault_id, lang_id='EN', timeout=None, deadline=None, priority=None):
+        '''See sevd.execute_vault_status_query(). Cached and hedged when the client is set up for it.'''
+        deadline = sevd.make_deadline(timeout, deadline)
+        def call():
+            return sevd.execute_vault_status_query(app_id, merchant_id, merchant_key, vault_id, lang_id, deadline=deadline, session=self.session_for(merchant_id, priority))
+        return self._query('vault_status_query', merchant_id, vault_id, call, deadline, is_final_vault_status)
+
+    def transaction_status_query(self, app_id, merchant_id, merchant_key, trans_id, lang_id='EN', timeout=None, deadline=None, priority=None):
+        '''See sevd.execute_transaction_status_query(). Cached and hedged when the client is set up for it.'''
+        deadline = sevd.make_deadline(timeout, deadline)
+        def call():
+            return sevd.execute_transaction_status_query(app_id, merchant_id, merchant_key, trans_id, lang_id, deadline=deadline, session=self.session_for(merchant_id, priority))
+        return self._query('transaction_status_query', merchant_id, trans_id, call, deadline, is_final_transaction_status)
+
+    def vault_delete(self, app_id, merchant_id, merchant_key, vault_guid, query_first='vault', lang_id='EN', timeout=None, deadline=None, priority=None):
+        '''See sevd.execute_vault_delete(). Invalidates the cached status of the entry.'''
+        self.invalidate_vault(merchant_id, vault_guid)
+        try:
+            return sevd.execute_vault_delete(app_id, merchant_id, merchant_key, vault_guid, query_first, lang_id, timeout, deadline, self.session_for(merchant_id, priority))
+        except BaseException:
+            # the delete may have gone through without its response reaching invalidate_written_vault()
+            self.invalidate_vault(merchant_id, vault_guid)
+            raise
+
+    def vault_retrieve(self, app_id, merchant_id, merchant_key, vault_guid, query_first='vault', lang_id='EN', timeout=None, deadline=None, priority=None):
+        '''See sevd.execute_vault_retrieve().'''
+        return sevd.execute_vault_retrieve(app_id, merchant_id, merchant_key, vault_guid, query_first, lang_id, timeout, deadline, self.session_for(merchant_id, priority))
+
+    def send(self, sage_request, timeout=None, deadline=None, priority=None):
+        '''Sends any Request, invalidating cached vault entries it updates or deletes.'''
+        self._invalidate_request(sage_request)
+        try:
+            return sevd.send_request(sage_request, sevd.make_deadline(timeout, deadline), self.session_for(sevd.get_merchant_id(sage_request), priority))
+        except BaseException:
+            self._invalidate_request(sage_request)
+            raise
+
+    def html_form(self, sage_request, redirect_url, button_value, target='_blank', timeout=None, deadline=None):
+        '''See sevd.html_form().
+
+        The browser sends the form, so nothing is invalidated here. Call
+        invalidate_vault() when the result of an UPDATE or DELETE comes back.
+        '''
+        return sevd.html_form(sage_request, redirect_url, button_value, target, sevd.make_deadline(timeout, deadline))
+
+
+class AsyncClient(object):
+    '''Asyncio front end for a Client.
+
+    The blocking calls run in `executor` (the loop's default executor when not
+    given). Concurrent identical queries on the loop share one call. With
+    `adaptive` (AdaptiveConcurrency) the calls in flight for each operation
+    are limited by its AdaptiveLimit; callers over the limit wait on the loop
+    instead of holding an executor thread. A call keeps its slot until its
+    thread is done, even if the awaiting task is cancelled, and its round
+    trip is timed from when a thread starts it, so time queued in the
+    executor does not count. Without an `executor` those calls run in a
+    thread pool of the AsyncClient with a thread for every slot the limit
+    may grow to.
+    '''
+
+    def __init__(self, client=None, executor=None, adaptive=None):
+        self.client = client or Client()
+        self.executor = executor
+        self.adaptive = adaptive
+        self.flights = AsyncSingleFlight()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self.executor is not None:
+            return self.executor
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(self.adaptive.max_limit)
+            return self._executor
+
+    def close(self):
+        '''Stops the thread pool used for adaptive calls when no `executor` was given.'''
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def _run(self, operation, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        if self.adaptive is None:
+            return await loop.run_in_executor(self.executor, call)
+
+        limit = self.adaptive.limiter(operation)
+        await limit.acquire_async()
+        started = []
+        def timed_call():
+            started.append(time.monotonic())
+            return call()
+        def release(future):
+            # runs when the thread is done (or the call was cancelled before
+            # it started), not when the awaiting task is cancelled
+            rtt = time.monotonic() - started[0] if started else 0.0
+            limit.release(rtt, future.cancelled() or future.exception() is not None)
+        try:
+            future = self._get_executor().submit(timed_call)
+        except BaseException:
+            limit.release(0.0, True)
+            raise
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future, loop=loop)
+
+    async def vault_status_query(self, app_id, merchant_id, merchant_key, vault_id, lang_id='EN', timeout=None, deadline=None, priority=None):
+        '''See Client.vault_status_query().'''
+        deadline = sevd.make_deadline(timeout, deadline)
+        call = functools.partial(self._run, 'vault_status_query', self.client.vault_status_query, app_id, merchant_id, merchant_key, vault_id, lang_id, deadline=deadline, priority=priority)
+        return await self.flights.do(('vault_status_query', merchant_id, vault_id), call)
+
+    async def transaction_status_query(self, app_id, merchant_id, merchant_key, trans_id, lang_id='EN', timeout=None, deadline=None, priority=None):
+        '''See Client.transaction_status_query().'''
+        deadline = sevd.make_deadline(timeout, deadline)
+        call = functools.partial(self._run, 'transaction_status_query', self.client.transaction_status_query, app_id, merchant_id, merchant_key, trans_id, lang_id, deadline=deadline, priority=priority)
+        return await self.flights.do(('transaction_status_query', merchant_id, trans_id), call)
@@ -0,0 +1,36 @@
+# Generated for Django 1.11 and later on 2026-10-19 11:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VaultCard',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('guid', models.CharField(max_length=64, unique=True)),
+                ('merchant_id', models.CharField(blank=True, max_length=32)),
+                ('last4', models.CharField(blank=True, max_length=4)),
+                ('payment_description', models.CharField(blank=True, max_length=32)),
+                ('payment_type_id', models.CharField(blank=True, max_length=8)),
+                ('expiration_date', models.CharField(blank=True, max_length=4)),
+                ('expiration_month', models.DateField(blank=True, db_index=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='vault_cards', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', 'expiration_month'], name='sevd_vaultcard_owner_exp')],
+            },
+        ),
+    ]
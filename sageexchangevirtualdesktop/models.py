@@ -0,0 +1,99 @@
+'''Local index of cards stored in the Sage Vault.
+
+Card metadata (last4, expiration, payment type) is recorded from every vault
+response that passes through sevd.send_request() so that card-on-file screens
+can be rendered without calling Sage. Recording is enabled by the app's
+AppConfig when the SEVD_VAULT_CARD_INDEX setting is True.
+'''
+import datetime
+
+from django.conf import settings
+from django.db import models
+
+from . import sevd
+
+
+def iter_vault_responses(sage_response):
+    '''Yields every VaultResponseType found in a Response.'''
+    for path in ('VaultStatusQueryResponse/VaultResponse', 'VaultResponse', 'PaymentResponses/*/VaultResponse'):
+        for vault_response in sage_response.select(path):
+            yield vault_response
+
+
+class VaultCardManager(models.Manager):
+
+    def for_owner(self, owner):
+        return self.filter(owner=owner)
+
+    def expiring(self, year, month):
+        '''Cards that expire in the given month.'''
+        return self.filter(expiration_month=datetime.date(year, month, 1))
+
+    def expiring_before(self, date):
+        '''Cards that expire before the month containing `date`.'''
+        return self.filter(expiration_month__lt=date.replace(day=1))
+
+    def claim(self, guid, owner):
+        '''Assigns the card identified by `guid` to `owner`.'''
+        return self.filter(guid=guid).update(owner=owner)
+
+    def update_from_vault_response(self, vault_response, merchant_id='', owner=None):
+        '''Creates or updates the card described by a successful VaultResponseType.
+
+        The owner of an existing card is kept unless `owner` is given.
+        '''
+        if vault_response.guid is None or vault_response.response is None or vault_response.response.response_indicator != 'A':
+            return None
+        if vault_response.last4 is None and vault_response.expiration_date is None:
+            # e.g. a DELETE response only carries the GUID
+            return None
+        values = {
+            'merchant_id': merchant_id or '',
+            'last4': (vault_response.last4 or '')[-4:],
+            'payment_description': vault_response.payment_description or '',
+            'payment_type_id': vault_response.payment_type_id or '',
+            'expiration_date': vault_response.expiration_date or '',
+            'expiration_month': sevd.parse_expiration_date(vault_response.expiration_date),
+        }
+        if owner is not None:
+            values['owner'] = owner
+        card, created = self.update_or_create(guid=vault_response.guid, defaults=values)
+        return card
+
+    def record_response(self, sage_request, sage_response):
+        '''Response listener that keeps the index in step with what Sage returns.'''
+        merchant_id = sevd.get_merchant_id(sage_request)
+        operation = sage_request.vault_operation
+        if operation is not None and operation.vault_storage is not None and operation.vault_storage.service == 'DELETE':
+            vault_response = sage_response.vault_response
+            if vault_response is not None and vault_response.response is not None and vault_response.response.response_indicator == 'A':
+                self.filter(guid=operation.vault_storage.guid).delete()
+            return
+        for vault_response in iter_vault_responses(sage_response):
+            self.update_from_vault_response(vault_response, merchant_id)
+
+
+class VaultCard(models.Model):
+    '''A card stored in the Sage Vault, identified by its GUID.'''
+    guid = models.CharField(max_length=64, unique=True)
+    merchant_id = models.CharField(max_length=32, blank=True)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name='vault_cards', on_delete=models.CASCADE)
+    last4 = models.CharField(max_length=4, blank=True)
+    payment_description = models.CharField(max_length=32, blank=True)
+    payment_type_id = models.CharField(max_length=8, blank=True)
+    # ExpirationDate exactly as returned by Sage (MMYY)
+    expiration_date = models.CharField(max_length=4, blank=True)
+    # first day of the month the card expires, for range lookups
+    expiration_month = models.DateField(null=True, blank=True, db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = VaultCardManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'expiration_month'], name='sevd_vaultcard_owner_exp'),
+        ]
+
+    def __str__(self):
+        return '%s ending %s (%s)' % (self.payment_description or 'Card', self.last4, self.expiration_date)
@@ -0,0 +1,180 @@
+'''Settlement reconciliation of a local ledger against Sage Exchange results.
+
+Sage-side records (from TransactionStatusQueryResponseType and
+TransactionResponseType results) and ledger rows are streamed, both sorted by
+TransactionID, and merge-joined. Only the current record of each side is held
+in memory so any number of records can be reconciled.
+
+Example:
+
+    sage = iter_sage_records(responses_sorted_by_transaction_id)
+    with open('ledger.csv') as f:
+        for result in reconcile(sage, read_ledger_csv(f)):
+            if result.status != MATCHED:
+                ...
+'''
+import collections
+import csv
+
+from . import sevd
+
+MATCHED = 'matched'
+MISSING_FROM_SAGE = 'missing_from_sage'
+MISSING_FROM_LEDGER = 'missing_from_ledger'
+AMOUNT_MISMATCH = 'amount_mismatch'
+UNSETTLED = 'unsettled'
+
+SageRecord = collections.namedtuple('SageRecord', 'transaction_id amount response_indicator settlement_date batch_reference')
+LedgerRow = collections.namedtuple('LedgerRow', 'transaction_id amount')
+Reconciliation = collections.namedtuple('Reconciliation', 'status transaction_id sage ledger')
+BatchDifference = collections.namedtuple('BatchDifference', 'net count suspects')
+
+
+def to_cents(value):
+    '''Converts an amount (Money, str, int, float or Decimal) to an integer number of cents.
+
+    Ledger amounts with fractions of a cent are rounded half up (see
+    sevd.Money.parse()).
+    '''
+    if value is None:
+        return None
+    return sevd.Money.parse(value).cents
+
+def format_cents(cents):
+    '''Formats an integer number of cents as an amount with two decimal places.'''
+    return str(sevd.Money(cents))
+
+def iter_sage_records(responses):
+    '''Yields a SageRecord for every transaction in an iterable of Response objects.
+
+    Transaction status query results carry their settlement status. Payment
+    results (TransactionResponseType only) are never settled.
+    '''
+    for response in responses:
+        for status in response.select('TransactionStatusQueryResponses/*'):
+            transaction = status.transaction_response
+            if transaction is None:
+                continue
+            settlement = status.transaction_settlement_status
+            yield SageRecord(
+                transaction.transaction_id,
+                transaction.amount,
+                status.select_one('Response/ResponseIndicator'),
+                settlement.settlement_date if settlement is not None else None,
+                settlement.batch_reference if settlement is not None else None,
+            )
+        for payment in response.select('PaymentResponses/*'):
+            transaction = payment.transaction_response
+            if transaction is None:
+                continue
+            yield SageRecord(
+                transaction.transaction_id,
+                transaction.amount,
+                payment.select_one('Response/ResponseIndicator'),
+                None,
+                None,
+            )
+
+def read_ledger_csv(f, id_column='transaction_id', amount_column='amount'):
+    '''Yields a LedgerRow for every row of a CSV file with a header row.'''
+    for row in csv.DictReader(f):
+        yield LedgerRow(row[id_column], row[amount_column])
+
+def _sorted(records, side):
+    '''Passes `records` through, raising ValueError if they are not strictly sorted by transaction_id.'''
+    previous = None
+    for record in records:
+        if previous is not None and record[0] <= previous:
+            raise ValueError('%s records must be sorted by TransactionID without duplicates: "%s" follows "%s".' % (side, record[0], previous))
+        previous = record[0]
+        yield record
+
+def reconcile(sage_records, ledger_rows):
+    '''Merge-joins Sage records with ledger rows and yields a Reconciliation for every TransactionID.
+
+    Both iterables must be sorted by TransactionID. Ledger rows may be
+    LedgerRow instances or any (transaction_id, amount) tuple. The status of
+    each result is one of MATCHED, AMOUNT_MISMATCH, UNSETTLED,
+    MISSING_FROM_SAGE or MISSING_FROM_LEDGER.
+    '''
+    sage_records = _sorted(sage_records, 'Sage')
+    ledger_rows = _sorted(ledger_rows, 'Ledger')
+    sage = next(sage_records, None)
+    ledger = next(ledger_rows, None)
+    while sage is not None or ledger is not None:
+        if ledger is None or (sage is not None and sage.transaction_id < ledger[0]):
+            yield Reconciliation(MISSING_FROM_LEDGER, sage.transaction_id, sage, None)
+            sage = next(sage_records, None)
+        elif sage is None or ledger[0] < sage.transaction_id:
+            yield Reconciliation(MISSING_FROM_SAGE, ledger[0], None, ledger)
+            ledger = next(ledger_rows, None)
+        else:
+            if to_cents(sage.amount) != to_cents(ledger[1]):
+                status = AMOUNT_MISMATCH
+            elif sage.settlement_date is None:
+                status = UNSETTLED
+            else:
+                status = MATCHED
+            yield Reconciliation(status, sage.transaction_id, sage, ledger)
+            sage = next(sage_records, None)
+            ledger = next(ledger_rows, None)
+
+def summarize(results):
+    '''Counts reconciliation results by status.'''
+    return collections.Counter(result.status for result in results)
+
+
+class BatchTotals(object):
+    '''Net and Count of a batch computed from ledger rows.
+
+    The rows are indexed by amount so the transactions that could explain a
+    difference with Sage's totals can be found without scanning the batch.
+    '''
+
+    def __init__(self, ledger_rows=()):
+        self.net = 0
+        self.count = 0
+        self.by_amount = collections.defaultdict(list)
+        for row in ledger_rows:
+            self.add(row[0], row[1])
+
+    def add(self, transaction_id, amount):
+        cents = to_cents(amount)
+        self.net += cents
+        self.count += 1
+        self.by_amount[cents].append(transaction_id)
+
+    def suspects(self, net_difference):
+        '''Transactions that could explain Sage's Net being `net_difference` cents away from ours.
+
+        A single transaction missing at Sage shows up as a difference of its
+        own amount; one booked with the wrong sign as twice its amount. Only
+        ledger rows can be suspects, so a transaction only known to Sage is
+        never found here.
+        '''
+        if net_difference == 0:
+            return []
+        suspects = list(self.by_amount.get(-net_difference, []))
+        if net_difference % 2 == 0:
+            suspects.extend(self.by_amount.get(-net_difference // 2, []))
+        return suspects
+
+    def compare(self, batch_response):
+        '''Returns a BatchDifference (Sage minus ours) with a BatchResponseType.'''
+        net = to_cents(batch_response.net) - self.net
+        count = int(batch_response.count) - self.count
+        return BatchDifference(net, count, self.suspects(net))
+
+
+def close_batch(app_id, merchant_id, merchant_key, ledger_rows, batch_payment='CREDITCARD', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Closes the batch with totals computed from `ledger_rows` and compares them with Sage's.
+
+    Returns the Response and a BatchDifference, which is None if Sage did not
+    return a BatchResponse.
+    '''
+    totals = BatchTotals(ledger_rows)
+    response = sevd.execute_batch_close(app_id, merchant_id, merchant_key, sevd.Money(totals.net), totals.count, batch_payment, lang_id, timeout, deadline, session)
+    batch_response = response.batch_response
+    if batch_response is None or batch_response.net is None or batch_response.count is None:
+        return response, None
+    return response, totals.compare(batch_response)
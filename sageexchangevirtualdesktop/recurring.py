@@ -0,0 +1,260 @@
+'''Local projection of RecurringType schedules.
+
+Sage runs recurring charges itself; this module computes when those charges
+will run so cash flow can be forecast and billing runs pre-staged without
+asking Sage. A BusinessCalendar precomputes lookup tables for a date range
+(the next and previous business day of every day, and the date of every
+DayOfMonth in every month) so projecting many schedules is a series of table
+lookups.
+
+Example:
+
+    calendar = BusinessCalendar(datetime.date(2026, 1, 1), datetime.date(2027, 12, 31))
+    schedules = [compile_schedule(payment.recurring) for payment in payments]
+    for schedule, dates in zip(schedules, project(schedules, 12, calendar)):
+        ...
+'''
+from array import array
+import collections
+import datetime
+
+from . import sevd
+
+WEEKEND = (5, 6)
+UNBOUNDED = -1
+
+
+def nth_weekday(year, month, weekday, n):
+    '''The `n`th `weekday` (0 is Monday) of a month. A negative `n` counts from the end of the month.'''
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7 + 7 * (-n - 1))
+
+def month_length(year, month):
+    '''The number of days in a month.'''
+    return (datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.date(year, month, 1)).days
+
+def federal_reserve_holidays(year):
+    '''Days the Federal Reserve (and so card settlement) is closed in `year`.
+
+    Holidays falling on a Sunday are observed the following Monday. Those
+    falling on a Saturday are not moved.
+    '''
+    fixed = [datetime.date(year, 1, 1), datetime.date(year, 7, 4), datetime.date(year, 11, 11), datetime.date(year, 12, 25)]
+    if year >= 2021:
+        fixed.append(datetime.date(year, 6, 19))
+    holidays = [day + datetime.timedelta(days=1) if day.weekday() == 6 else day for day in fixed]
+    holidays.extend([
+        nth_weekday(year, 1, 0, 3), # Martin Luther King Jr. Day
+        nth_weekday(year, 2, 0, 3), # Washington's Birthday
+        nth_weekday(year, 5, 0, -1), # Memorial Day
+        nth_weekday(year, 9, 0, 1), # Labor Day
+        nth_weekday(year, 10, 0, 2), # Columbus Day
+        nth_weekday(year, 11, 3, 4), # Thanksgiving Day
+    ])
+    return sorted(holidays)
+
+
+class BusinessCalendar(object):
+    '''Precomputed business days between `start` and `end` (inclusive).
+
+    `holidays` defaults to federal_reserve_holidays() for every year in the
+    range. Days are addressed by their offset from `start`.
+    '''
+
+    def __init__(self, start, end, holidays=None, weekend=WEEKEND):
+        if end < start:
+            raise ValueError('end must not be before start.')
+        self.start = start
+        self.end = end
+        self.base = start.toordinal()
+        self.size = end.toordinal() - self.base + 1
+        if holidays is None:
+            holidays = []
+            for year in range(start.year, end.year + 1):
+                holidays.extend(federal_reserve_holidays(year))
+        holidays = set(holidays)
+
+        days = [datetime.date.fromordinal(self.base + i) for i in range(self.size)]
+        business = [day.weekday() not in weekend and day not in holidays for day in days]
+        self.business = bytearray(business)
+
+        # next_business[i] / previous_business[i] are the offsets of the
+        # closest business day on or after / on or before day i (-1 if none
+        # in range).
+        self.next_business = array('l', [UNBOUNDED]) * self.size
+        self.previous_business = array('l', [UNBOUNDED]) * self.size
+        closest = UNBOUNDED
+        for i in range(self.size - 1, -1, -1):
+            if business[i]:
+                closest = i
+            self.next_business[i] = closest
+        closest = UNBOUNDED
+        for i in range(self.size):
+            if business[i]:
+                closest = i
+            self.previous_business[i] = closest
+
+        # month_days[m * 32 + d] is the offset of day d of month m (counted
+        # from the month of `start`), clamped to the last day of short months.
+        self.first_month = start.year * 12 + start.month - 1
+        self.months = end.year * 12 + end.month - self.first_month
+        self.month_days = array('l', [UNBOUNDED]) * (self.months * 32)
+        for m in range(self.months):
+            year, month = divmod(self.first_month + m, 12)
+            first = datetime.date(year, month + 1, 1).toordinal() - self.base
+            length = month_length(year, month + 1)
+            for day in range(1, 32):
+                self.month_days[m * 32 + day] = first + min(day, length) - 1
+
+    def offset(self, date):
+        return date.toordinal() - self.base
+
+    def date(self, offset):
+        return datetime.date.fromordinal(self.base + offset)
+
+    def month_index(self, date):
+        return date.year * 12 + date.month - 1 - self.first_month
+
+    def is_business_day(self, date):
+        offset = self.offset(date)
+        if not 0 <= offset < self.size:
+            raise ValueError('%s is outside of the calendar.' % date)
+        return bool(self.business[offset])
+
+    def adjust(self, offset, non_business_day):
+        '''Moves the run on day `offset` according to a NonBusinessDay rule.
+
+        Returns -1 if that leaves the calendar, before its start for BEFORE or
+        past its end for AFTER.
+        '''
+        if non_business_day == 'BEFORE':
+            return self.previous_business[offset]
+        if non_business_day == 'AFTER':
+            return self.next_business[offset]
+        return offset
+
+
+Schedule = collections.namedtuple('Schedule', 'schedule interval day_of_month start_date times_to_process non_business_day amount')
+
+def parse_start_date(value):
+    '''Parses a StartDate given as MM/DD/YYYY or YYYY-MM-DD.'''
+    value = value.strip()
+    for date_format in ('%m/%d/%Y', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise ValueError('StartDate: "%s" is not a date.' % value)
+
+def compile_schedule(recurring, default_start=None):
+    '''Converts a RecurringType into a Schedule.
+
+    A missing StartDate defaults to `default_start` (today when not given). A
+    TimesToProcess of zero or less means the schedule never ends.
+    '''
+    if recurring.start_date:
+        start = parse_start_date(str(recurring.start_date))
+    else:
+        start = default_start or datetime.date.today()
+    times = int(recurring.times_to_process) if recurring.times_to_process is not None else 0
+    return Schedule(
+        str(recurring.schedule).strip(),
+        max(1, int(recurring.interval or 1)),
+        int(recurring.day_of_month or start.day),
+        start,
+        times if times > 0 else None,
+        str(recurring.non_business_day or 'THATDAY').strip(),
+        sevd.Money.parse(recurring.amount) if recurring.amount is not None else None,
+    )
+
+def nominal_offsets(schedule, calendar, count, since=None):
+    '''Yields the calendar offsets of the next `count` runs of `schedule` on or after `since`, before NonBusinessDay adjustment.'''
+    times = schedule.times_to_process
+    if schedule.schedule == 'DAILY':
+        first = calendar.offset(schedule.start_date)
+        skip = 0
+        if since is not None and calendar.offset(since) > first:
+            skip = -(-(calendar.offset(since) - first) // schedule.interval)
+        step = schedule.interval
+        index = skip
+        produced = 0
+        offset = first + skip * step
+        while produced < count and offset < calendar.size and (times is None or index < times):
+            if offset >= 0:
+                yield offset
+                produced += 1
+            offset += step
+            index += 1
+
+    elif schedule.schedule == 'MONTHLY':
+        day = min(max(schedule.day_of_month, 1), 31)
+        start = schedule.start_date
+        month = calendar.month_index(start)
+        # the first run is in the start month unless its day has already passed
+        if min(day, month_length(start.year, start.month)) < start.day:
+            month += 1
+        since_offset = calendar.offset(since) if since is not None else None
+        index = 0
+        produced = 0
+        while produced < count and month < calendar.months and (times is None or index < times):
+            if month >= 0:
+                offset = calendar.month_days[month * 32 + day]
+                if since_offset is None or offset >= since_offset:
+                    yield offset
+                    produced += 1
+            month += schedule.interval
+            index += 1
+
+    else:
+        raise ValueError('Schedule: "%s" is not a valid Schedule.' % schedule.schedule)
+
+def project(schedules, count, calendar, since=None):
+    '''Returns, for every Schedule in `schedules`, a list of the dates of its next `count` runs.
+
+    Runs are counted from the schedule's start; only those on or after
+    `since` are returned. Runs that are moved before the start of `calendar`
+    and runs beyond its end are not returned.
+    Schedules that only differ by amount are projected once.
+    '''
+    base = calendar.base
+    fromordinal = datetime.date.fromordinal
+    projected = {}
+    results = []
+    for schedule in schedules:
+        key = schedule[:6]
+        dates = projected.get(key)
+        if dates is None:
+            rule = schedule.non_business_day
+            dates = []
+            for offset in nominal_offsets(schedule, calendar, calendar.size, since):
+                if len(dates) == count:
+                    break
+                offset = calendar.adjust(offset, rule)
+                if offset == UNBOUNDED:
+                    if rule == 'BEFORE':
+                        # moved before the calendar; later runs may still be in it
+                        continue
+                    break
+                dates.append(fromordinal(base + offset))
+            projected[key] = dates
+        results.append(list(dates))
+    return results
+
+def forecast(schedules, calendar, since=None, until=None):
+    '''Totals the Amount of every run between `since` and `until` by date.
+
+    Returns an OrderedDict of date: total in date order.
+    '''
+    until = until or calendar.end
+    totals = collections.defaultdict(sevd.Money)
+    for schedule, dates in zip(schedules, project(schedules, calendar.size, calendar, since)):
+        if schedule.amount is None:
+            continue
+        for date in dates:
+            if date > until:
+                break
+            totals[date] += schedule.amount
+    return collections.OrderedDict(sorted(totals.items()))
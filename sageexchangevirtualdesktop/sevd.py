@@ -1,23 +1,407 @@
 '''Sage Exchange Virtual Desktop integration.'''
+import collections
+import copy
+import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import functools
+import html
+import logging
+import os
 import re
+import sys
+import threading
+import time
 import uuid
 import warnings
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape as xml_escape
 
 try:
     from django.conf import settings
 except ImportError:
     settings = object()
+try:
+    import lxml.etree
+except ImportError:
+    lxml = None
 import requests
 
+logger = logging.getLogger(__name__)
+
 DEBUG = True
 SAGE_SEVD_ENCRYPT_URL = 'https://www.sageexchange.com/sevd/frmenvelope.aspx'
 SAGE_SEVD_DECRYPT_URL = 'https://www.sageexchange.com/sevd/frmopenenvelope.aspx'
 SAGE_SEVD_PAYMENT_URL = 'https://www.sageexchange.com/sevd/frmpayment.aspx'
 
+# parse_response() returns element-backed Responses (see lazy_from_xml())
+LAZY_RESPONSES = False
+
+# Callables run with (sage_request, sage_response) after every send_request().
+# See add_response_listener().
+RESPONSE_LISTENERS = []
+
 COLOR_REGEX = re.compile('^([0-9A-F][0-9A-F][0-9A-F])?([0-9A-F][0-9A-F][0-9A-F])?$', re.IGNORECASE)
+# re._pattern_type was removed in Python 3.7
+PATTERN_TYPE = type(COLOR_REGEX)
+MONEY_REGEX = re.compile(r'^([+-]?)(\d*)(?:\.(\d*))?$')
 HEX_COLOR_REGEX = re.compile('^#[0-9A-F][0-9A-F][0-9A-F][0-9A-F][0-9A-F][0-9A-F]$', re.IGNORECASE)
 
+##############################################################################
+# Deadlines so a whole request pipeline can be bound to a time budget        #
+##############################################################################
+
+# Bytes read at a time when a response is streamed under a deadline (see post()).
+READ_CHUNK_SIZE = 16384
+
+class DeadlineExceeded(requests.Timeout):
+    '''Raised when a Deadline runs out before the pipeline has finished.'''
+
+
+class Deadline(object):
+    '''A point in time by which a chain of calls must complete.
+
+    Create one with a budget in seconds and pass it through every step of the
+    pipeline (UUID probe, encryption, payment POST and parsing). Each network
+    hop is given whatever time is left and the pipeline aborts with
+    DeadlineExceeded as soon as the budget is used up.
+    '''
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        '''Seconds left before the deadline. Never negative.'''
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage):
+        '''Raises DeadlineExceeded if there is no time left to start `stage`.'''
+        if self.expired():
+            raise DeadlineExceeded('Deadline of %ss exceeded before %s.' % (self.timeout, stage))
+
+def make_deadline(timeout=None, deadline=None):
+    '''Returns `deadline` or, if only `timeout` is given, a new Deadline for it.'''
+    if deadline is None and timeout is not None:
+        deadline = Deadline(timeout)
+    return deadline
+
+def post(url, data, deadline=None, session=None):
+    '''POSTs `data` to `url` giving the call whatever time `deadline` has left.
+
+    `session` may be a requests.Session (or anything with a compatible `post`
+    method); the requests module is used when it is not specified.
+
+    The timeout requests applies is per connect and per read, so with a
+    `deadline` the body is streamed and the deadline is checked after every
+    chunk of READ_CHUNK_SIZE bytes; a body that trickles in raises
+    DeadlineExceeded instead of running on. A single read that stalls can
+    still take as long as the deadline had left when the POST was sent.
+    '''
+    if deadline is None:
+        return (session or requests).post(url, data=data, timeout=None)
+    deadline.check('POST %s' % url)
+    timeout = deadline.remaining()
+    if timeout <= 0:
+        # expired since check(); requests rejects a timeout of 0
+        raise DeadlineExceeded('Deadline of %ss exceeded before POST %s.' % (deadline.timeout, url))
+    try:
+        response = (session or requests).post(url, data=data, timeout=timeout, stream=True)
+        read_body(response, deadline, url)
+        return response
+    except (requests.Timeout, requests.ConnectionError):
+        # a read timeout while streaming the body surfaces as a ConnectionError
+        if deadline.expired():
+            raise DeadlineExceeded('Deadline of %ss exceeded during POST %s.' % (deadline.timeout, url))
+        raise
+
+def read_body(response, deadline, url):
+    '''Reads the body of a streamed `response` into its `content`, checking `deadline` after every chunk.'''
+    iter_content = getattr(response, 'iter_content', None)
+    if iter_content is None:
+        # not a requests.Response: the body is already there
+        return
+    chunks = []
+    try:
+        for chunk in iter_content(READ_CHUNK_SIZE):
+            chunks.append(chunk)
+            if deadline.expired():
+                raise DeadlineExceeded('Deadline of %ss exceeded reading the response of POST %s.' % (deadline.timeout, url))
+    except BaseException:
+        response.close()
+        raise
+    response._content = b''.join(chunks)
+    response._content_consumed = True
+
+##############################################################################
+# Merchant configuration, read from the Django settings once                 #
+##############################################################################
+
+DEFAULT_MERCHANT = 'default'
+SETTINGS_NAMES = ('SEVD_APPLICATION_ID', 'SEVD_MERCHANT_ID', 'SEVD_MERCHANT_KEY', 'SEVD_LANGUAGE_ID', 'SEVD_MERCHANTS')
+
+
+class MerchantConfig(collections.namedtuple('MerchantConfig', 'app_id merchant_id merchant_key lang_id')):
+    '''Immutable credentials used to send requests for one merchant.'''
+    __slots__ = ()
+
+    def __new__(cls, app_id, merchant_id, merchant_key, lang_id='EN'):
+        return super(MerchantConfig, cls).__new__(cls, app_id, merchant_id, merchant_key, lang_id or 'EN')
+
+    def __repr__(self):
+        # keep the key out of logs and tracebacks
+        return 'MerchantConfig(app_id=%r, merchant_id=%r, lang_id=%r)' % (self.app_id, self.merchant_id, self.lang_id)
+
+
+def settings_snapshot():
+    '''Returns the SEVD_* Django settings as a dict.
+
+    Missing settings are None. Nothing is read (every value is None) when
+    Django is not installed or its settings are not configured.
+    '''
+    if not getattr(settings, 'configured', True):
+        return dict.fromkeys(SETTINGS_NAMES)
+    return dict((name, getattr(settings, name, None)) for name in SETTINGS_NAMES)
+
+
+class MerchantRegistry(object):
+    '''Holds the MerchantConfig of every merchant a process sends requests for.
+
+    When `load_settings` is True the registry is filled from the Django
+    settings the first time it is used: SEVD_APPLICATION_ID, SEVD_MERCHANT_ID
+    and SEVD_MERCHANT_KEY become the DEFAULT_MERCHANT and SEVD_MERCHANTS may
+    map further names to dicts with MERCHANT_ID, MERCHANT_KEY and optionally
+    APPLICATION_ID and LANGUAGE_ID. Merchants can also be registered at
+    runtime. Lookups never touch the settings again until reload().
+    '''
+
+    def __init__(self, load_settings=True):
+        self._merchants = {}
+        self._by_merchant_id = {}
+        self._from_settings = set()
+        self._loaded = not load_settings
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            # read again on next use if Django is not configured yet
+            configured = getattr(settings, 'configured', True)
+            values = settings_snapshot()
+            configs = {}
+            if values['SEVD_APPLICATION_ID'] is not None or values['SEVD_MERCHANT_ID'] is not None:
+                configs[DEFAULT_MERCHANT] = MerchantConfig(values['SEVD_APPLICATION_ID'], values['SEVD_MERCHANT_ID'], values['SEVD_MERCHANT_KEY'], values['SEVD_LANGUAGE_ID'])
+            for name, merchant in (values['SEVD_MERCHANTS'] or {}).items():
+                configs[name] = MerchantConfig(
+                    merchant.get('APPLICATION_ID', values['SEVD_APPLICATION_ID']),
+                    merchant['MERCHANT_ID'],
+                    merchant['MERCHANT_KEY'],
+                    merchant.get('LANGUAGE_ID', values['SEVD_LANGUAGE_ID']),
+                )
+            for name, config in configs.items():
+                # merchants registered at runtime win over the settings
+                if name not in self._merchants:
+                    self._set(name, config)
+                    self._from_settings.add(name)
+            self._loaded = configured
+
+    def _set(self, name, config):
+        self._merchants[name] = config
+        self._by_merchant_id[config.merchant_id] = config
+
+    def register(self, name, config):
+        '''Adds or replaces the merchant called `name`. Returns `config`.'''
+        if not isinstance(config, MerchantConfig):
+            raise ValueError('%s: config must be a MerchantConfig.' % name)
+        if not self._loaded:
+            self._load()
+        with self._lock:
+            self._set(name, config)
+            self._from_settings.discard(name)
+        return config
+
+    def unregister(self, name):
+        with self._lock:
+            config = self._merchants.pop(name, None)
+            self._from_settings.discard(name)
+            if config is not None and self._by_merchant_id.get(config.merchant_id) is config:
+                del self._by_merchant_id[config.merchant_id]
+
+    def reload(self):
+        '''Drops the merchants read from the settings so they are read again on next use.'''
+        with self._lock:
+            for name in self._from_settings:
+                config = self._merchants.pop(name)
+                if self._by_merchant_id.get(config.merchant_id) is config:
+                    del self._by_merchant_id[config.merchant_id]
+            self._from_settings.clear()
+            self._loaded = False
+
+    def get(self, name=None):
+        '''Returns the MerchantConfig called `name`.
+
+        Without a `name` the DEFAULT_MERCHANT is returned, or None if there is
+        none. A missing named merchant raises KeyError.
+        '''
+        if not self._loaded:
+            self._load()
+        if name is None:
+            return self._merchants.get(DEFAULT_MERCHANT)
+        try:
+            return self._merchants[name]
+        except KeyError:
+            raise KeyError('%s: No such merchant is configured.' % name)
+
+    def find(self, merchant_id):
+        '''Returns the MerchantConfig registered with `merchant_id`, or None.'''
+        if not self._loaded:
+            self._load()
+        return self._by_merchant_id.get(merchant_id)
+
+    def credentials(self, merchant_id=None, merchant_key=None):
+        '''Returns (merchant_id, merchant_key) with whichever is None filled in.
+
+        Without a `merchant_id` both come from the DEFAULT_MERCHANT ((None,
+        None) if there is none). A MerchantKey is only ever taken from the
+        merchant registered with the same MerchantID, so an unknown
+        `merchant_id` raises ValueError.
+        '''
+        if merchant_id is not None and merchant_key is not None:
+            return merchant_id, merchant_key
+        if merchant_id is None:
+            if merchant_key is not None:
+                raise ValueError('A MerchantKey was given without its MerchantID.')
+            config = self.get()
+            if config is None:
+                return None, None
+            return config.merchant_id, config.merchant_key
+        config = self.find(merchant_id)
+        if config is None:
+            raise ValueError('%s: No merchant with this MerchantID is configured (see MerchantRegistry).' % merchant_id)
+        return merchant_id, config.merchant_key
+
+    def resolve(self, app_id=None, merchant_id=None, merchant_key=None, lang_id=None):
+        '''Returns the MerchantConfig a request is sent with, with whatever is None filled in.
+
+        The credentials are filled in as by credentials(). The ApplicationID
+        and LanguageID come from the merchant registered with the MerchantID,
+        or from the DEFAULT_MERCHANT when there is none.
+        '''
+        merchant_id, merchant_key = self.credentials(merchant_id, merchant_key)
+        if app_id is None or lang_id is None:
+            config = (self.find(merchant_id) if merchant_id is not None else None) or self.get()
+            if config is not None:
+                app_id = config.app_id if app_id is None else app_id
+                lang_id = lang_id or config.lang_id
+        return MerchantConfig(app_id, merchant_id, merchant_key, lang_id)
+
+    def names(self):
+        if not self._loaded:
+            self._load()
+        return sorted(self._merchants)
+
+    def __contains__(self, name):
+        if not self._loaded:
+            self._load()
+        return name in self._merchants
+
+
+# The registry used when application or merchant details are not given.
+MERCHANTS = MerchantRegistry()
+
+##############################################################################
+# XML backends: ElementTree or, when it is installed, lxml                   #
+##############################################################################
+
+class ElementTreeBackend(object):
+    '''Builds, parses and serializes XML with xml.etree.ElementTree.'''
+    name = 'etree'
+    Element = staticmethod(ET.Element)
+    SubElement = staticmethod(ET.SubElement)
+
+    def fromstring(self, content):
+        '''Parses bytes, a memoryview or str into an Element.'''
+        return ET.XML(content)
+
+    def tostring(self, elem):
+        '''Serializes an Element to str, writing empty elements as <tag></tag>.'''
+        return ET.tostring(elem, 'unicode', short_empty_elements=False)
+
+    def iterparse(self, source, tags=None):
+        '''Yields every element of the file-like `source` (only those in `tags` if given) as it is closed.'''
+        for event, elem in ET.iterparse(source, ('end',)):
+            if tags is None or elem.tag in tags:
+                yield elem
+
+
+class LxmlBackend(object):
+    '''Builds, parses and serializes XML with lxml.
+
+    Comments and processing instructions are dropped and entities are not
+    resolved while parsing. The output of tostring() matches
+    ElementTreeBackend for the same tree.
+    '''
+    name = 'lxml'
+
+    def __init__(self):
+        self.Element = lxml.etree.Element
+        self.SubElement = lxml.etree.SubElement
+        self.parser_options = dict(remove_comments=True, remove_pis=True, resolve_entities=False, no_network=True)
+        self._local = threading.local()
+
+    @property
+    def parser(self):
+        # parsers are not thread-safe, so every thread gets its own
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = self._local.parser = lxml.etree.XMLParser(**self.parser_options)
+        return parser
+
+    def fromstring(self, content):
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return lxml.etree.fromstring(content, self.parser)
+
+    def tostring(self, elem):
+        # lxml writes <tag/> for empty elements unless they have text; they
+        # are given some on a copy so the caller's tree is left alone
+        if any(sub_elem.text is None and len(sub_elem) == 0 for sub_elem in elem.iter()):
+            elem = copy.deepcopy(elem)
+            for sub_elem in elem.iter():
+                if sub_elem.text is None and len(sub_elem) == 0:
+                    sub_elem.text = ''
+        return lxml.etree.tostring(elem, encoding='unicode')
+
+    def iterparse(self, source, tags=None):
+        for event, elem in lxml.etree.iterparse(source, ('end',), tag=tags, **self.parser_options):
+            yield elem
+
+
+XML_BACKENDS = {'etree': ElementTreeBackend}
+if lxml is not None:
+    XML_BACKENDS['lxml'] = LxmlBackend
+
+def get_xml_backend(name='etree'):
+    '''Returns a new backend called `name`: 'etree' or, when lxml is installed, 'lxml'.'''
+    try:
+        return XML_BACKENDS[name]()
+    except KeyError:
+        raise ValueError('%s: XML backend must be one of %s.' % (name, ', '.join(sorted(XML_BACKENDS))))
+
+def set_xml_backend(name='etree'):
+    '''Switches the backend used to build, parse and serialize XML. Returns the new backend.'''
+    global XML_BACKEND
+    XML_BACKEND = get_xml_backend(name)
+    return XML_BACKEND
+
+# lxml is used when it is installed; it is about as fast to parse eagerly
+# and faster to serialize and to parse lazily (see benchmark.py). Set the SEVD_XML_BACKEND environment variable to 'etree'
+# to opt out, or call set_xml_backend() at runtime.
+DEFAULT_XML_BACKEND = os.environ.get('SEVD_XML_BACKEND') or ('lxml' if lxml is not None else 'etree')
+XML_BACKEND = get_xml_backend(DEFAULT_XML_BACKEND)
+
 def escape(str_data):
     '''Converts to escaped HTML.'''
     return str_data.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;').replace("'", '&#39;')
@@ -26,7 +410,19 @@ def format_uuid(a_uuid):
     '''Formats a uuid into a GUID format that windows prefers.'''
     return ('%s-%s-%s-%s-%s' % (a_uuid[0:8], a_uuid[8:12], a_uuid[12:16], a_uuid[16:20], a_uuid[20:])).strip()
 
-def get_uuid(query_first='vault', app_id=None, merchant_id=None, merchant_key=None):
+def parse_expiration_date(value):
+    '''Converts an ExpirationDate as returned by Sage (MMYY) to the first day of that month.
+
+    Returns None when the value cannot be interpreted.
+    '''
+    if value is None:
+        return None
+    value = value.strip()
+    if len(value) != 4 or not value.isdigit() or not 1 <= int(value[:2]) <= 12:
+        return None
+    return datetime.date(2000 + int(value[2:]), int(value[:2]), 1)
+
+def get_uuid(query_first='vault', app_id=None, merchant_id=None, merchant_key=None, deadline=None, session=None):
     '''Return a UUID.
 
     `query_first` should either be 'vault' or 'payment' depending on how the UUID will be used. NOTE: this may need to change.
@@ -35,24 +431,28 @@ def get_uuid(query_first='vault', app_id=None, merchant_id=None, merchant_key=No
     the last time the UUID was used will be returned. UUIDs are removed from
     Sage Exchange Virtual Desktop after 6 months
     (https://support.sagepayments.com/link/portal/20000/20000/Article/3194/How-long-does-the-TransactionID-stay-in-the-gateway).
+
+    If a `deadline` is given every probe is bound by it and DeadlineExceeded is
+    raised instead of looping past it.
     '''
     if query_first:
-        if app_id is None:
-            app_id = settings.SEVD_APPLICATION_ID
-        if merchant_id is None:
-            merchant_id = settings.SEVD_MERCHANT_ID
-        if merchant_key is None:
-            settings.SEVD_MERCHANT_KEY
+        if app_id is None or merchant_id is None or merchant_key is None:
+            config = MERCHANTS.resolve(app_id, merchant_id, merchant_key)
+            if config.merchant_id is None or config.app_id is None:
+                raise ValueError('No default merchant is configured (see MerchantRegistry).')
+            app_id, merchant_id, merchant_key = config.app_id, config.merchant_id, config.merchant_key
 
         u = format_uuid(uuid.uuid4().hex)
         duplicate = True
         while duplicate:
+            if deadline is not None:
+                deadline.check('UUID probe')
             if query_first == 'vault':
-                result = execute_vault_status_query(app_id, merchant_id, merchant_key, u)
+                result = execute_vault_status_query(app_id, merchant_id, merchant_key, u, deadline=deadline, session=session)
                 if result.vault_query_response.response.response_code == '411411':
                     duplicate = False
             else:
-                result = execute_transaction_status_query(app_id, merchant_id, merchant_key, u)
+                result = execute_transaction_status_query(app_id, merchant_id, merchant_key, u, deadline=deadline, session=session)
                 if result.transaction_query_responses.transaction_status_query_responses.response.response_code == '411411':
                     duplicate = False
             if duplicate:
@@ -113,6 +513,123 @@ def double_set_func(name):
         setattr(obj, name, value)
     return setter
 
+@functools.total_ordering
+class Money(object):
+    '''An amount of money stored as an integer number of cents.
+
+    Amounts with a fraction of a cent (float arithmetic, ledgers, the odd
+    response) are rounded half up to the cent. `str()` gives the canonical
+    form sent to Sage ('-12.30'). Money can be added, subtracted and summed
+    with sum(). Integers are taken to be whole units, not cents.
+    '''
+    __slots__ = ('cents',)
+
+    def __init__(self, cents=0):
+        self.cents = cents
+
+    @classmethod
+    def parse(cls, value, exact=False):
+        '''Converts a str, int, float or Decimal amount to Money.
+
+        With `exact` a value with a non-zero fraction of a cent raises
+        ValueError instead of being rounded.
+        '''
+        if isinstance(value, Money):
+            return value
+        if isinstance(value, bool):
+            raise ValueError('Unable to convert a bool to Money.')
+        if isinstance(value, int):
+            return cls(value * 100)
+        if isinstance(value, str):
+            match = MONEY_REGEX.match(value.strip())
+            if match is not None and (match.group(2) or match.group(3)):
+                sign, units, fraction = match.groups()
+                fraction = fraction or ''
+                if exact and fraction[2:].strip('0'):
+                    raise ValueError('"%s" is not a whole number of cents.' % value)
+                cents = int(units or '0') * 100 + int((fraction[:2] + '00')[:2])
+                if fraction[2:3] >= '5':
+                    # half up, i.e. away from zero like ROUND_HALF_UP
+                    cents += 1
+                return cls(-cents if sign == '-' else cents)
+        # anything else (floats, Decimals, exponents) goes through Decimal
+        try:
+            cents = Decimal(repr(value) if isinstance(value, float) else str(value).strip()) * 100
+        except InvalidOperation:
+            raise ValueError('Unable to convert "%s" to Money.' % value)
+        if not cents.is_finite():
+            raise ValueError('Unable to convert "%s" to Money.' % value)
+        if exact and cents != cents.to_integral_value():
+            raise ValueError('"%s" is not a whole number of cents.' % value)
+        return cls(int(cents.to_integral_value(ROUND_HALF_UP)))
+
+    @classmethod
+    def sum(cls, values):
+        '''Adds up an iterable of amounts of any type Money.parse() accepts.'''
+        return cls(sum(cls.parse(value).cents for value in values))
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __str__(self):
+        cents = self.cents
+        if cents < 0:
+            return '-%d.%02d' % divmod(-cents, 100)
+        return '%d.%02d' % divmod(cents, 100)
+
+    def __repr__(self):
+        return 'Money(%s)' % self
+
+    def __hash__(self):
+        return hash(self.to_decimal())
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return self.cents == other.cents
+        if isinstance(other, (int, float, Decimal)) and not isinstance(other, bool):
+            # exact, like Decimal: Money(10) != 0.1 but Money(150) == 1.5
+            return self.to_decimal() == other
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, Money):
+            return self.cents < other.cents
+        return NotImplemented
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        if other == 0:
+            # lets sum() start from 0
+            return self
+        return NotImplemented
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __reduce__(self):
+        return (Money, (self.cents,))
+
+def money_set_func(name):
+    '''Validates every value is an amount of money and stores it as Money (see Money.parse()).'''
+    def setter(obj, value):
+        if value is not None:
+            try:
+                value = Money.parse(value)
+            except ValueError as ex:
+                raise ValueError('%s: %s' % (name, ex))
+        setattr(obj, name, value)
+    return setter
+
 def boolean_set_func(name):
     '''Validates every value to be either a valid bool or "true" or "false".'''
     def setter(obj, value):
@@ -148,7 +665,7 @@ def multiple_class_set_func(name, cls):
     return setter
 
 def regex_set_func(regex):
-    if not isinstance(regex, re._pattern_type):
+    if not isinstance(regex, PATTERN_TYPE):
         regex = re.compile(regex)
     def set_func(name):
         def setter(obj, value):
@@ -160,7 +677,7 @@ def regex_set_func(regex):
 
 def required_regex_set_func(regex):
     '''This is a special case where the field should be required but an empty string '' is allowed as the value.'''
-    if not isinstance(regex, re._pattern_type):
+    if not isinstance(regex, PATTERN_TYPE):
         regex = re.compile(regex)
     def set_func(name):
         def setter(obj, value):
@@ -172,6 +689,79 @@ def required_regex_set_func(regex):
         return setter
     return set_func
 
+##############################################################################
+# Elements received that the models do not know about                       #
+##############################################################################
+
+# What from_xml() does with child elements it does not know:
+#   'warn'      warn about every one (the default)
+#   'warn_once' warn the first time a tag is seen under a parent
+#   'count'     only count them
+#   'ignore'    do nothing at all
+#   'strict'    raise UnknownElementError
+#   'preserve'  keep them in the object's unknown_elements
+# Every policy but 'ignore' counts them in UNKNOWN_ELEMENTS.
+UNKNOWN_ELEMENT_POLICIES = ('warn', 'warn_once', 'count', 'ignore', 'strict', 'preserve')
+UNKNOWN_ELEMENT_POLICY = 'warn'
+
+
+class UnknownElementError(ValueError):
+    '''Raised by the 'strict' policy when a response contains an element the models do not know.'''
+
+
+class UnknownElementCounts(object):
+    '''Counts the unknown elements received by (parent tag, tag) to monitor changes to Sage's schema.'''
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, parent, tag):
+        '''Counts one `tag` under `parent` and returns how many have been seen.'''
+        with self._lock:
+            self.counts[(parent, tag)] += 1
+            return self.counts[(parent, tag)]
+
+    def metrics(self):
+        '''Returns {'parent/tag': count}.'''
+        with self._lock:
+            return dict(('%s/%s' % key, count) for key, count in self.counts.items())
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+UNKNOWN_ELEMENTS = UnknownElementCounts()
+
+def check_unknown_element_policy(policy):
+    '''Returns `policy`, or UNKNOWN_ELEMENT_POLICY if it is None. Raises ValueError for an unknown policy.'''
+    policy = policy or UNKNOWN_ELEMENT_POLICY
+    if policy not in UNKNOWN_ELEMENT_POLICIES:
+        raise ValueError('%s: The unknown element policy must be one of %s.' % (policy, ', '.join(UNKNOWN_ELEMENT_POLICIES)))
+    return policy
+
+def handle_unknown_elements(obj, parent, elements, policy):
+    '''Applies `policy` to the `elements` of `parent` that were not parsed into `obj`.'''
+    if policy == 'ignore':
+        return
+    for el in elements:
+        seen = UNKNOWN_ELEMENTS.add(parent.tag, el.tag)
+        if policy == 'warn' or (policy == 'warn_once' and seen == 1):
+            warnings.warn('Tag "%s" was not parsed. Child of "%s" tag. Additional children were also unparsed.' % (el.tag, parent.tag))
+        elif policy == 'strict':
+            raise UnknownElementError('Tag "%s" was not parsed. Child of "%s" tag.' % (el.tag, parent.tag))
+    if policy == 'preserve':
+        obj.unknown_elements = list(elements)
+
+
+def element_text(elem, intern=False):
+    '''Returns the text of `elem`, interned if `intern` is set.'''
+    text = elem.text
+    if intern and text is not None:
+        return sys.intern(text)
+    return text
+
 class SEVDChild(object):
     '''Represents a child element of the class.'''
     tag_name = ''
@@ -180,20 +770,26 @@ class SEVDChild(object):
     required = False
     multiple = False
     valid_values = None
+    intern = False
 
-    def __init__(self, tag_name, member_name, sevd_class=None, required=False, multiple=False, valid_values=None):
+    def __init__(self, tag_name, member_name, sevd_class=None, required=False, multiple=False, valid_values=None, intern=False):
         self.tag_name = tag_name
         self.member_name = member_name
         self.sevd_class = sevd_class
         self.required = required
         self.multiple = multiple
         self.valid_values = valid_values
+        # values of low-cardinality fields (codes, indicators, IDs) are
+        # interned when parsed so the many copies in a large result set share
+        # one string
+        self.intern = intern
 
 
 class BaseSEVDObjectMeta(type):
     '''Allows us to create descriptors on the class so we can do extra fancy validation.'''
     def __new__(cls, name, parents, dct):
-        for child in dct['xml_children']:
+        # subclasses that do not declare xml_children (e.g. lazy classes) keep their parent's properties
+        for child in dct.get('xml_children', ()):
             # In order to ensure that we are properly following the XSD we
             # need to validate that every property that is set matches
             # either the expected class or a valid value. To do this we use
@@ -235,97 +831,347 @@ class BaseSEVDObjectMeta(type):
             # always set private member variable value to None at creation.
             dct[private_member_name] = None
 
+        if 'xml_children' in dct:
+            # for pack(): the private members in xml_children order and the positions of those holding objects
+            dct['xml_private_members'] = tuple('_xml_%s' % child.member_name for child in dct['xml_children'])
+            dct['xml_object_positions'] = tuple(i for i, child in enumerate(dct['xml_children']) if child.sevd_class is not None)
         return super(BaseSEVDObjectMeta, cls).__new__(cls, name, parents, dct)
 
 
+def pack(obj):
+    '''Converts an object tree into nested tuples that pickle compactly and quickly.
+
+    Each object becomes (class, values[, xml_element]): its class, its values
+    in xml_children order without the trailing Nones, and its tag name if it
+    differs from the class's, followed by any preserved unknown_elements
+    (as ElementTree elements).
+    Child objects are packed the same way and lists of them become lists.
+    Lazy objects are loaded and packed as their model class. Pickle stores
+    each class reference once, so naming the classes costs little.
+    '''
+    cls = type(obj)
+    if isinstance(obj, LazySEVDObject):
+        cls = cls.__bases__[1]
+        values = [getattr(obj, child.member_name) for child in cls.xml_children]
+    else:
+        values = list(map(obj.__dict__.get, cls.xml_private_members))
+    for i in cls.xml_object_positions:
+        value = values[i]
+        if value is not None:
+            if isinstance(value, (list, tuple)):
+                values[i] = [pack(item) for item in value]
+            else:
+                values[i] = pack(value)
+    while values and values[-1] is None:
+        values.pop()
+    packed = (cls, tuple(values))
+    xml_element = obj.__dict__.get('xml_element')
+    unknown_elements = obj.__dict__.get('unknown_elements')
+    if xml_element == cls.xml_element:
+        xml_element = None
+    if unknown_elements:
+        if lxml is not None:
+            # lxml elements cannot be pickled, so ElementTree copies are kept instead
+            unknown_elements = [ET.fromstring(lxml.etree.tostring(el, with_tail=False)) if isinstance(el, lxml.etree._Element) else el for el in unknown_elements]
+        packed += (xml_element, unknown_elements)
+    elif xml_element is not None:
+        packed += (xml_element,)
+    return packed
+
+def unpack(packed):
+    '''Rebuilds the object tree packed by pack() without going through the setters again.'''
+    cls = packed[0]
+    obj = object.__new__(cls)
+    values = packed[1]
+    if cls.xml_object_positions:
+        values = list(values)
+        for i in cls.xml_object_positions:
+            if i >= len(values):
+                break
+            value = values[i]
+            if value is not None:
+                if isinstance(value, list):
+                    values[i] = [unpack(item) for item in value]
+                else:
+                    values[i] = unpack(value)
+    # members left out of the values fall back to the class's None
+    members = obj.__dict__
+    members.update(zip(cls.xml_private_members, values))
+    if len(packed) > 2:
+        if packed[2] is not None:
+            members['xml_element'] = packed[2]
+        if len(packed) > 3:
+            members['unknown_elements'] = packed[3]
+    return obj
+
+
 class BaseSEVDObject(object, metaclass=BaseSEVDObjectMeta):
 
     # the element to render this object as
     xml_element = ''
     # the sub-elements to render for this class
     xml_children = []
+    # elements received that are not in xml_children (see UNKNOWN_ELEMENT_POLICY)
+    unknown_elements = ()
 
     def __init__(self, **kwargs):
         for child in self.xml_children:
             # set the inital value
             setattr(self, child.member_name, kwargs.get(child.member_name, None))
 
-    def to_xml(self, tag_name=None):
-        '''Converts the instance to an XML element using ElementTree.'''
-        elem = ET.Element(tag_name or self.xml_element)
+    def __reduce__(self):
+        # the whole tree as nested tuples instead of a __dict__ per object
+        return (unpack, (pack(self),))
+
+    def to_xml(self, tag_name=None, backend=None):
+        '''Converts the instance to an XML element using `backend` (XML_BACKEND by default).'''
+        backend = backend or XML_BACKEND
+        elem = backend.Element(tag_name or self.xml_element)
         for child in self.xml_children:
 
             if isinstance(getattr(self, child.member_name), BaseSEVDObject):
                 if getattr(self, child.member_name) is not None:
-                    sub_elem = getattr(self, child.member_name).to_xml(child.tag_name)
+                    sub_elem = getattr(self, child.member_name).to_xml(child.tag_name, backend)
                     elem.append(sub_elem)
             elif isinstance(getattr(self, child.member_name), (list, tuple)):
                 if child.sevd_class is not None:
                     for item in getattr(self, child.member_name):
                         # if this raises and exception then there was an error with an item in the list.
-                        sub_elem = item.to_xml(child.tag_name)
+                        sub_elem = item.to_xml(child.tag_name, backend)
                         elem.append(sub_elem)
                 else:
                     #TODO: add logic here. Expect that it is a list of values
                     raise NotImplementedError()
             else:
                 if getattr(self, child.member_name) is not None:
-                    sub_elem = ET.SubElement(elem, child.tag_name)
-                    if isinstance(getattr(self, child.member_name), bool):
-                        sub_elem.text = 'true' if getattr(self, child.member_name) else 'false'
+                    sub_elem = backend.SubElement(elem, child.tag_name)
+                    value = getattr(self, child.member_name)
+                    if isinstance(value, bool):
+                        sub_elem.text = 'true' if value else 'false'
+                    elif isinstance(value, str):
+                        sub_elem.text = value
                     else:
-                        sub_elem.text = getattr(self, child.member_name)
+                        sub_elem.text = str(value)
                 elif child.required:
                     raise Exception('Missing value: %s' % child.tag_name)
 
         return elem
 
-    def from_xml(self, elem):
-        '''Converts from an XML Element to an instance of this object.'''
+    def select(self, path):
+        '''Returns a list of every value at `path`, a "/" separated list of tag names.
+
+        "*" matches every child. Members holding a list and members holding a
+        single object are treated alike and missing members are left out,
+        e.g. response.select('PaymentResponses/*/TransactionResponse/VANReference').
+        '''
+        return compile_query(path).run(self)
+
+    def select_one(self, path, default=None):
+        '''Returns the first value at `path`, or `default` if there is none.'''
+        values = compile_query(path).run(self)
+        return values[0] if values else default
+
+    def from_xml(self, elem, unknown=None):
+        '''Converts from an XML Element to an instance of this object.
+
+        `unknown` is the policy for elements the model does not know
+        (UNKNOWN_ELEMENT_POLICY by default).
+        '''
+        unknown = check_unknown_element_policy(unknown)
         if elem.tag != self.xml_element:
             warnings.warn("Element received <%s> does not match expected tag name %s." % (elem.tag, self.xml_element))
 
+        # group the children by tag in one pass instead of searching the element for every member
+        children = list(elem)
+        by_tag = {}
+        for el in children:
+            by_tag.setdefault(el.tag, []).append(el)
+
         # keep track of every element we successfully parse so we can throw warnings about those we have not.
-        parsed_elements = []
+        parsed_elements = set()
 
         for child in self.xml_children:
+            els = by_tag.get(child.tag_name)
+            if els is None:
+                continue
             if child.sevd_class is not None:
-                els = elem.findall(child.tag_name)
                 if len(els) == 1 and (len(child.sevd_class.xml_children) == 0 or len(els[0]) > 0):
                     obj = child.sevd_class()
                     obj.xml_element = child.tag_name
                     setattr(self, child.member_name, obj)
-                    obj.from_xml(els[0])
-                    parsed_elements.append(els[0])
+                    obj.from_xml(els[0], unknown)
+                    parsed_elements.add(id(els[0]))
                 elif len(els) > 1:
                     objs = []
                     for el in els:
                         if len(child.sevd_class.xml_children) == 0 or len(el) > 0:
                             obj = child.sevd_class()
                             obj.xml_element = child.tag_name
-                            obj.from_xml(el)
+                            obj.from_xml(el, unknown)
                             objs.append(obj)
-                            parsed_elements.append(el)
+                            parsed_elements.add(id(el))
                     setattr(self, child.member_name, objs)
-                elif len(els) == 1:
+                else:
                     # if we get here we have an empty element <tag /> meaning that we ignore it but we want to track that we have seen it.
-                    parsed_elements.append(els[0])
+                    parsed_elements.add(id(els[0]))
             else:
-                els = elem.findall(child.tag_name)
                 if len(els) == 1:
-                    setattr(self, child.member_name, els[0].text)
-                    parsed_elements.append(els[0])
-                elif len(els) > 1:
+                    setattr(self, child.member_name, element_text(els[0], child.intern))
+                    parsed_elements.add(id(els[0]))
+                else:
                     vals = []
                     for el in els:
-                        vals.append(el.text)
-                        parsed_elements.append(el)
-                    setattr(self, child.member_name, objs)
+                        vals.append(element_text(el, child.intern))
+                        parsed_elements.add(id(el))
+                    setattr(self, child.member_name, vals)
 
         # check for unparsed elements (generally means we are missing features)
-        for el in elem:
-            if el not in parsed_elements:
-                warnings.warn('Tag "%s" was not parsed. Child of "%s" tag. Additional children were also unparsed.' % (el.tag, elem.tag))
+        if len(parsed_elements) < len(children):
+            handle_unknown_elements(self, elem, [el for el in children if id(el) not in parsed_elements], unknown)
+
+
+class Query(object):
+    '''A path of tag names compiled by compile_query().'''
+
+    def __init__(self, path):
+        self.path = path
+        # None matches every child
+        self.steps = tuple(None if tag == '*' else tag for tag in path.strip('/').split('/'))
+        if '' in self.steps:
+            raise ValueError('%s: The path has an empty step.' % path)
+
+    def run(self, obj):
+        current = [obj]
+        for tag in self.steps:
+            found = []
+            for parent in current:
+                if not isinstance(parent, BaseSEVDObject):
+                    continue
+                if tag is None:
+                    children = parent.xml_children
+                else:
+                    child = children_by_tag(type(parent)).get(tag)
+                    if child is None:
+                        continue
+                    children = (child,)
+                for child in children:
+                    value = getattr(parent, child.member_name)
+                    if isinstance(value, (list, tuple)):
+                        found.extend(value)
+                    elif value is not None:
+                        found.append(value)
+            current = found
+        return current
+
+@functools.lru_cache(256)
+def compile_query(path):
+    '''Returns the Query for `path`, compiling it on first use.'''
+    return Query(path)
+
+@functools.lru_cache(None)
+def children_by_tag(cls):
+    return dict((child.tag_name, child) for child in cls.xml_children)
+
+
+class LazySEVDObject(object):
+    '''Mixin for objects backed by a parsed element (see lazy_from_xml()).
+
+    Each member is converted from its elements the first time it is read and
+    then kept like any other value. Setting a member replaces the element's
+    value.
+    '''
+    _element = None
+    _children_by_tag = None
+    _unknown = None
+
+    def _lazy_children(self):
+        by_tag = self._children_by_tag
+        if by_tag is None:
+            by_tag = {}
+            for el in self._element:
+                by_tag.setdefault(el.tag, []).append(el)
+            if not self._lazy_tags.issuperset(by_tag):
+                handle_unknown_elements(self, self._element, [el for el in self._element if el.tag not in self._lazy_tags], self._unknown)
+            self._children_by_tag = by_tag
+        return by_tag
+
+    def _lazy_load(self, child):
+        value = None
+        els = self._lazy_children().get(child.tag_name)
+        if els is not None:
+            if child.sevd_class is not None:
+                cls = child.sevd_class
+                # empty elements <tag /> are ignored like in from_xml()
+                objs = [lazy_from_xml(cls, el, child.tag_name, self._unknown) for el in els if len(cls.xml_children) == 0 or len(el) > 0]
+                if len(els) > 1:
+                    value = objs
+                elif objs:
+                    value = objs[0]
+            elif len(els) == 1:
+                value = element_text(els[0], child.intern)
+            else:
+                value = [element_text(el, child.intern) for el in els]
+        # the model's setter validates the value
+        setattr(self, child.member_name, value)
+        return self.__dict__['_xml_%s' % child.member_name]
+
+
+def lazy_get_func(child):
+    '''Returns a getter that loads the member from the element on first read.'''
+    private_member_name = '_xml_%s' % child.member_name
+    def getter(obj):
+        try:
+            return obj.__dict__[private_member_name]
+        except KeyError:
+            return obj._lazy_load(child)
+    return getter
+
+@functools.lru_cache(None)
+def lazy_class(cls):
+    '''Returns the element-backed subclass of a BaseSEVDObject class.'''
+    dct = {
+        '__doc__': 'Element-backed %s.' % cls.__name__,
+        '_lazy_tags': frozenset(child.tag_name for child in cls.xml_children),
+    }
+    for child in cls.xml_children:
+        setter = getattr(cls, child.member_name).fset
+        dct[child.member_name] = property(lazy_get_func(child), setter)
+    return type(cls)('Lazy%s' % cls.__name__, (LazySEVDObject, cls), dct)
+
+def check_known_tags(cls, elem):
+    '''Raises UnknownElementError if the tree under `elem` has an element the models of `cls` do not know.'''
+    by_tag = children_by_tag(cls)
+    for el in elem:
+        child = by_tag.get(el.tag)
+        if child is None:
+            raise UnknownElementError('Tag "%s" was not parsed. Child of "%s" tag.' % (el.tag, elem.tag))
+        if child.sevd_class is not None:
+            check_known_tags(child.sevd_class, el)
+
+def lazy_from_xml(cls, elem, tag_name=None, unknown=None):
+    '''Returns an instance of `cls` that converts `elem` as its members are read.
+
+    The result is an instance of `cls` and behaves like one filled by
+    from_xml(), but only the members that are read are converted and
+    validated: a bad value raises ValueError when its member is first read,
+    not here. The `unknown` element policy is applied to the children of an
+    element when its first member is read, except that 'preserve' applies
+    straight away and 'strict' checks every tag of the tree straight away.
+    '''
+    if tag_name is None:
+        unknown = check_unknown_element_policy(unknown)
+        if elem.tag != cls.xml_element:
+            warnings.warn("Element received <%s> does not match expected tag name %s." % (elem.tag, cls.xml_element))
+        if unknown == 'strict':
+            check_known_tags(cls, elem)
+    obj = object.__new__(lazy_class(cls))
+    if tag_name is not None:
+        obj.xml_element = tag_name
+    obj._element = elem
+    obj._unknown = unknown
+    if unknown == 'preserve':
+        obj._lazy_children()
+    return obj
 
 
 class ApplicationType(BaseSEVDObject):
@@ -346,8 +1192,12 @@ class ApplicationType(BaseSEVDObject):
 
     def __init__(self, **kwargs):
         super(ApplicationType, self).__init__(**kwargs)
-        if self.app_id is None and hasattr(settings, 'SEVD_APPLICATION_ID'):
-            self.app_id = settings.SEVD_APPLICATION_ID
+        # only the default merchant is known here; requests for another
+        # merchant get theirs from build_application_and_merchant()
+        if self.app_id is None:
+            config = MERCHANTS.get()
+            if config is not None:
+                self.app_id = config.app_id
         if self.lang_id is None:
             self.lang_id = 'EN'
 
@@ -364,16 +1214,14 @@ class MerchantType(BaseSEVDObject):
     '''
     xml_element = 'Merchant'
     xml_children = [
-        SEVDChild('MerchantID', 'merchant_id', required=True),
+        SEVDChild('MerchantID', 'merchant_id', required=True, intern=True),
         SEVDChild('MerchantKey', 'merchant_key', required=True),
     ]
 
     def __init__(self, **kwargs):
         super(MerchantType, self).__init__(**kwargs)
-        if self.merchant_id is None and hasattr(settings, 'SEVD_MERCHANT_ID'):
-            self.merchant_id = settings.SEVD_MERCHANT_ID
-        if self.merchant_key is None and hasattr(settings, 'SEVD_MERCHANT_KEY'):
-            self.merchant_key = settings.SEVD_MERCHANT_KEY
+        if self.merchant_id is None or self.merchant_key is None:
+            self.merchant_id, self.merchant_key = MERCHANTS.credentials(self.merchant_id, self.merchant_key)
 
 
 class AddressType(BaseSEVDObject):
@@ -490,7 +1338,7 @@ class Level2Type(BaseSEVDObject):
     xml_element = 'Level2'
     xml_children = [
         SEVDChild('CustomerNumber', 'customer_number', required=True),
-        SEVDChild('TaxAmount', 'tax_amount', required=True, valid_values=double_set_func),
+        SEVDChild('TaxAmount', 'tax_amount', required=True, valid_values=money_set_func),
     ]
 
 
@@ -524,15 +1372,15 @@ class Level3LineItemType(BaseSEVDObject):
         SEVDChild('ProductCode', 'product_code', required=True),
         SEVDChild('Quantity', 'quantity', required=True, valid_values=int_set_func),
         SEVDChild('UnitOfMeasure', 'unit_of_measure', required=True),
-        SEVDChild('UnitCost', 'unit_cost', required=True, valid_values=double_set_func),
-        SEVDChild('TaxAmount', 'tax_amount', required=True, valid_values=double_set_func),
+        SEVDChild('UnitCost', 'unit_cost', required=True, valid_values=money_set_func),
+        SEVDChild('TaxAmount', 'tax_amount', required=True, valid_values=money_set_func),
         SEVDChild('TaxRate', 'tax_rate', required=True, valid_values=double_set_func),
-        SEVDChild('DiscountAmount', 'discount_amount', required=True, valid_values=double_set_func),
+        SEVDChild('DiscountAmount', 'discount_amount', required=True, valid_values=money_set_func),
         SEVDChild('AlternateTaxIdentifier', 'alternate_tax_identifier', required=True),
         SEVDChild('TaxTypeApplied', 'tax_type_applied', required=True),
         SEVDChild('DiscountIndicator', 'discount_indicator', required=True),
         SEVDChild('NetGrossIndicator', 'net_gross_indicator', required=True),
-        SEVDChild('ExtendedItemAmount', 'extended_item_amount', required=True, valid_values=double_set_func),
+        SEVDChild('ExtendedItemAmount', 'extended_item_amount', required=True, valid_values=money_set_func),
         SEVDChild('DebitCreditIndicator', 'debit_credit_indicator', required=True),
     ]
 
@@ -574,15 +1422,15 @@ class Level3Type(BaseSEVDObject):
     xml_element = 'Level3'
     xml_children = [
         SEVDChild('Level2', 'level2', Level2Type, required=True),
-        SEVDChild('ShippingAmount', 'shipping_amount', required=True, valid_values=double_set_func),
+        SEVDChild('ShippingAmount', 'shipping_amount', required=True, valid_values=money_set_func),
         SEVDChild('DestinationZipCode', 'destination_zip_code', required=True),
         SEVDChild('DestinationCountryCode', 'destination_country', required=True),
         SEVDChild('VATNumber', 'vat_number', required=True),
-        SEVDChild('DiscountAmount', 'discount_amount', required=True, valid_values=double_set_func),
-        SEVDChild('DutyAmount', 'duty_amount', required=True, valid_values=double_set_func),
-        SEVDChild('NationalTaxAmount', 'national_tax_amount', required=True, valid_values=double_set_func),
+        SEVDChild('DiscountAmount', 'discount_amount', required=True, valid_values=money_set_func),
+        SEVDChild('DutyAmount', 'duty_amount', required=True, valid_values=money_set_func),
+        SEVDChild('NationalTaxAmount', 'national_tax_amount', required=True, valid_values=money_set_func),
         SEVDChild('VATInvoiceNumber', 'vat_invoice_number', required=True),
-        SEVDChild('VATTaxAmount', 'vat_tax_amount', required=True, valid_values=double_set_func),
+        SEVDChild('VATTaxAmount', 'vat_tax_amount', required=True, valid_values=money_set_func),
         SEVDChild('VATTaxRate', 'vat_tax_rate', required=True, valid_values=double_set_func),
         SEVDChild('LineItems', 'line_items', Level3LineItems, required=False),
     ]
@@ -633,7 +1481,7 @@ class TransactionBaseType(BaseSEVDObject):
         SEVDChild('TransactionType', 'trans_type', required=True, valid_values=transaction_type_set_func),
         SEVDChild('Reference1', 'ref1'),
         SEVDChild('Reference2', 'ref2'),
-        SEVDChild('Amount', 'amount', valid_values=double_set_func),
+        SEVDChild('Amount', 'amount', valid_values=money_set_func),
         SEVDChild('AuthCode', 'auth_code'),
         SEVDChild('VANReference', 'van_reference'),
     ]
@@ -726,7 +1574,7 @@ class RecurringType(BaseSEVDObject):
         SEVDChild('Interval', 'interval', valid_values=int_set_func),
         SEVDChild('DayOfMonth', 'day_of_month', valid_values=int_set_func),
         SEVDChild('StartDate', 'start_date'),
-        SEVDChild('Amount', 'amount', valid_values=double_set_func),
+        SEVDChild('Amount', 'amount', valid_values=money_set_func),
         SEVDChild('TimesToProcess', 'times_to_process', valid_values=int_set_func),
         SEVDChild('NonBusinessDay', 'non_business_day', valid_values=nonbusiness_day_set_func),
     ]
@@ -1236,8 +2084,8 @@ class PaymentType(BaseSEVDObject):
         SEVDChild('ShippingRecipient', 'shipping_recipient', PersonType),
         SEVDChild('Level2', 'level2', Level2Type),
         SEVDChild('Level3', 'level3', Level3Type),
-        SEVDChild('VaultStorage', 'vault_storage', VaultStorageType),
         SEVDChild('Recurring', 'recurring', RecurringType),
+        SEVDChild('VaultStorage', 'vault_storage', VaultStorageType),
         SEVDChild('Postback', 'postback', PostbackType),
     ]
 
@@ -1287,9 +2135,9 @@ class BatchType(BaseSEVDObject):
     xml_element = 'BatchType'
     xml_children = [
         SEVDChild('Merchant', 'merchant', MerchantType, required=True),
-        SEVDChild('Net', 'net', valid_values=double_set_func),
+        SEVDChild('Net', 'net', valid_values=money_set_func),
         SEVDChild('Count', 'count', valid_values=int_set_func),
-        SEVDChild('BatchPayment', 'batch_payment', required=True, valid_values=batch_payment_set_func),
+        SEVDChild('BatchPayment', 'batch_payment', required=True, valid_values=batch_payment_set_func, intern=True),
     ]
 
 # Appears to be wrongly implemented.
@@ -1355,8 +2203,8 @@ class ResponseType(BaseSEVDObject):
     '''
     xml_element = 'Response'
     xml_children = [
-        SEVDChild('ResponseIndicator', 'response_indicator'),
-        SEVDChild('ResponseCode', 'response_code'),
+        SEVDChild('ResponseIndicator', 'response_indicator', intern=True),
+        SEVDChild('ResponseCode', 'response_code', intern=True),
         SEVDChild('ResponseMessage', 'response_message'),
     ]
 
@@ -1394,10 +2242,10 @@ class VaultResponseType(BaseSEVDObject):
     xml_children = [
         SEVDChild('Response', 'response', ResponseType),
         SEVDChild('GUID', 'guid'),
-        SEVDChild('ExpirationDate', 'expiration_date'),
+        SEVDChild('ExpirationDate', 'expiration_date', intern=True),
         SEVDChild('Last4', 'last4'),
         SEVDChild('PaymentDescription', 'payment_description'),
-        SEVDChild('PaymentTypeID', 'payment_type_id'),
+        SEVDChild('PaymentTypeID', 'payment_type_id', intern=True),
     ]
 
 
@@ -1442,20 +2290,20 @@ class TransactionResponseType(BaseSEVDObject):
     xml_element = 'TransactionResponse'
     xml_children = [
         SEVDChild('AuthCode', 'auth_code'),
-        SEVDChild('AVSResult', 'avs_result'),
-        SEVDChild('CVVResult', 'cvv_result'),
+        SEVDChild('AVSResult', 'avs_result', intern=True),
+        SEVDChild('CVVResult', 'cvv_result', intern=True),
         SEVDChild('VANReference', 'van_reference'),
         SEVDChild('TransactionID', 'transaction_id'),
         SEVDChild('Last4', 'last4'),
         SEVDChild('PaymentDescription', 'payment_description'),
-        SEVDChild('Amount', 'amount', required=True, valid_values=double_set_func),
-        SEVDChild('PaymentTypeID', 'payment_type_id'),
+        SEVDChild('Amount', 'amount', required=True, valid_values=money_set_func),
+        SEVDChild('PaymentTypeID', 'payment_type_id', intern=True),
         SEVDChild('Reference1', 'reference1'),
         SEVDChild('TransactionDate', 'transaction_date'),
         SEVDChild('AuxiliaryData', 'auxiliary_data'),
-        SEVDChild('EntryMode', 'entry_mode'),
-        SEVDChild('TaxAmount', 'tax_amount', required=True, valid_values=double_set_func),
-        SEVDChild('ShippingAmount', 'shipping_amount', required=True, valid_values=double_set_func),
+        SEVDChild('EntryMode', 'entry_mode', intern=True),
+        SEVDChild('TaxAmount', 'tax_amount', required=True, valid_values=money_set_func),
+        SEVDChild('ShippingAmount', 'shipping_amount', required=True, valid_values=money_set_func),
     ]
 
 
@@ -1531,9 +2379,9 @@ class BatchResponseType(BaseSEVDObject):
         SEVDChild('Response', 'response', ResponseType),
         SEVDChild('BatchNumber', 'batch_number'),
         SEVDChild('BatchReference', 'batch_reference'),
-        SEVDChild('Net', 'net', required=True, valid_values=double_set_func),
+        SEVDChild('Net', 'net', required=True, valid_values=money_set_func),
         SEVDChild('Count', 'count', required=True, valid_values=int_set_func),
-        SEVDChild('BatchPayment', 'batch_payment', required=True, valid_values=batch_payment_set_func),
+        SEVDChild('BatchPayment', 'batch_payment', required=True, valid_values=batch_payment_set_func, intern=True),
     ]
 
 
@@ -1551,8 +2399,8 @@ class TransactionSettlementStatusType(BaseSEVDObject):
     '''
     xml_element = 'TransactionSettlementStatus'
     xml_children = [
-        SEVDChild('TransactionType', 'transaction_type'),
-        SEVDChild('SettlementType', 'settlement_type'),
+        SEVDChild('TransactionType', 'transaction_type', intern=True),
+        SEVDChild('SettlementType', 'settlement_type', intern=True),
         SEVDChild('SettlementDate', 'settlement_date'),
         SEVDChild('BatchReference', 'batch_reference'),
     ]
@@ -1733,6 +2581,35 @@ class Response(BaseSEVDObject):
         SEVDChild('AccountQueryResponse', 'account_query_response', AccountQueryResponseType),
     ]
 
+    def by_transaction_id(self, transaction_id, default=None):
+        '''Returns the PaymentResponseType or TransactionStatusQueryResponseType for a TransactionID.
+
+        The results are indexed by TransactionID the first time this is
+        called, so later lookups do not scan the response. Setting
+        payment_responses or transaction_query_responses drops the index;
+        changing the results in place (e.g. their TransactionID) does not.
+        '''
+        index = self.__dict__.get('_transaction_index')
+        if index is None:
+            index = {}
+            for path in ('PaymentResponses/*', 'TransactionStatusQueryResponses/*'):
+                for result in self.select(path):
+                    key = result.select_one('TransactionResponse/TransactionID')
+                    if key is not None:
+                        index.setdefault(key, result)
+            self._transaction_index = index
+        return index.get(transaction_id, default)
+
+def index_clear_set_func(prop):
+    '''Wraps the setter of `prop` so setting it drops the index of by_transaction_id().'''
+    def setter(obj, value):
+        obj.__dict__.pop('_transaction_index', None)
+        prop.fset(obj, value)
+    return property(prop.fget, setter)
+
+Response.payment_responses = index_clear_set_func(Response.payment_responses)
+Response.transaction_query_responses = index_clear_set_func(Response.transaction_query_responses)
+
 '''
 <xs:complexType name="ArrayOfString">
     <xs:sequence>
@@ -1744,17 +2621,247 @@ class Response(BaseSEVDObject):
 </xs:schema>
 '''
 
+##############################################################################
+# Validation of object trees against schema.xsd before they are sent         #
+##############################################################################
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.xsd')
+XS = '{http://www.w3.org/2001/XMLSchema}'
+# checked before every request is serialized by to_xml_string()
+VALIDATE_REQUESTS = True
+
+INT_REGEX = re.compile(r'^[+-]?\d+$')
+DOUBLE_REGEX = re.compile(r'^([+-]?(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?|[+-]?INF|NaN)$')
+
+def check_int(text):
+    if not INT_REGEX.match(text) or not -2 ** 31 <= int(text) < 2 ** 31:
+        return '"%s" is not an xs:int.' % text
+
+def check_double(text):
+    if not DOUBLE_REGEX.match(text):
+        return '"%s" is not an xs:double.' % text
+
+def check_boolean(text):
+    if text not in ('true', 'false', '1', '0'):
+        return '"%s" is not an xs:boolean.' % text
+
+BUILTIN_CHECKS = {
+    'xs:string': None,
+    'xs:int': check_int,
+    'xs:double': check_double,
+    'xs:boolean': check_boolean,
+}
+
+Violation = collections.namedtuple('Violation', 'path message')
+
+
+class SchemaViolation(ValueError):
+    '''Raised when an object tree does not match the schema. `violations` lists every problem found.'''
+
+    def __init__(self, violations):
+        self.violations = violations
+        super(SchemaViolation, self).__init__('\n'.join('%s: %s' % violation for violation in violations))
+
+
+class SchemaValidator(object):
+    '''Checks BaseSEVDObject trees against the types of an XSD.
+
+    The XSD is read once into tables of the elements of every complex type
+    (position, minOccurs, maxOccurs, type) and a check function for every
+    simple type. The first time a class is validated as a type, its
+    xml_children are matched with those tables; validating an object is then
+    a single walk over its members.
+    '''
+
+    def __init__(self, path=SCHEMA_PATH):
+        root = ET.parse(path).getroot()
+        self.elements = {}
+        for elem in root.findall(XS + 'element'):
+            self.elements[elem.get('name')] = elem.get('type')
+
+        self.checks = dict(BUILTIN_CHECKS)
+        for simple_type in root.findall(XS + 'simpleType'):
+            restriction = simple_type.find(XS + 'restriction')
+            self.checks[simple_type.get('name')] = self._compile_restriction(restriction)
+
+        # name: (ordered, {tag: (position, min_occurs, max_occurs, type)})
+        self.types = {}
+        for complex_type in root.findall(XS + 'complexType'):
+            group = complex_type.find(XS + 'sequence')
+            ordered = group is not None
+            if group is None:
+                group = complex_type.find(XS + 'all')
+            children = {}
+            for position, elem in enumerate(group.findall(XS + 'element') if group is not None else []):
+                max_occurs = elem.get('maxOccurs', '1')
+                children[elem.get('name')] = (position, int(elem.get('minOccurs', '1')), None if max_occurs == 'unbounded' else int(max_occurs), elem.get('type'))
+            self.types[complex_type.get('name')] = (ordered, children)
+
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def _compile_restriction(self, restriction):
+        base = self.checks.get(restriction.get('base'))
+        values = frozenset(elem.get('value') for elem in restriction.findall(XS + 'enumeration'))
+        # XSD patterns always match the whole value
+        patterns = [re.compile('^(%s)$' % elem.get('value')) for elem in restriction.findall(XS + 'pattern')]
+
+        def check(text):
+            if values and text not in values:
+                return '"%s" is not one of %s.' % (text, ', '.join(sorted(values)))
+            for pattern in patterns:
+                if not pattern.match(text):
+                    return '"%s" does not match the pattern %s.' % (text, pattern.pattern[2:-2])
+            if base is not None:
+                return base(text)
+        return check
+
+    def type_name(self, obj):
+        '''The schema type of `obj`: the type of its root element, or the complex type named like its class.'''
+        name = self.elements.get(obj.xml_element)
+        if name is None and type(obj).__name__ in self.types:
+            name = type(obj).__name__
+        if name is None:
+            raise ValueError('%s does not match a type in the schema.' % type(obj).__name__)
+        return name
+
+    def _plan(self, cls, type_name):
+        plan = self._plans.get((cls, type_name))
+        if plan is None:
+            ordered, children = self.types[type_name]
+            fields = []
+            for child in cls.xml_children:
+                position, min_occurs, max_occurs, child_type = children.get(child.tag_name, (None, 0, 1, None))
+                fields.append((
+                    child.tag_name,
+                    '_xml_%s' % child.member_name,
+                    position,
+                    min_occurs > 0 or child.required,
+                    max_occurs,
+                    child_type if child_type in self.types else None,
+                    self.checks.get(child_type),
+                ))
+            plan = (ordered, type_name, fields)
+            with self._lock:
+                self._plans[(cls, type_name)] = plan
+        return plan
+
+    def validate(self, obj, type_name=None, path=None):
+        '''Returns a list of Violations for the tree under `obj`; it is empty when `obj` is valid.'''
+        violations = []
+        path = path or obj.xml_element
+        self._validate(obj, type_name or self.type_name(obj), path, violations)
+        return violations
+
+    def check(self, obj, type_name=None):
+        '''Raises SchemaViolation if the tree under `obj` does not match the schema.'''
+        violations = self.validate(obj, type_name)
+        if violations:
+            raise SchemaViolation(violations)
+
+    def _validate(self, obj, type_name, path, violations):
+        ordered, type_name, fields = self._plan(type(obj), type_name)
+        last_position = -1
+        last_tag = None
+        for tag_name, private_member_name, position, required, max_occurs, child_type, check in fields:
+            value = getattr(obj, private_member_name)
+            child_path = '%s/%s' % (path, tag_name)
+            if value is None or (isinstance(value, (list, tuple)) and not value):
+                if required:
+                    violations.append(Violation(child_path, 'Missing required element.'))
+                continue
+            if position is None:
+                violations.append(Violation(child_path, 'Element is not allowed in %s.' % type_name))
+                continue
+            if ordered:
+                if position < last_position:
+                    violations.append(Violation(child_path, 'Element must come before %s.' % last_tag))
+                else:
+                    last_position = position
+                    last_tag = tag_name
+
+            if isinstance(value, (list, tuple)):
+                if max_occurs is not None and len(value) > max_occurs:
+                    violations.append(Violation(child_path, 'Element may appear at most %d times.' % max_occurs))
+                for i, item in enumerate(value):
+                    self._validate_value(item, child_type, check, '%s[%d]' % (child_path, i), violations)
+            else:
+                self._validate_value(value, child_type, check, child_path, violations)
+
+    def _validate_value(self, value, child_type, check, path, violations):
+        if isinstance(value, BaseSEVDObject):
+            if child_type is None:
+                violations.append(Violation(path, 'Element must be a simple value.'))
+            else:
+                self._validate(value, child_type, path, violations)
+        elif child_type is not None:
+            violations.append(Violation(path, 'Element must be a %s.' % child_type))
+        elif check is not None and not isinstance(value, Slot):
+            if isinstance(value, bool):
+                text = 'true' if value else 'false'
+            elif isinstance(value, str):
+                text = value
+            else:
+                text = str(value)
+            message = check(text)
+            if message:
+                violations.append(Violation(path, message))
+
+
+@functools.lru_cache(None)
+def get_schema_validator(path=SCHEMA_PATH):
+    '''Returns the SchemaValidator compiled from `path`, compiling it on first use.'''
+    return SchemaValidator(path)
+
+def validate_request(sage_request):
+    '''Raises SchemaViolation listing every problem if `sage_request` does not match schema.xsd.'''
+    get_schema_validator().check(sage_request)
+
+def find_xml(content):
+    '''Returns the (start, end) offsets of the XML in `content` (str or bytes).
+
+    The XML runs from the first "<" to the last ">", skipping any byte order
+    mark, whitespace or other garbage around it. Returns None if there is no
+    XML.
+    '''
+    if isinstance(content, str):
+        start, end = content.find('<'), content.rfind('>') + 1
+    else:
+        start, end = content.find(b'<'), content.rfind(b'>') + 1
+    if start == -1 or end <= start:
+        return None
+    return start, end
+
+def xml_body(content):
+    '''Returns a memoryview of the XML in the raw bytes `content` without copying it.
+
+    Raises ValueError if `content` does not contain XML.
+    '''
+    bounds = find_xml(content)
+    if bounds is None:
+        raise ValueError('The response does not contain XML.')
+    return memoryview(content)[bounds[0]:bounds[1]]
+
 def trim_xml(xml_str):
-    if '<' in xml_str and '>' in xml_str:
-        while not xml_str.startswith('<'):
-            xml_str = xml_str[1:]
-        while not xml_str.endswith('>'):
-            xml_str = xml_str[:-1]
-        return xml_str
+    '''Strips anything before the first "<" and after the last ">". Returns None if there is no XML.'''
+    bounds = find_xml(xml_str)
+    if bounds is not None:
+        return xml_str[bounds[0]:bounds[1]]
+
+def serialize_request(sage_request, backend=None):
+    '''Renders a Request as the XML document sent to Sage Exchange.'''
+    backend = backend or XML_BACKEND
+    return '<?xml version="1.0" encoding="utf-8"?>' + backend.tostring(sage_request.to_xml(backend=backend)).replace('<Request_v1>', '<Request_v1 xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">')
 
 def to_xml_string(sage_request):
     global DEBUG
-    result = '<?xml version="1.0" encoding="utf-8"?>' + ET.tostring(sage_request.to_xml(), 'unicode', short_empty_elements=False).replace('<Request_v1>', '<Request_v1 xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema">')
+    if isinstance(sage_request, RenderedRequest):
+        # the skeleton was checked against the schema when it was compiled
+        result = sage_request.xml
+    else:
+        if VALIDATE_REQUESTS and isinstance(sage_request, Request):
+            validate_request(sage_request)
+        result = serialize_request(sage_request)
     if DEBUG:
         print(result)
     return result
@@ -1763,29 +2870,24 @@ def load_style_ui(ui_xml):
     '''Loads UIStyleType element from a string of XML.'''
     style = UIStyleType()
     style.xml_element = 'UIStyle'
-    style.from_xml(ET.XML(ui_xml))
+    style.from_xml(XML_BACKEND.fromstring(ui_xml))
     return style
 
-def encrypt_request(sage_request):
+def encrypt_request(sage_request, deadline=None):
     '''Encrypts a request by calling the Sage Exchange encrypt API.'''
-    response = requests.post(SAGE_SEVD_ENCRYPT_URL, data={'request': to_xml_string(sage_request)})
-    content = response.content.decode('utf-8')
-    while not content.startswith('<'):
-        content = content[1:]
-    return content
+    response = post(SAGE_SEVD_ENCRYPT_URL, {'request': to_xml_string(sage_request)}, deadline)
+    return str(xml_body(response.content), 'utf-8')
     #doc = ET.XML(response.content)
     #token = doc.find('Token').text
     #data = doc.find('Data').text
     #return token, data
 
-def decrypt_response(xml_response):
+def decrypt_response(xml_response, deadline=None):
     '''Decrypts a response by calling the Sage Exchange decrypt API.'''
-    response = requests.post(SAGE_SEVD_DECRYPT_URL, data={'request': xml_response})
-    content = trim_xml(response.content.decode('utf-8'))
+    response = post(SAGE_SEVD_DECRYPT_URL, {'request': xml_response}, deadline)
+    return str(xml_body(response.content), 'utf-8')
 
-    return content
-
-def html_form(sage_request, redirect_url, button_value, target='_blank'):
+def html_form(sage_request, redirect_url, button_value, target='_blank', deadline=None):
     '''Creates a form for posting to the Sage Vault.'''
     template = '''\
     <form method="POST" action="%(url)s" target="%(target)s">
@@ -1795,9 +2897,9 @@ def html_form(sage_request, redirect_url, button_value, target='_blank'):
         <input type="submit" value="%(button_value)s"/>
     </form>'''
 
-    response = requests.post(SAGE_SEVD_ENCRYPT_URL, data={'request': to_xml_string(sage_request)})
+    response = post(SAGE_SEVD_ENCRYPT_URL, {'request': to_xml_string(sage_request)}, deadline)
     # remove any nasty characters we cannot interpret
-    content = trim_xml(response.content.decode('utf-8'))
+    content = str(xml_body(response.content), 'utf-8')
 
     return template % {
         'url': SAGE_SEVD_PAYMENT_URL,
@@ -1807,111 +2909,632 @@ def html_form(sage_request, redirect_url, button_value, target='_blank'):
         'target': target,
     }
 
-def execute_vault_delete(app_id, merchant_id, merchant_key, vault_guid, query_first='vault', lang_id='EN'):
-    '''Sends a VaultOperation requesting that a card identified by `vault_guid` be deleted.'''
-    request = Request()
-    request.application = ApplicationType(app_id=app_id, lang_id=lang_id)
-    request.vault_operation = VaultOperationType()
-    request.vault_operation.merchant = MerchantType(merchant_id=merchant_id, merchant_key=merchant_key)
-    request.vault_operation.vault_storage = VaultStorageType(service='DELETE', guid=vault_guid)
-    UUID = get_uuid(query_first, app_id, merchant_id, merchant_key)
-    request.vault_operation.vault_id = UUID
+def parse_response(content, deadline=None, lazy=None, unknown=None):
+    '''Converts the raw body returned by Sage Exchange into a Response.
+
+    With `lazy` (LAZY_RESPONSES by default) the Response is backed by the
+    parsed XML and its members are only converted when read, so a bad value
+    raises ValueError from the first read of its member rather than from
+    here. `unknown` is the policy for elements the models do not know
+    (UNKNOWN_ELEMENT_POLICY by default); 'strict' is checked here in both
+    modes.
+    '''
+    if deadline is not None:
+        deadline.check('parsing the response')
+    unknown = check_unknown_element_policy(unknown)
+    # the parser reads the XML straight out of the body
+    elem = XML_BACKEND.fromstring(xml_body(content))
+    if LAZY_RESPONSES if lazy is None else lazy:
+        return lazy_from_xml(Response, elem, unknown=unknown)
+    sevd_response = Response()
+    sevd_response.from_xml(elem, unknown)
+    return sevd_response
 
-    response = requests.post(SAGE_SEVD_PAYMENT_URL, data={'request': to_xml_string(request)})
-    content = trim_xml(response.content.decode('utf-8'))
+##############################################################################
+# Extraction of a few fields from raw responses without building objects     #
+##############################################################################
 
-    sevd_response = Response()
-    sevd_response.from_xml(ET.XML(content.encode('utf8')))
+# bytes that can follow the tag name in a start tag
+TAG_NAME_ENDS = b'> \t\r\n/'
+
+@functools.lru_cache(256)
+def same_tag_regex(tag):
+    '''Matches the start and end tags of elements called `tag` (bytes).'''
+    return re.compile(br'<(/?)' + re.escape(tag) + br'(?:\s[^>]*?)?(/?)>')
+
+def has_start_tag(data, tag, start, end):
+    '''True if an element called `tag` starts between `start` and `end` (not just one whose name begins with it).'''
+    start_tag = b'<' + tag
+    i = data.find(start_tag, start, end)
+    while i != -1:
+        if data[i + len(start_tag)] in TAG_NAME_ENDS:
+            return True
+        i = data.find(start_tag, i + 1, end)
+    return False
+
+def skip_element(data, tag, pos):
+    '''Returns the offset after the end tag of the `tag` element whose start tag ends at `pos`.'''
+    end_tag = b'</' + tag + b'>'
+    end = data.find(end_tag, pos)
+    if end != -1 and not has_start_tag(data, tag, pos, end):
+        # nothing nested with the same name: the usual case
+        return end + len(end_tag)
+    depth = 1
+    for match in same_tag_regex(tag).finditer(data, pos):
+        if match.group(1):
+            depth -= 1
+            if not depth:
+                return match.end()
+        elif not match.group(2):
+            depth += 1
+    return len(data)
+
+def skip_markup(data, pos):
+    '''Returns the offset after the comment, CDATA section, processing instruction or doctype starting at `pos`.'''
+    if data.startswith(b'<!--', pos):
+        end, length = data.find(b'-->', pos), 3
+    elif data.startswith(b'<![CDATA[', pos):
+        end, length = data.find(b']]>', pos), 3
+    elif data.startswith(b'<?', pos):
+        end, length = data.find(b'?>', pos), 2
+    else:
+        end, length = data.find(b'>', pos), 1
+    return len(data) if end == -1 else end + length
+
+
+class FieldExtractor(object):
+    '''Pulls a few fields out of a raw response body into a namedtuple called `name`.
+
+    Every keyword names a field and gives its path from the root element,
+    e.g. 'VaultResponse/GUID', or a (path, convert) tuple where `convert` is
+    applied to the text (e.g. Money.parse). Only the first element matching
+    each step of a path is looked into, so with several PaymentResponseType
+    elements every field comes from the first one. Fields that are missing
+    or empty are None.
+
+    extract() walks down the paths with bytes.find() on the body itself,
+    without copying it or building a tree. Elements that do not lead to a
+    field are skipped to their end tag and the walk stops as soon as no
+    field is left to find.
+    '''
+
+    def __init__(self, name, **fields):
+        self.record = collections.namedtuple(name, list(fields))
+        self.converters = []
+        # the paths as a tree of {tag: (field index or None, {child tag: ...})}
+        self.tree = {}
+        paths = set()
+        for i, (field, path) in enumerate(fields.items()):
+            convert = None
+            if isinstance(path, tuple):
+                path, convert = path
+            path = path.strip('/').encode('utf-8')
+            if path in paths:
+                raise ValueError('%s: %s is already extracted.' % (field, path.decode('utf-8')))
+            paths.add(path)
+            self.converters.append(convert)
+            node = self.tree
+            tags = path.split(b'/')
+            for tag in tags[:-1]:
+                node = node.setdefault(tag, (None, {}))[1]
+            node[tags[-1]] = (i, node.get(tags[-1], (None, {}))[1])
+
+    def extract(self, content, deadline=None):
+        '''Returns the record of the fields found in the raw bytes `content`.'''
+        if deadline is not None:
+            deadline.check('parsing the response')
+        if not isinstance(content, bytes):
+            # bodies are bytes and searched in place; anything else is copied once
+            content = bytes(content)
+        bounds = find_xml(content)
+        if bounds is None:
+            raise ValueError('The response does not contain XML.')
+        start, end = bounds
+        values = [None] * len(self.converters)
+
+        # the root element's start tag, after any XML declaration or comments
+        root = content.find(b'<', start, end)
+        while root != -1 and content[root + 1] in b'!?':
+            root = content.find(b'<', skip_markup(content, root), end)
+        close = content.find(b'>', root, end) if root != -1 else -1
+        if close != -1 and content[close - 1] != 0x2f: # not <Root/>
+            tag = content[root + 1:close].split(None, 1)[0]
+            self._walk(content, close + 1, end, tag, self.tree, values, [])
+
+        for i, convert in enumerate(self.converters):
+            if values[i] is not None and convert is not None:
+                values[i] = convert(values[i])
+        return self.record(*values)
+
+    def _walk(self, data, pos, end, tag, tree, values, pending):
+        '''Looks for the tags in `tree` among the children of the `tag` element whose start tag ends at `pos`.
+
+        `pending` holds the tags still looked for by every enclosing element.
+        Returns the offset after the element's end tag, or -1 once nothing is
+        left to look for anywhere.
+        '''
+        wanted = dict(tree)
+        pending.append(wanted)
+        try:
+            while wanted:
+                pos = data.find(b'<', pos, end)
+                if pos == -1:
+                    return end
+                marker = data[pos + 1]
+                if marker == 0x2f: # </: the end of this element
+                    return data.find(b'>', pos, end) + 1
+                if marker == 0x21 or marker == 0x3f: # <! or <?
+                    pos = skip_markup(data, pos)
+                    continue
+                close = data.find(b'>', pos, end)
+                if close == -1:
+                    return end
+                if data[close - 1] == 0x2f: # <Tag/>
+                    wanted.pop(data[pos + 1:close - 1].split(None, 1)[0], None)
+                    pos = close + 1
+                    continue
+                child = data[pos + 1:close].split(None, 1)[0]
+                pos = close + 1
+                node = wanted.pop(child, None)
+                # most elements only hold text: then the next tag is their end tag
+                text_end = data.find(b'<', pos, end)
+                if text_end != -1 and data[text_end + 1] == 0x2f:
+                    if node is not None and node[0] is not None:
+                        values[node[0]] = self._text(data[pos:text_end])
+                    pos = data.find(b'>', text_end, end) + 1
+                elif node is None:
+                    # not on a path, or a later element at a path already looked into
+                    pos = skip_element(data, child, pos)
+                elif node[0] is not None:
+                    after = skip_element(data, child, pos)
+                    values[node[0]] = self._text(data[pos:after - len(child) - 3])
+                    pos = after
+                else:
+                    pos = self._walk(data, pos, end, child, node[1], values, pending)
+                    if pos == -1:
+                        return -1
+        finally:
+            pending.pop()
+        # every path below this element has been looked into
+        if not any(pending):
+            return -1
+        return skip_element(data, tag, pos)
+
+    @staticmethod
+    def _text(raw):
+        if b'<' in raw:
+            # comments or CDATA: let the parser work it out
+            text = ''.join(ET.fromstring(b'<text>' + raw + b'</text>').itertext())
+        else:
+            text = str(raw, 'utf-8')
+            if '&' in text:
+                text = html.unescape(text)
+        return text or None
+
+
+_PAYMENT = 'PaymentResponses/PaymentResponseType/'
+_VAULT_STATUS = 'VaultStatusQueryResponse/'
+
+# result of a payment (e.g. an auth or a void)
+PAYMENT_RESULT = FieldExtractor(
+    'PaymentResult',
+    response_indicator=_PAYMENT + 'Response/ResponseIndicator',
+    response_code=_PAYMENT + 'Response/ResponseCode',
+    response_message=_PAYMENT + 'Response/ResponseMessage',
+    transaction_id=_PAYMENT + 'TransactionResponse/TransactionID',
+    van_reference=_PAYMENT + 'TransactionResponse/VANReference',
+    auth_code=_PAYMENT + 'TransactionResponse/AuthCode',
+    amount=(_PAYMENT + 'TransactionResponse/Amount', Money.parse),
+    guid=_PAYMENT + 'VaultResponse/GUID',
+)
+
+# result of a vault status query
+VAULT_STATUS_RESULT = FieldExtractor(
+    'VaultStatusResult',
+    response_indicator=_VAULT_STATUS + 'Response/ResponseIndicator',
+    response_code=_VAULT_STATUS + 'Response/ResponseCode',
+    response_message=_VAULT_STATUS + 'Response/ResponseMessage',
+    guid=_VAULT_STATUS + 'VaultResponse/GUID',
+    expiration_date=_VAULT_STATUS + 'VaultResponse/ExpirationDate',
+    last4=_VAULT_STATUS + 'VaultResponse/Last4',
+)
+
+# result of a vault operation (e.g. a DELETE)
+VAULT_RESULT = FieldExtractor(
+    'VaultResult',
+    response_indicator='VaultResponse/Response/ResponseIndicator',
+    response_code='VaultResponse/Response/ResponseCode',
+    response_message='VaultResponse/Response/ResponseMessage',
+    guid='VaultResponse/GUID',
+    expiration_date='VaultResponse/ExpirationDate',
+)
+
+def get_merchant_id(sage_request):
+    '''Returns the MerchantID a Request is sent for, or None if it has no Merchant.'''
+    if isinstance(sage_request, RenderedRequest):
+        # avoid building the Request just to read it
+        return sage_request.skeleton.constants.get('merchant_id')
+    for operation in (sage_request.vault_status_query, sage_request.vault_operation, sage_request.batch):
+        if operation is not None and operation.merchant is not None:
+            return operation.merchant.merchant_id
+    if sage_request.transaction_status_queries is not None:
+        query = sage_request.transaction_status_queries.transaction_status_queries
+        if isinstance(query, (list, tuple)):
+            query = query[0] if query else None
+        if query is not None and query.merchant is not None:
+            return query.merchant.merchant_id
+    if sage_request.payments is not None and sage_request.payments.payment_type is not None:
+        payment = sage_request.payments.payment_type
+        if isinstance(payment, (list, tuple)):
+            payment = payment[0]
+        if payment.merchant is not None:
+            return payment.merchant.merchant_id
+    return None
+
+def add_response_listener(listener):
+    '''Registers `listener` to be called with (sage_request, sage_response) after every send_request().'''
+    if listener not in RESPONSE_LISTENERS:
+        RESPONSE_LISTENERS.append(listener)
+
+def remove_response_listener(listener):
+    if listener in RESPONSE_LISTENERS:
+        RESPONSE_LISTENERS.remove(listener)
+
+def send_request(sage_request, deadline=None, session=None):
+    '''POSTs a Request to the payment API and returns the parsed Response.
+
+    Exceptions raised by response listeners are logged and otherwise ignored
+    so the Response (e.g. of an approved payment) is never lost.
+    '''
+    data = {'request': to_xml_string(sage_request)}
+    response = post(SAGE_SEVD_PAYMENT_URL, data, deadline, session)
+    sevd_response = parse_response(response.content, deadline)
+    for listener in RESPONSE_LISTENERS:
+        try:
+            listener(sage_request, sevd_response)
+        except Exception:
+            logger.exception('Response listener %r failed.', listener)
     return sevd_response
 
-def execute_vault_status_query(app_id, merchant_id, merchant_key, vault_id, lang_id='EN'):
-    '''Sends a VaultStatusQuery to get the status of a previous VaultOperation.'''
+##############################################################################
+# Request skeletons: requests serialized once per merchant with slots for    #
+# the few fields that change between calls                                   #
+##############################################################################
+
+class Slot(object):
+    '''Placeholder for a variable field while a RequestSkeleton is compiled.'''
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        # private use characters, which are valid XML but never sent to Sage
+        return '\ue000%s\ue001' % self.name
+
+SLOT_REGEX = re.compile('<([^<>\\s]+)>\ue000(\\w+)\ue001</\\1>')
+
+
+class RequestSkeleton(object):
+    '''A Request serialized once with its variable fields left as slots.
+
+    `build` is a function returning a Request from `constants` plus the
+    variables named in `slots`. `slots` maps each variable to the path of
+    member names leading to its field from the Request, e.g.
+    {'vault_id': ('vault_operation', 'vault_id')}. Slots whose parent object
+    is not built for these constants are left out.
+
+    When VALIDATE_REQUESTS is True the skeleton is checked against the schema
+    once, when it is compiled (the slots are skipped). render() validates the
+    variables with the model's own setters and joins them with the cached XML.
+    The result is exactly what to_xml_string() gives for the Request built
+    from the same values.
+    '''
+
+    def __init__(self, build, slots, **constants):
+        self.build = build
+        self.constants = constants
+        request = build(**dict(constants, **dict.fromkeys(slots)))
+
+        self.fields = {}
+        self.absent = set()
+        for name, path in slots.items():
+            obj = request
+            for member_name in path[:-1]:
+                obj = getattr(obj, member_name)
+                if obj is None:
+                    break
+            if obj is None:
+                self.absent.add(name)
+                continue
+            cls = type(obj)
+            for child in cls.xml_children:
+                if child.member_name == path[-1]:
+                    break
+            else:
+                raise ValueError('%s: %s has no member %s.' % (name, cls.__name__, path[-1]))
+            setattr(obj, '_xml_%s' % child.member_name, Slot(name))
+            self.fields[name] = (cls, getattr(cls, child.member_name), child.required)
+        if VALIDATE_REQUESTS and isinstance(request, Request):
+            # constants, required elements and order; the slots are checked by render()
+            validate_request(request)
+
+        # splitting gives constant XML, tag name, slot name, constant XML, ...
+        parts = SLOT_REGEX.split(serialize_request(request))
+        self.fragments = parts[0::3]
+        self.slots = list(zip(parts[1::3], parts[2::3]))
+        if len(self.slots) != len(self.fields):
+            raise ValueError('Every slot must be a simple element that appears once in the request.')
+
+    def render(self, **values):
+        '''Returns the XML document with `values` rendered into the slots.'''
+        for name in self.absent:
+            if values.get(name) is not None:
+                raise ValueError('%s: This field is not part of the request skeleton.' % name)
+        fragments = self.fragments
+        result = [fragments[0]]
+        for i, (tag_name, name) in enumerate(self.slots):
+            cls, prop, required = self.fields[name]
+            # validate and normalize the value exactly as setting it on the model would
+            obj = cls.__new__(cls)
+            prop.fset(obj, values.get(name))
+            value = prop.fget(obj)
+            if value is not None:
+                if isinstance(value, bool):
+                    text = 'true' if value else 'false'
+                elif isinstance(value, str):
+                    text = value
+                else:
+                    text = str(value)
+                result.append('<%s>%s</%s>' % (tag_name, xml_escape(text), tag_name))
+            elif required:
+                raise Exception('Missing value: %s' % tag_name)
+            result.append(fragments[i + 1])
+        return ''.join(result)
+
+    def bind(self, **values):
+        '''Renders `values` into a RenderedRequest that can be passed to send_request().'''
+        return RenderedRequest(self, self.render(**values), values)
+
+
+class RenderedRequest(object):
+    '''A Request rendered from a RequestSkeleton.
+
+    It can be used in place of a Request with send_request(). Attributes are
+    looked up on the Request built from the same values, which is only built
+    when first needed (e.g. by a response listener).
+    '''
+
+    def __init__(self, skeleton, xml, values):
+        self.skeleton = skeleton
+        self.xml = xml
+        self.values = values
+
+    def __getattr__(self, name):
+        request = self.__dict__.get('_request')
+        if request is None:
+            if 'skeleton' not in self.__dict__:
+                raise AttributeError(name)
+            request = self._request = self.skeleton.build(**dict(self.skeleton.constants, **self.values))
+        return getattr(request, name)
+
+
+def build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id='EN'):
+    '''Returns the ApplicationType and MerchantType of a request, both filled in from one MerchantConfig.'''
+    config = MERCHANTS.resolve(app_id, merchant_id, merchant_key, lang_id)
+    return (ApplicationType(app_id=config.app_id, lang_id=config.lang_id),
+            MerchantType(merchant_id=config.merchant_id, merchant_key=config.merchant_key))
+
+def build_vault_operation_request(app_id, merchant_id, merchant_key, service, vault_guid, vault_id, lang_id='EN'):
+    request = Request()
+    request.application, merchant = build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id)
+    request.vault_operation = VaultOperationType()
+    request.vault_operation.merchant = merchant
+    request.vault_operation.vault_storage = VaultStorageType(service=service, guid=vault_guid)
+    request.vault_operation.vault_id = vault_id
+    return request
+
+def build_vault_status_query_request(app_id, merchant_id, merchant_key, vault_id, lang_id='EN'):
     request = Request()
-    request.application = ApplicationType(app_id=app_id, lang_id=lang_id)
+    request.application, merchant = build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id)
     request.vault_status_query = VaultStatusQueryType()
-    request.vault_status_query.merchant = MerchantType(merchant_id=merchant_id, merchant_key=merchant_key)
+    request.vault_status_query.merchant = merchant
     request.vault_status_query.vault_id = vault_id
+    return request
 
-    response = requests.post(SAGE_SEVD_PAYMENT_URL, data={'request': to_xml_string(request)})
-    content = trim_xml(response.content.decode('utf-8'))
-
-    sevd_response = Response()
-    sevd_response.from_xml(ET.XML(content.encode('utf8')))
-    return sevd_response
-
-def execute_transaction_status_query(app_id, merchant_id, merchant_key, trans_id, lang_id='EN'):
+def build_transaction_status_query_request(app_id, merchant_id, merchant_key, trans_id, lang_id='EN'):
     request = Request()
-    request.application = ApplicationType(app_id=app_id, lang_id=lang_id)
+    request.application, merchant = build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id)
     request.transaction_status_queries = TransactionStatusQueriesType()
     request.transaction_status_queries.transaction_status_queries = TransactionStatusQueryType()
-    request.transaction_status_queries.transaction_status_queries.merchant = MerchantType(merchant_id=merchant_id, merchant_key=merchant_key)
+    request.transaction_status_queries.transaction_status_queries.merchant = merchant
     request.transaction_status_queries.transaction_status_queries.trans_id = trans_id
+    return request
 
-    response = requests.post(SAGE_SEVD_PAYMENT_URL, data={'request': to_xml_string(request)})
-    content = trim_xml(response.content.decode('utf-8'))
+def build_auth_with_vault_request(app_id, merchant_id, merchant_key, trans_id, vault_guid, amount, street1, city, state, zip_code, street2=None, country=None, first_name=None, last_name=None, middle_initial=None, lang_id='EN', with_name=None):
+    '''Builds an Authorization (no UI) of a card in the vault.
 
-    sevd_response = Response()
-    sevd_response.from_xml(ET.XML(content.encode('utf8')))
-    return sevd_response
-
-def execute_auth_with_vault(app_id, merchant_id, merchant_key, vault_guid, amount, street1, city, state, zip_code, street2=None, country=None, first_name=None, last_name=None, middle_initial=None, query_first='payment', lang_id='EN'):
-    '''Performs an Authorization on a card in the vault.'''
+    A Name is added when `with_name` is True or, if it is None, when any part
+    of the name is given.
+    '''
     request = Request()
-    request.application = ApplicationType(app_id=app_id, lang_id=lang_id)
+    request.application, merchant = build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id)
     request.payments = Payments()
     request.payments.payment_type = PaymentType()
-    request.payments.payment_type.merchant = MerchantType(merchant_id=merchant_id, merchant_key=merchant_key)
+    request.payments.payment_type.merchant = merchant
     request.payments.payment_type.customer = PersonType()
 
-    # handle when name is passed in
-    if first_name is not None or last_name is not None or middle_initial is not None:
-        request.payments.payment_type.customer.name = NameType()
-        if first_name is not None:
-            request.payments.payment_type.customer.name.first_name = first_name
-        if last_name is not None:
-            request.payments.payment_type.customer.name.last_name = last_name
-        if middle_initial is not None:
-            request.payments.payment_type.customer.name.middle_initial = middle_initial
-
-    request.payments.payment_type.customer.address = AddressType()
-    request.payments.payment_type.customer.address.street1 = street1
-    if street2 is not None:
-        request.payments.payment_type.customer.address.street2 = street2
-    request.payments.payment_type.customer.address.city = city
-    request.payments.payment_type.customer.address.state = state
-    request.payments.payment_type.customer.address.zip_code = zip_code
-    if country is not None:
-        request.payments.payment_type.customer.address.country = country
+    if with_name is None:
+        with_name = first_name is not None or last_name is not None or middle_initial is not None
+    if with_name:
+        request.payments.payment_type.customer.name = NameType(first_name=first_name, last_name=last_name, middle_initial=middle_initial)
+
+    request.payments.payment_type.customer.address = AddressType(street1=street1, street2=street2, city=city, state=state, zip_code=zip_code, country=country)
     request.payments.payment_type.transaction_base = TransactionBaseType()
-    request.payments.payment_type.transaction_base.trans_id = get_uuid(query_first, app_id, merchant_id, merchant_key)
+    request.payments.payment_type.transaction_base.trans_id = trans_id
     request.payments.payment_type.transaction_base.trans_type = '02' # AUTH NO UI
     request.payments.payment_type.transaction_base.amount = amount
     request.payments.payment_type.vault_storage = VaultStorageType()
     request.payments.payment_type.vault_storage.service = 'RETRIEVE'
     request.payments.payment_type.vault_storage.guid = vault_guid
+    return request
 
-    response = requests.post(SAGE_SEVD_PAYMENT_URL, data={'request': to_xml_string(request)})
-    content = trim_xml(response.content.decode('utf-8'))
-
-    sevd_response = Response()
-    sevd_response.from_xml(ET.XML(content.encode('utf8')))
-    return sevd_response
-
-def execute_void(app_id, merchant_id, merchant_key, transaction_id, query_first='payment', lang_id='EN'):
-    '''Performs a void on an existing transaction.'''
+def build_void_request(app_id, merchant_id, merchant_key, trans_id, transaction_id, lang_id='EN'):
     request = Request()
-    request.application = ApplicationType(app_id=app_id, lang_id=lang_id)
+    request.application, merchant = build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id)
     request.payments = Payments()
     request.payments.payment_type = PaymentType()
-    request.payments.payment_type.merchant = MerchantType(merchant_id=merchant_id, merchant_key=merchant_key)
+    request.payments.payment_type.merchant = merchant
     request.payments.payment_type.transaction_base = TransactionBaseType()
-    request.payments.payment_type.transaction_base.trans_id = get_uuid(query_first, app_id, merchant_id, merchant_key)
+    request.payments.payment_type.transaction_base.trans_id = trans_id
     request.payments.payment_type.transaction_base.trans_type = '04'
     request.payments.payment_type.transaction_base.van_reference = transaction_id
+    return request
 
-    response = requests.post(SAGE_SEVD_PAYMENT_URL, data={'request': to_xml_string(request)})
-    content = trim_xml(response.content.decode('utf-8'))
+def build_batch_request(app_id, merchant_id, merchant_key, net, count, batch_payment='CREDITCARD', lang_id='EN'):
+    request = Request()
+    request.application, merchant = build_application_and_merchant(app_id, merchant_id, merchant_key, lang_id)
+    request.batch = BatchType()
+    request.batch.merchant = merchant
+    request.batch.net = net
+    request.batch.count = count
+    request.batch.batch_payment = batch_payment
+    return request
+
+_PAYMENT = ('payments', 'payment_type')
+_ADDRESS = _PAYMENT + ('customer', 'address')
+_NAME = _PAYMENT + ('customer', 'name')
+
+# operation: (build function, slots) for get_request_skeleton()
+REQUEST_SKELETONS = {
+    'vault_operation': (build_vault_operation_request, {
+        'vault_guid': ('vault_operation', 'vault_storage', 'guid'),
+        'vault_id': ('vault_operation', 'vault_id'),
+    }),
+    'vault_status_query': (build_vault_status_query_request, {
+        'vault_id': ('vault_status_query', 'vault_id'),
+    }),
+    'transaction_status_query': (build_transaction_status_query_request, {
+        'trans_id': ('transaction_status_queries', 'transaction_status_queries', 'trans_id'),
+    }),
+    'auth_with_vault': (build_auth_with_vault_request, {
+        'trans_id': _PAYMENT + ('transaction_base', 'trans_id'),
+        'amount': _PAYMENT + ('transaction_base', 'amount'),
+        'vault_guid': _PAYMENT + ('vault_storage', 'guid'),
+        'street1': _ADDRESS + ('street1',),
+        'street2': _ADDRESS + ('street2',),
+        'city': _ADDRESS + ('city',),
+        'state': _ADDRESS + ('state',),
+        'zip_code': _ADDRESS + ('zip_code',),
+        'country': _ADDRESS + ('country',),
+        'first_name': _NAME + ('first_name',),
+        'last_name': _NAME + ('last_name',),
+        'middle_initial': _NAME + ('middle_initial',),
+    }),
+    'void': (build_void_request, {
+        'trans_id': _PAYMENT + ('transaction_base', 'trans_id'),
+        'transaction_id': _PAYMENT + ('transaction_base', 'van_reference'),
+    }),
+    'batch': (build_batch_request, {
+        'net': ('batch', 'net'),
+        'count': ('batch', 'count'),
+    }),
+}
+
+def get_request_skeleton(operation, app_id, merchant_id, merchant_key, lang_id='EN', **options):
+    '''Returns the RequestSkeleton of an operation in REQUEST_SKELETONS for a merchant.
+
+    Skeletons are compiled once for every (operation, application, merchant,
+    options) and cached. Missing credentials are resolved through MERCHANTS
+    first, so the cache is keyed on the values actually sent and changes to
+    the registry are picked up. `options` are passed to the build function as
+    further constants, e.g. service='DELETE' for a 'vault_operation'.
+    '''
+    config = MERCHANTS.resolve(app_id, merchant_id, merchant_key, lang_id)
+    return compile_request_skeleton(operation, config.app_id, config.merchant_id, config.merchant_key, config.lang_id, **options)
+
+@functools.lru_cache(maxsize=256)
+def compile_request_skeleton(operation, app_id, merchant_id, merchant_key, lang_id, **options):
+    build, slots = REQUEST_SKELETONS[operation]
+    return RequestSkeleton(build, slots, app_id=app_id, merchant_id=merchant_id, merchant_key=merchant_key, lang_id=lang_id, **options)
+
+def execute_vault_delete(app_id, merchant_id, merchant_key, vault_guid, query_first='vault', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Sends a VaultOperation requesting that a card identified by `vault_guid` be deleted.
+
+    `timeout` (seconds) or `deadline` bounds the whole call including the UUID
+    probe. DeadlineExceeded is raised when it runs out. `session` is used for
+    every POST when given (see post()).
+    '''
+    deadline = make_deadline(timeout, deadline)
+    UUID = get_uuid(query_first, app_id, merchant_id, merchant_key, deadline, session)
+    skeleton = get_request_skeleton('vault_operation', app_id, merchant_id, merchant_key, lang_id, service='DELETE')
+    request = skeleton.bind(vault_guid=vault_guid, vault_id=UUID)
+
+    return send_request(request, deadline, session)
+
+def execute_vault_retrieve(app_id, merchant_id, merchant_key, vault_guid, query_first='vault', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Sends a VaultOperation requesting the details (ExpirationDate, Last4, ...) of the card identified by `vault_guid`.'''
+    deadline = make_deadline(timeout, deadline)
+    UUID = get_uuid(query_first, app_id, merchant_id, merchant_key, deadline, session)
+    skeleton = get_request_skeleton('vault_operation', app_id, merchant_id, merchant_key, lang_id, service='RETRIEVE')
+    request = skeleton.bind(vault_guid=vault_guid, vault_id=UUID)
+
+    return send_request(request, deadline, session)
+
+def execute_vault_status_query(app_id, merchant_id, merchant_key, vault_id, lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Sends a VaultStatusQuery to get the status of a previous VaultOperation.'''
+    deadline = make_deadline(timeout, deadline)
+    request = get_request_skeleton('vault_status_query', app_id, merchant_id, merchant_key, lang_id).bind(vault_id=vault_id)
 
-    sevd_response = Response()
-    sevd_response.from_xml(ET.XML(content.encode('utf8')))
-    return sevd_response
+    return send_request(request, deadline, session)
+
+def execute_transaction_status_query(app_id, merchant_id, merchant_key, trans_id, lang_id='EN', timeout=None, deadline=None, session=None):
+    deadline = make_deadline(timeout, deadline)
+    request = get_request_skeleton('transaction_status_query', app_id, merchant_id, merchant_key, lang_id).bind(trans_id=trans_id)
+
+    return send_request(request, deadline, session)
+
+def execute_auth_with_vault(app_id, merchant_id, merchant_key, vault_guid, amount, street1, city, state, zip_code, street2=None, country=None, first_name=None, last_name=None, middle_initial=None, query_first='payment', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Performs an Authorization on a card in the vault.'''
+    deadline = make_deadline(timeout, deadline)
+    with_name = first_name is not None or last_name is not None or middle_initial is not None
+    skeleton = get_request_skeleton('auth_with_vault', app_id, merchant_id, merchant_key, lang_id, with_name=with_name)
+    request = skeleton.bind(
+        trans_id=get_uuid(query_first, app_id, merchant_id, merchant_key, deadline, session),
+        amount=amount,
+        vault_guid=vault_guid,
+        street1=street1,
+        street2=street2,
+        city=city,
+        state=state,
+        zip_code=zip_code,
+        country=country,
+        first_name=first_name,
+        last_name=last_name,
+        middle_initial=middle_initial,
+    )
+
+    return send_request(request, deadline, session)
+
+def execute_void(app_id, merchant_id, merchant_key, transaction_id, query_first='payment', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Performs a void on an existing transaction.'''
+    deadline = make_deadline(timeout, deadline)
+    trans_id = get_uuid(query_first, app_id, merchant_id, merchant_key, deadline, session)
+    request = get_request_skeleton('void', app_id, merchant_id, merchant_key, lang_id).bind(trans_id=trans_id, transaction_id=transaction_id)
+
+    return send_request(request, deadline, session)
+
+def execute_batch_inquiry(app_id, merchant_id, merchant_key, batch_payment='CREDITCARD', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Asks for the Net and Count of the current open batch without closing it.'''
+    return execute_batch_close(app_id, merchant_id, merchant_key, '-1', '-1', batch_payment, lang_id, timeout, deadline, session)
+
+def execute_batch_close(app_id, merchant_id, merchant_key, net, count, batch_payment='CREDITCARD', lang_id='EN', timeout=None, deadline=None, session=None):
+    '''Closes the current batch. `net` and `count` are the totals expected to be in it.
+
+    Sage uses a `net` and `count` of -1 for an inquiry (see execute_batch_inquiry()).
+    '''
+    deadline = make_deadline(timeout, deadline)
+    skeleton = get_request_skeleton('batch', app_id, merchant_id, merchant_key, lang_id, batch_payment=batch_payment)
+    request = skeleton.bind(net=net, count=str(count))
+
+    return send_request(request, deadline, session)
@@ -7,19 +7,25 @@ import uuid
 
 from django import template
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 
 from .. import sevd
 
 register = template.Library()
 
 @register.simple_tag
-def vault_form():
+def vault_form(timeout=None, merchant=None):
+    '''Renders the form that sends the user to the vault. `merchant` names a merchant in sevd.MERCHANTS (the default one if not given).'''
+    deadline = sevd.make_deadline(timeout)
+    config = sevd.MERCHANTS.get(merchant)
+    if config is None:
+        raise ImproperlyConfigured('vault_form: no merchant given and no default merchant is configured (see sevd.MerchantRegistry).')
     request = sevd.Request()
-    request.application = sevd.ApplicationType()
+    request.application = sevd.ApplicationType(app_id=config.app_id, lang_id=config.lang_id)
     request.vault_operation = sevd.VaultOperationType()
-    request.vault_operation.merchant = sevd.MerchantType()
+    request.vault_operation.merchant = sevd.MerchantType(merchant_id=config.merchant_id, merchant_key=config.merchant_key)
     request.vault_operation.vault_storage = sevd.VaultStorageType(service='CREATE')
-    request.vault_operation.vault_id = sevd.get_uuid()
+    request.vault_operation.vault_id = sevd.get_uuid('vault', config.app_id, config.merchant_id, config.merchant_key, deadline=deadline)
     request.postback = sevd.PostbackType(url=settings.SEVD_VAULT_CREATE_POSTBACK_URL)
     
-    return sevd.html_form(request, settings.SEVD_VAULT_CREATE_RETURN_URL, settings.SEVD_VAULT_CREATE_BUTTON_TEXT)
+    return sevd.html_form(request, settings.SEVD_VAULT_CREATE_RETURN_URL, settings.SEVD_VAULT_CREATE_BUTTON_TEXT, deadline=deadline)
@@ -1,14 +1,45 @@
 """Unittests."""
 
+import asyncio
+from concurrent import futures
+import datetime
 from decimal import Decimal
+import io
+import json
 import os.path
+import pickle
 import re
-from unittest import TestCase
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipUnless
 import warnings
 import xml.etree.ElementTree as ET
 
 import lxml.etree
 
+try:
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+except ImportError:
+    django = None
+else:
+    if not settings.configured:
+        # enough of a project to test the models against an in-memory database
+        settings.configure(
+            INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'sageexchangevirtualdesktop'],
+            DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        )
+        django.setup()
+
+from . import benchmark
+from . import bulk
+from . import client
+from . import reconcile
+from . import recurring
 from . import sevd
 
 # we are trying to parse the XSD once.
@@ -126,6 +157,26 @@ class TestGetterSetter(TestCase):
 
         self.assertRaises(ValueError, setattr, x, 'prop', 'test')
 
+    def test_money_set_func(self):
+        X = self.create_class(sevd.money_set_func)
+
+        x = X()
+        self.assertEqual(x.prop, None)
+        x.prop = '1.5'
+        self.assertEqual(x.prop.cents, 150)
+        x.prop = 2
+        self.assertEqual(str(x.prop), '2.00')
+        x.prop = Decimal('-0.07')
+        self.assertEqual(x.prop.cents, -7)
+        x.prop = None
+        self.assertEqual(x.prop, None)
+
+        self.assertRaises(ValueError, setattr, x, 'prop', 'test')
+        # fractions of a cent are rounded, not rejected
+        x.prop = '1.005'
+        self.assertEqual(x.prop.cents, 101)
+        self.assertRaises(ValueError, setattr, x, 'prop', True)
+
     def test_boolean_set_func(self):
         X = self.create_class(sevd.boolean_set_func)
 
@@ -292,6 +343,1580 @@ class TestGetterSetter(TestCase):
         self.assertRaises(ValueError, setattr, x, 'prop', True)
 
 
+class FakeHTTPResponse(object):
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeSession(object):
+    '''Stands in for requests.Session and returns canned bodies.
+
+    `delay` is either a number of seconds to sleep on every call or a list
+    of delays used in turn.
+    '''
+    def __init__(self, content=b'', delay=0):
+        self.content = content
+        self.delay = delay
+        self.calls = []
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        self.calls.append((url, data, timeout))
+        delay = self.delay
+        if isinstance(delay, list):
+            delay = delay[len(self.calls) - 1] if len(self.calls) <= len(delay) else 0
+        if delay:
+            time.sleep(delay)
+        return FakeHTTPResponse(self.content)
+
+
+VAULT_STATUS_RESPONSE = b'''\xef\xbb\xbf<?xml version="1.0" encoding="UTF-8"?>
+<Response_v1>
+    <VaultStatusQueryResponse>
+        <Response>
+            <ResponseIndicator>A</ResponseIndicator>
+            <ResponseMessage>SUCCESS</ResponseMessage>
+        </Response>
+        <VaultResponse>
+            <Response>
+                <ResponseIndicator>A</ResponseIndicator>
+                <ResponseMessage>SUCCESS</ResponseMessage>
+            </Response>
+            <GUID>74e7b7c14839486484071a91f4367bd6</GUID>
+            <ExpirationDate>0716</ExpirationDate>
+            <Last4>XXXXXXXXXXXX1111</Last4>
+            <PaymentDescription>411111XXXXXX1111</PaymentDescription>
+            <PaymentTypeID>4</PaymentTypeID>
+        </VaultResponse>
+    </VaultStatusQueryResponse>
+</Response_v1>
+'''
+
+
+class TestDeadline(TestCase):
+
+    def test_remaining(self):
+        deadline = sevd.Deadline(10)
+        self.assertTrue(0 < deadline.remaining() <= 10)
+        self.assertFalse(deadline.expired())
+        deadline.check('test')
+
+        deadline = sevd.Deadline(0)
+        self.assertEqual(deadline.remaining(), 0)
+        self.assertTrue(deadline.expired())
+        self.assertRaises(sevd.DeadlineExceeded, deadline.check, 'test')
+
+    def test_make_deadline(self):
+        self.assertEqual(sevd.make_deadline(), None)
+        deadline = sevd.Deadline(5)
+        self.assertIs(sevd.make_deadline(1, deadline), deadline)
+        self.assertEqual(sevd.make_deadline(2).timeout, 2)
+
+    def test_post_uses_remaining_time(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        sevd.post(sevd.SAGE_SEVD_PAYMENT_URL, {}, sevd.Deadline(2), session)
+        timeout = session.calls[0][2]
+        self.assertTrue(0 < timeout <= 2)
+
+        sevd.post(sevd.SAGE_SEVD_PAYMENT_URL, {}, session=session)
+        self.assertEqual(session.calls[1][2], None)
+
+    def test_body_is_read_under_the_deadline(self):
+        class StreamedResponse(object):
+            closed = False
+            def __init__(self, chunks, delay):
+                self.chunks = chunks
+                self.delay = delay
+            def iter_content(self, chunk_size):
+                for chunk in self.chunks:
+                    time.sleep(self.delay)
+                    yield chunk
+            def close(self):
+                self.closed = True
+
+        class StreamingSession(object):
+            def __init__(self, response):
+                self.response = response
+                self.kwargs = None
+            def post(self, url, data=None, timeout=None, **kwargs):
+                self.kwargs = kwargs
+                return self.response
+
+        session = StreamingSession(StreamedResponse([b'<a>', b'</a>'], 0))
+        response = sevd.post(sevd.SAGE_SEVD_PAYMENT_URL, {}, sevd.Deadline(2), session)
+        self.assertEqual(session.kwargs, {'stream': True})
+        self.assertEqual(response._content, b'<a></a>')
+
+        # every chunk arrives in time for its read but the body takes too long
+        session = StreamingSession(StreamedResponse([b'x'] * 20, 0.02))
+        self.assertRaises(sevd.DeadlineExceeded, sevd.post, sevd.SAGE_SEVD_PAYMENT_URL, {}, sevd.Deadline(0.1), session)
+        self.assertTrue(session.response.closed)
+
+    def test_expired_deadline_aborts_pipeline(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        self.assertRaises(sevd.DeadlineExceeded, sevd.post, sevd.SAGE_SEVD_PAYMENT_URL, {}, sevd.Deadline(0), session)
+        self.assertEqual(session.calls, [])
+
+        # the deadline is used up by the POST so parsing is never started
+        session = FakeSession(VAULT_STATUS_RESPONSE, delay=0.05)
+        request = sevd.Request()
+        request.vault_status_query = sevd.VaultStatusQueryType(vault_id='1')
+        self.assertRaises(sevd.DeadlineExceeded, sevd.send_request, request, sevd.Deadline(0.01), session)
+
+        self.assertRaises(sevd.DeadlineExceeded, sevd.get_uuid, 'vault', 'APP', 'MID', 'KEY', sevd.Deadline(0))
+
+    def test_deadline_expiring_after_check(self):
+        class ExpiringDeadline(sevd.Deadline):
+            # runs out between check() and remaining()
+            def expired(self):
+                return False
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        self.assertRaises(sevd.DeadlineExceeded, sevd.post, sevd.SAGE_SEVD_PAYMENT_URL, {}, ExpiringDeadline(0), session)
+        self.assertEqual(session.calls, [])
+
+    def test_send_request(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        request = sevd.Request()
+        request.vault_status_query = sevd.VaultStatusQueryType(vault_id='1')
+        response = sevd.send_request(request, sevd.Deadline(5), session)
+        self.assertEqual(response.vault_query_response.vault_response.last4, 'XXXXXXXXXXXX1111')
+
+
+class TestResponseListeners(TestCase):
+
+    def test_parse_expiration_date(self):
+        self.assertEqual(sevd.parse_expiration_date('0716'), datetime.date(2016, 7, 1))
+        self.assertEqual(sevd.parse_expiration_date(' 1230 '), datetime.date(2030, 12, 1))
+        self.assertEqual(sevd.parse_expiration_date('1316'), None)
+        self.assertEqual(sevd.parse_expiration_date('716'), None)
+        self.assertEqual(sevd.parse_expiration_date(None), None)
+
+    def test_listeners_receive_responses(self):
+        received = []
+        def listener(sage_request, sage_response):
+            received.append((sage_request, sage_response))
+        sevd.add_response_listener(listener)
+        sevd.add_response_listener(listener)
+        self.addCleanup(sevd.remove_response_listener, listener)
+
+        request = sevd.Request()
+        request.vault_status_query = sevd.VaultStatusQueryType(vault_id='1')
+        response = sevd.send_request(request, session=FakeSession(VAULT_STATUS_RESPONSE))
+        self.assertEqual(received, [(request, response)])
+
+    def test_listener_errors_are_logged(self):
+        def failing(sage_request, sage_response):
+            raise RuntimeError('database is down')
+        sevd.add_response_listener(failing)
+        self.addCleanup(sevd.remove_response_listener, failing)
+
+        request = sevd.Request()
+        request.vault_status_query = sevd.VaultStatusQueryType(vault_id='1')
+        with self.assertLogs('sageexchangevirtualdesktop.sevd', 'ERROR') as logs:
+            response = sevd.send_request(request, session=FakeSession(VAULT_STATUS_RESPONSE))
+        self.assertEqual(response.vault_query_response.vault_response.guid, '74e7b7c14839486484071a91f4367bd6')
+        self.assertIn('database is down', logs.output[0])
+
+
+def vault_card_index_installed():
+    if django is None or not settings.configured:
+        return False
+    from django.apps import apps
+    return apps.ready and apps.is_installed('sageexchangevirtualdesktop') and 'default' in settings.DATABASES
+
+
+@skipUnless(vault_card_index_installed(), 'the app and a database are not configured')
+class TestVaultCardIndex(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        call_command('migrate', verbosity=0)
+
+    def setUp(self):
+        from .models import VaultCard
+        self.VaultCard = VaultCard
+        self.addCleanup(VaultCard.objects.all().delete)
+
+    def vault_response(self, **kwargs):
+        vault_response = sevd.parse_response(VAULT_STATUS_RESPONSE).vault_query_response.vault_response
+        for name, value in kwargs.items():
+            setattr(vault_response, name, value)
+        return vault_response
+
+    def test_not_registered_on_import(self):
+        self.assertNotIn(self.VaultCard.objects.record_response, sevd.RESPONSE_LISTENERS)
+
+    def test_update_from_vault_response(self):
+        manager = self.VaultCard.objects
+        card = manager.update_from_vault_response(self.vault_response(), 'MID')
+        self.assertEqual((card.guid, card.merchant_id, card.last4, card.payment_type_id, card.expiration_date),
+                         ('74e7b7c14839486484071a91f4367bd6', 'MID', '1111', '4', '0716'))
+        self.assertEqual(card.expiration_month, datetime.date(2016, 7, 1))
+
+        # updated in place
+        card = manager.update_from_vault_response(self.vault_response(expiration_date='0818'))
+        self.assertEqual(manager.count(), 1)
+        self.assertEqual(card.expiration_month, datetime.date(2018, 8, 1))
+        self.assertEqual(list(manager.expiring(2018, 8)), [card])
+
+        # declined responses and responses without card details are not recorded
+        declined = self.vault_response(guid='other')
+        declined.response.response_indicator = 'E'
+        self.assertIsNone(manager.update_from_vault_response(declined))
+        self.assertIsNone(manager.update_from_vault_response(self.vault_response(guid='other', last4=None, expiration_date=None)))
+        self.assertEqual(manager.count(), 1)
+
+    def test_record_response_delete(self):
+        manager = self.VaultCard.objects
+        manager.update_from_vault_response(self.vault_response(guid='g'))
+        manager.update_from_vault_response(self.vault_response(guid='kept'))
+
+        request = sevd.build_vault_operation_request('APP', 'MID', 'KEY', 'DELETE', 'g', '1')
+        declined = sevd.parse_response(VAULT_RESPONSE)
+        declined.vault_response.response.response_indicator = 'E'
+        manager.record_response(request, declined)
+        self.assertEqual(manager.count(), 2)
+
+        manager.record_response(request, sevd.parse_response(VAULT_RESPONSE))
+        self.assertEqual(sorted(manager.values_list('guid', flat=True)), ['kept'])
+
+
+class TestHedging(TestCase):
+
+    def create_client(self, session, tokens=10):
+        policy = client.HedgePolicy(min_samples=1)
+        policy.budget.tokens = tokens
+        c = client.Client(hedging=policy, session=session)
+        c._get_latency_tracker('vault_status_query').observe(0.02)
+        self.addCleanup(c.close)
+        return c
+
+    def test_slow_query_is_hedged(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE, delay=[1, 0])
+        c = self.create_client(session)
+        start = time.monotonic()
+        response = c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertTrue(time.monotonic() - start < 0.5)
+        self.assertEqual(response.vault_query_response.vault_response.payment_type_id, '4')
+        self.assertEqual(len(session.calls), 2)
+        self.assertEqual(c.hedges_sent, 1)
+
+    def test_fast_query_is_not_hedged(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        c = self.create_client(session)
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 1)
+        self.assertEqual(c.hedges_sent, 0)
+
+    def test_budget_caps_hedges(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE, delay=[0.2, 0.2])
+        c = self.create_client(session, tokens=0)
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 1)
+        self.assertEqual(c.hedges_sent, 0)
+
+        budget = client.HedgeBudget(ratio=0.5, burst=1)
+        self.assertFalse(budget.spend())
+        budget.earn()
+        budget.earn()
+        budget.earn()
+        self.assertEqual(budget.tokens, 1)
+        self.assertTrue(budget.spend())
+        self.assertFalse(budget.spend())
+
+    def test_mutating_calls_are_never_hedged(self):
+        c = self.create_client(FakeSession())
+        self.assertRaises(ValueError, c._hedged, 'vault_delete', lambda: None, None)
+        self.assertRaises(ValueError, c._hedged, 'auth_with_vault', lambda: None, None)
+
+    def test_latency_tracker(self):
+        tracker = client.LatencyTracker(window=100, min_samples=10)
+        self.assertEqual(tracker.percentile(0.95), None)
+        for i in range(100):
+            tracker.observe(i / 100.0)
+        self.assertEqual(tracker.percentile(0.95), 0.95)
+
+
+VAULT_NOT_FOUND_RESPONSE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Response_v1>
+    <VaultStatusQueryResponse>
+        <Response>
+            <ResponseIndicator>E</ResponseIndicator>
+            <ResponseCode>411411</ResponseCode>
+            <ResponseMessage>NOT FOUND</ResponseMessage>
+        </Response>
+    </VaultStatusQueryResponse>
+</Response_v1>
+'''
+
+
+class TestCache(TestCase):
+
+    def test_lru_cache(self):
+        cache = client.LRUCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'b' was the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+
+        cache = client.LRUCache(ttl=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_final_vault_status_is_cached(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        c = client.Client(session=session, cache=client.LRUCache())
+        response = c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertIs(c.vault_status_query('APP', 'MID', 'KEY', '1'), response)
+        self.assertEqual(len(session.calls), 1)
+
+        # keyed by merchant too
+        c.vault_status_query('APP', 'MID2', 'KEY', '1')
+        self.assertEqual(len(session.calls), 2)
+
+    def test_not_found_is_not_cached(self):
+        session = FakeSession(VAULT_NOT_FOUND_RESPONSE)
+        c = client.Client(session=session, cache=client.LRUCache())
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 2)
+
+    def test_vault_writes_invalidate(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        c = client.Client(session=session, cache=client.LRUCache())
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        c.vault_delete('APP', 'MID', 'KEY', '74e7b7c14839486484071a91f4367bd6', query_first=None)
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 3)
+
+        request = sevd.Request()
+        request.vault_operation = sevd.VaultOperationType()
+        request.vault_operation.merchant = sevd.MerchantType(merchant_id='MID', merchant_key='KEY')
+        request.vault_operation.vault_storage = sevd.VaultStorageType(service='UPDATE', guid='74e7b7c14839486484071a91f4367bd6')
+        c._invalidate_request(request)
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 4)
+
+    def test_vault_entry_shared_by_vault_ids(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        cache = client.LRUCache(maxsize=4)
+        c = client.Client(session=session, cache=cache)
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        c.vault_status_query('APP', 'MID', 'KEY', '2')
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 2)
+
+        # a hit keeps the GUID entry as fresh as the query pointing at it
+        cache.set('x', 1)
+        c.vault_status_query('APP', 'MID', 'KEY', '2')
+        cache.set('y', 2)
+        c.vault_status_query('APP', 'MID', 'KEY', '2')
+        self.assertEqual(len(session.calls), 2)
+
+        # a delete sent without the client invalidates every VaultID that returned the GUID
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        session.content = VAULT_RESPONSE
+        sevd.execute_vault_delete('APP', 'MID', 'KEY', '74e7b7c14839486484071a91f4367bd6', query_first=None, session=session)
+        session.content = VAULT_STATUS_RESPONSE
+        c.vault_status_query('APP', 'MID', 'KEY', '2')
+        self.assertEqual(len(session.calls), 5)
+
+    def test_is_final_transaction_status(self):
+        response = sevd.Response()
+        response.transaction_query_responses = sevd.TransactionStatusQueryResponsesType()
+        status = sevd.TransactionStatusQueryResponseType(response=sevd.ResponseType(response_indicator='A'))
+        response.transaction_query_responses.transaction_status_query_responses = status
+        self.assertFalse(client.is_final_transaction_status(response))
+        status.transaction_settlement_status = sevd.TransactionSettlementStatusType(settlement_date='7/21/2015')
+        self.assertTrue(client.is_final_transaction_status(response))
+        status.response.response_code = '411411'
+        self.assertFalse(client.is_final_transaction_status(response))
+
+
+class TestSingleFlight(TestCase):
+
+    def test_threads_share_one_call(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE, delay=0.2)
+        c = client.Client(session=session)
+        results = []
+        def query():
+            results.append(c.vault_status_query('APP', 'MID', 'KEY', '1'))
+        threads = [threading.Thread(target=query) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(session.calls), 1)
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertIs(result, results[0])
+
+        # once the call has finished the next one goes out again
+        c.vault_status_query('APP', 'MID', 'KEY', '1')
+        self.assertEqual(len(session.calls), 2)
+
+    def test_errors_are_shared(self):
+        flights = client.SingleFlight()
+        def fail():
+            raise ValueError('failed')
+        self.assertRaises(ValueError, flights.do, 'key', fail)
+        self.assertEqual(flights.do('key', lambda: 1), 1)
+
+    def test_asyncio_shares_one_call(self):
+        session = FakeSession(VAULT_STATUS_RESPONSE, delay=0.2)
+        c = client.AsyncClient(client.Client(session=session, coalesce=False))
+        async def query():
+            return await asyncio.gather(*[c.vault_status_query('APP', 'MID', 'KEY', '1') for i in range(5)])
+        results = asyncio.run(query())
+        self.assertEqual(len(session.calls), 1)
+        for result in results:
+            self.assertIs(result, results[0])
+
+
+VAULT_RESPONSE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Response_v1>
+    <VaultResponse>
+        <Response>
+            <ResponseIndicator>A</ResponseIndicator>
+            <ResponseMessage>SUCCESS</ResponseMessage>
+        </Response>
+        <GUID>74e7b7c14839486484071a91f4367bd6</GUID>
+        <ExpirationDate>0716</ExpirationDate>
+    </VaultResponse>
+</Response_v1>
+'''
+
+
+class TestRateLimits(TestCase):
+
+    def test_token_bucket(self):
+        bucket = client.TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1, places=2)
+        # would have to wait ~0.2s
+        self.assertIsNone(bucket.reserve(max_wait=0.05))
+        metrics = bucket.metrics()
+        self.assertEqual((metrics['acquired'], metrics['throttled'], metrics['rejected']), (3, 1, 1))
+
+        bucket.configure(None)
+        self.assertEqual(bucket.reserve(max_wait=0), 0)
+        self.assertRaises(ValueError, bucket.configure, 0)
+
+    def create_pools(self, **kwargs):
+        pools = client.MerchantPools(**kwargs)
+        sessions = []
+        def new_session():
+            sessions.append(FakeSession(VAULT_STATUS_RESPONSE))
+            return sessions[-1]
+        pools._new_session = new_session
+        return pools, sessions
+
+    def test_pools(self):
+        pools, sessions = self.create_pools(rate=1, burst=1)
+        c = client.Client(pools=pools, coalesce=False)
+        c.vault_status_query('APP', 'M1', 'KEY', '1', timeout=5)
+        c.vault_status_query('APP', 'M2', 'KEY', '1', timeout=5)
+        self.assertEqual([len(session.calls) for session in sessions], [1, 1])
+        self.assertIs(pools.session('M1').session, sessions[0])
+
+        # M1 has used its burst and would have to wait about a second
+        self.assertRaises(client.RateLimitExceeded, c.vault_status_query, 'APP', 'M1', 'KEY', '2', timeout=0.2)
+        pools.set_limit('M1', 100, 5)
+        c.vault_status_query('APP', 'M1', 'KEY', '2', timeout=0.2)
+
+        metrics = pools.metrics()
+        self.assertEqual(sorted(metrics['merchants']), ['M1', 'M2'])
+        self.assertEqual(metrics['merchants']['M1']['rejected'], 1)
+        self.assertEqual(metrics['merchants']['M1']['rate'], 100)
+        self.assertIsNone(metrics['global']['rate'])
+
+    def test_throttled_merchant_holds_no_slot(self):
+        pools, sessions = self.create_pools()
+        pools.set_limit('SLOW', 2, 1)
+        c = client.Client(pools=pools, scheduler=client.Scheduler(slots=2, reserve=1), coalesce=False)
+        c.vault_status_query('APP', 'SLOW', 'KEY', '1', timeout=5)
+        # each of these waits for a token, for 0.5s and 1s
+        threads = [threading.Thread(target=c.vault_status_query, args=('APP', 'SLOW', 'KEY', str(i)), kwargs={'timeout': 5}) for i in range(2, 4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        start = time.monotonic()
+        c.vault_status_query('APP', 'FAST', 'KEY', '1', timeout=5)
+        self.assertLess(time.monotonic() - start, 0.3)
+        for thread in threads:
+            thread.join()
+
+    def test_global_limit(self):
+        pools, sessions = self.create_pools(global_rate=1, global_burst=1)
+        self.assertEqual(pools.reserve('M1', 0.1), 0)
+        self.assertIsNone(pools.reserve('M2', 0.1))
+        # the merchant's token is given back when the global limit refuses
+        self.assertEqual(pools.limit('M2').metrics()['acquired'], 0)
+
+
+class TestScheduler(TestCase):
+
+    def test_reserve(self):
+        scheduler = client.Scheduler(slots=2, reserve=1)
+        scheduler.acquire(client.BULK)
+        # the last slot is kept for interactive requests
+        self.assertRaises(client.QueueTimeout, scheduler.acquire, client.BACKGROUND, 0.05)
+        scheduler.acquire(client.INTERACTIVE, 0.05)
+        self.assertEqual(scheduler.metrics()['in_flight'], 2)
+        scheduler.release()
+        scheduler.release()
+        self.assertEqual(scheduler.metrics()['queued'], {'interactive': 0, 'background': 0, 'bulk': 0})
+        self.assertRaises(ValueError, scheduler.acquire, 'urgent')
+
+    def test_weighted_fair_queuing(self):
+        scheduler = client.Scheduler(slots=1, reserve=0)
+        scheduler.acquire(client.INTERACTIVE)
+        order = []
+        def request(priority):
+            with scheduler.slot(priority):
+                order.append(priority)
+        threads = []
+        for priority in [client.BULK] * 3 + [client.BACKGROUND] * 2 + [client.INTERACTIVE]:
+            threads.append(threading.Thread(target=request, args=(priority,)))
+            threads[-1].start()
+            time.sleep(0.01)
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'background', 'background', 'bulk', 'bulk', 'bulk'])
+        self.assertEqual(scheduler.metrics()['admitted'], {'interactive': 2, 'background': 2, 'bulk': 3})
+
+    def test_client(self):
+        session = FakeSession(VAULT_RESPONSE)
+        scheduler = client.Scheduler(slots=4)
+        c = client.Client(session=session, scheduler=scheduler)
+        job = bulk.BulkVaultJob('APP', 'MID', 'KEY', client=c, concurrency=3)
+        self.assertEqual(len(list(job.delete(['a', 'b', 'c']))), 3)
+        c.vault_status_query('APP', 'MID', 'KEY', '1', timeout=5)
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics['admitted'], {'interactive': 1, 'background': 0, 'bulk': 3})
+        self.assertEqual(metrics['in_flight'], 0)
+        # the time spent queued comes out of the POST timeout
+        self.assertTrue(0 < session.calls[-1][2] <= 5)
+
+
+class TestAdaptiveConcurrency(TestCase):
+
+    def test_aimd(self):
+        limit = client.AdaptiveLimit(initial=2, max_limit=3)
+        limit.acquire()
+        limit.acquire()
+        self.assertRaises(client.QueueTimeout, limit.acquire, 0.01)
+        limit.release(0.1)
+        self.assertEqual(limit.limit, 2.5)
+        limit.release(0.1)
+        # not saturated any more
+        self.assertEqual(limit.limit, 2.5)
+
+        for i in range(4):
+            limit.acquire()
+            limit.release(0.1)
+        self.assertEqual(limit.current, 2)
+        with limit.measure():
+            self.assertEqual(limit.in_flight, 1)
+        self.assertEqual(limit.in_flight, 0)
+
+        limit.acquire()
+        limit.release(0.1, error=True)
+        self.assertEqual(limit.current, 1)
+        self.assertEqual(limit.metrics()['errors'], 1)
+
+    def test_slow_round_trips(self):
+        limit = client.AdaptiveLimit(initial=8, tolerance=2.0)
+        limit.acquire()
+        limit.release(0.01)
+        limit.acquire()
+        limit.release(0.5)
+        self.assertEqual(limit.current, 4)
+        # a second slow response within the same round trip does not count again
+        limit.acquire()
+        limit.release(0.5)
+        self.assertEqual(limit.current, 4)
+        self.assertEqual(limit.metrics()['decreases'], 1)
+
+    def test_bulk(self):
+        adaptive = client.AdaptiveConcurrency(initial=2)
+        job = bulk.BulkVaultJob('APP', 'MID', 'KEY', client=client.Client(session=FakeSession(VAULT_RESPONSE)), concurrency=4, adaptive=adaptive)
+        self.assertEqual(len(list(job.retrieve(['a', 'b', 'c', 'd']))), 4)
+        metrics = adaptive.metrics()['vault_retrieve']
+        self.assertEqual((metrics['successes'], metrics['in_flight']), (4, 0))
+
+    def test_async(self):
+        adaptive = client.AdaptiveConcurrency(initial=1, max_limit=1)
+        async_client = client.AsyncClient(client.Client(session=FakeSession(VAULT_STATUS_RESPONSE, delay=0.05)), adaptive=adaptive)
+        async def run():
+            return await asyncio.gather(*[async_client.vault_status_query('APP', 'MID', 'KEY', str(i)) for i in range(3)])
+        start = time.monotonic()
+        self.assertEqual(len(asyncio.run(run())), 3)
+        # one at a time
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+        self.assertEqual(adaptive.metrics()['vault_status_query']['successes'], 3)
+        self.assertEqual(adaptive.current('vault_status_query'), 1)
+
+    def test_async_cancel_keeps_slot(self):
+        adaptive = client.AdaptiveConcurrency(initial=1, max_limit=1)
+        executor = futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+        async_client = client.AsyncClient(client.Client(session=FakeSession(VAULT_STATUS_RESPONSE)), executor=executor, adaptive=adaptive)
+        limit = adaptive.limiter('vault_status_query')
+        async def run():
+            # queries share a call that is shielded from the caller, so cancel the call itself
+            task = asyncio.ensure_future(async_client._run('vault_status_query', time.sleep, 0.1))
+            await asyncio.sleep(0.02)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            # the thread is still running so its slot is still taken
+            in_flight = limit.metrics()['in_flight']
+            await async_client.vault_status_query('APP', 'MID', 'KEY', '2')
+            return in_flight
+        self.assertEqual(asyncio.run(run()), 1)
+        self.assertEqual(limit.metrics()['in_flight'], 0)
+
+    def test_async_queue_time_is_not_rtt(self):
+        adaptive = client.AdaptiveConcurrency(initial=3, smoothing=1.0)
+        executor = futures.ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        async_client = client.AsyncClient(client.Client(session=FakeSession(VAULT_STATUS_RESPONSE)), executor=executor, adaptive=adaptive)
+        async def run():
+            await asyncio.gather(*[async_client._run('vault_status_query', time.sleep, 0.05) for i in range(3)])
+        asyncio.run(run())
+        # the calls waited for the only thread in turn, but the last one still took 0.05s
+        self.assertLess(adaptive.metrics()['vault_status_query']['rtt'], 0.09)
+
+    def test_async_executor_fits_limit(self):
+        async_client = client.AsyncClient(client.Client(session=FakeSession(VAULT_STATUS_RESPONSE)), adaptive=client.AdaptiveConcurrency(max_limit=40))
+        self.assertEqual(async_client._get_executor()._max_workers, 40)
+        async_client._get_executor().shutdown()
+
+
+class TestBulk(TestCase):
+
+    def create_job(self, session, **kwargs):
+        return bulk.BulkVaultJob('APP', 'MID', 'KEY', client=client.Client(session=session), **kwargs)
+
+    def test_delete(self):
+        session = FakeSession(VAULT_RESPONSE)
+        job = self.create_job(session, concurrency=3)
+        results = list(job.delete('guid%d' % i for i in range(10)))
+        self.assertEqual(len(results), 10)
+        self.assertEqual(sorted(r.guid for r in results), sorted('guid%d' % i for i in range(10)))
+        self.assertTrue(all(r.ok for r in results))
+        # no UUID probes
+        self.assertEqual(len(session.calls), 10)
+        self.assertIn('<Service>DELETE</Service>', session.calls[0][1]['request'])
+
+        self.assertRaises(ValueError, list, job.run('create', ['guid']))
+
+    def test_checkpoint_resume(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'checkpoint')
+        with bulk.Checkpoint(path) as checkpoint:
+            list(self.create_job(FakeSession(VAULT_RESPONSE), checkpoint=checkpoint).delete(['a', 'b']))
+        self.assertTrue(checkpoint._file.closed)
+
+        resumed = bulk.Checkpoint(path)
+        self.addCleanup(resumed.close)
+        self.assertIn('delete:a', resumed)
+        session = FakeSession(VAULT_RESPONSE)
+        results = list(self.create_job(session, checkpoint=resumed).delete(['a', 'b', 'c']))
+        self.assertEqual([r.guid for r in results], ['c'])
+        self.assertEqual(len(session.calls), 1)
+
+    def test_checkpoint_per_operation(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with bulk.Checkpoint(os.path.join(directory, 'checkpoint')) as checkpoint:
+            job = self.create_job(FakeSession(VAULT_RESPONSE), checkpoint=checkpoint)
+            list(job.expiring_cards(['a', 'b']))
+            # retrieving the cards does not count as deleting them
+            self.assertEqual(sorted(r.guid for r in job.delete(['a', 'b'])), ['a', 'b'])
+            self.assertEqual(list(job.delete(['a', 'b'])), [])
+
+    def test_failures(self):
+        results = list(self.create_job(FakeSession(VAULT_NOT_FOUND_RESPONSE)).retrieve(['a']))
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].error, 'No VaultResponse returned.')
+
+        f = io.StringIO()
+        bulk.write_results(results, f)
+        self.assertEqual(json.loads(f.getvalue())['guid'], 'a')
+
+    def test_expiring_cards(self):
+        job = self.create_job(FakeSession(VAULT_RESPONSE))
+        self.assertEqual(sorted(r.guid for r in job.expiring_cards(['a', 'b'], datetime.date(2016, 8, 15))), ['a', 'b'])
+        self.assertEqual(list(job.expiring_cards(['a'], datetime.date(2016, 7, 15))), [])
+
+
+class TestBulkCodec(TestCase):
+
+    def requests(self, count):
+        return [sevd.build_vault_status_query_request('APP', 'MID', 'KEY', str(i)) for i in range(count)]
+
+    def test_process_pool(self):
+        requests = self.requests(5)
+        bodies = [VAULT_STATUS_RESPONSE, VAULT_RESPONSE, benchmark.payment_responses(3)] * 3
+        with bulk.BulkCodec(workers=2, chunk_size=2) as codec:
+            self.assertEqual(list(codec.serialize(requests)), [sevd.to_xml_string(request) for request in requests])
+            responses = list(codec.parse(bodies))
+        self.assertEqual([sevd.serialize_request(response) for response in responses],
+                         [sevd.serialize_request(sevd.parse_response(body, lazy=False)) for body in bodies])
+
+    def test_ordering(self):
+        executor = futures.ThreadPoolExecutor(3)
+        self.addCleanup(executor.shutdown)
+        codec = bulk.BulkCodec(workers=3, chunk_size=3, prefetch=1, executor=executor)
+        requests = self.requests(20)
+        xml = [sevd.to_xml_string(request) for request in requests]
+        self.assertEqual(list(codec.serialize(iter(requests))), xml)
+        self.assertEqual(sorted(codec.serialize(requests, ordered=False)), sorted(xml))
+        self.assertEqual(list(codec.serialize([])), [])
+
+        # errors are raised when their chunk is reached
+        results = codec.parse([VAULT_RESPONSE, b'not xml'], ordered=False)
+        self.assertRaises(ValueError, list, results)
+        codec.close()
+        self.assertEqual(len(list(codec.serialize(requests[:1]))), 1)
+        self.assertRaises(ValueError, bulk.BulkCodec, chunk_size=0, executor=executor)
+
+
+class TestRecurring(TestCase):
+
+    def setUp(self):
+        self.calendar = recurring.BusinessCalendar(datetime.date(2024, 1, 1), datetime.date(2025, 12, 31))
+
+    def schedule(self, **kwargs):
+        values = {'schedule': 'MONTHLY', 'interval': '1', 'day_of_month': '1', 'start_date': '01/01/2024', 'times_to_process': '0', 'non_business_day': 'THATDAY', 'amount': '10.00'}
+        values.update(kwargs)
+        return recurring.compile_schedule(sevd.RecurringType(**values))
+
+    def test_federal_reserve_holidays(self):
+        holidays = recurring.federal_reserve_holidays(2024)
+        self.assertIn(datetime.date(2024, 11, 28), holidays) # Thanksgiving
+        self.assertIn(datetime.date(2024, 5, 27), holidays) # Memorial Day
+        self.assertIn(datetime.date(2024, 1, 15), holidays) # MLK Day
+        self.assertEqual(len(holidays), 11)
+        # July 4th 2027 is a Sunday
+        self.assertIn(datetime.date(2027, 7, 5), recurring.federal_reserve_holidays(2027))
+
+    def test_calendar(self):
+        self.assertFalse(self.calendar.is_business_day(datetime.date(2024, 1, 1)))
+        self.assertFalse(self.calendar.is_business_day(datetime.date(2024, 1, 6)))
+        self.assertTrue(self.calendar.is_business_day(datetime.date(2024, 1, 2)))
+        self.assertRaises(ValueError, self.calendar.is_business_day, datetime.date(2023, 12, 31))
+
+    def test_monthly(self):
+        dates = recurring.project([self.schedule(day_of_month='31')], 3, self.calendar)[0]
+        self.assertEqual(dates, [datetime.date(2024, 1, 31), datetime.date(2024, 2, 29), datetime.date(2024, 3, 31)])
+
+        dates = recurring.project([self.schedule(interval='3', start_date='01/15/2024', day_of_month='10')], 2, self.calendar)[0]
+        self.assertEqual(dates, [datetime.date(2024, 2, 10), datetime.date(2024, 5, 10)])
+
+    def test_non_business_day(self):
+        # June 1st 2024 is a Saturday
+        schedules = [self.schedule(start_date='06/01/2024', non_business_day=rule) for rule in ('THATDAY', 'BEFORE', 'AFTER')]
+        dates = [d[0] for d in recurring.project(schedules, 1, self.calendar)]
+        self.assertEqual(dates, [datetime.date(2024, 6, 1), datetime.date(2024, 5, 31), datetime.date(2024, 6, 3)])
+
+    def test_run_moved_before_calendar(self):
+        # January 1st 2024 is a holiday and the first day of the calendar
+        dates = recurring.project([self.schedule(non_business_day='BEFORE')], 2, self.calendar)[0]
+        self.assertEqual(dates, [datetime.date(2024, 2, 1), datetime.date(2024, 3, 1)])
+
+    def test_monthly_started_before_calendar(self):
+        # the day of the start month had passed, so the runs are Jan, Feb and Mar
+        schedule = self.schedule(start_date='12/20/2023', day_of_month='10', times_to_process='3')
+        dates = recurring.project([schedule], 10, self.calendar)[0]
+        self.assertEqual(dates, [datetime.date(2024, 1, 10), datetime.date(2024, 2, 10), datetime.date(2024, 3, 10)])
+
+        schedule = self.schedule(start_date='12/05/2023', day_of_month='10', times_to_process='3')
+        dates = recurring.project([schedule], 10, self.calendar)[0]
+        self.assertEqual(dates, [datetime.date(2024, 1, 10), datetime.date(2024, 2, 10)])
+
+    def test_daily_and_times_to_process(self):
+        schedule = self.schedule(schedule='DAILY', interval='7', start_date='01/02/2024', times_to_process='3')
+        dates = recurring.project([schedule], 10, self.calendar)[0]
+        self.assertEqual(dates, [datetime.date(2024, 1, 2), datetime.date(2024, 1, 9), datetime.date(2024, 1, 16)])
+
+        dates = recurring.project([schedule], 10, self.calendar, since=datetime.date(2024, 1, 10))[0]
+        self.assertEqual(dates, [datetime.date(2024, 1, 16)])
+
+    def test_forecast(self):
+        schedules = [self.schedule(day_of_month='15'), self.schedule(day_of_month='15', amount='5.50')]
+        totals = recurring.forecast(schedules, self.calendar, until=datetime.date(2024, 2, 28))
+        self.assertEqual(list(totals.items()), [(datetime.date(2024, 1, 15), Decimal('15.50')), (datetime.date(2024, 2, 15), Decimal('15.50'))])
+
+
+class TestReconcile(TestCase):
+
+    def test_to_cents(self):
+        self.assertEqual(reconcile.to_cents('1'), 100)
+        self.assertEqual(reconcile.to_cents('12.345'), 1235)
+        self.assertEqual(reconcile.to_cents(-2.5), -250)
+        self.assertEqual(reconcile.to_cents(None), None)
+        self.assertRaises(ValueError, reconcile.to_cents, ' ')
+
+    def test_reconcile(self):
+        sage = [
+            reconcile.SageRecord('a', '1.00', 'A', '7/21/2015', 'B1'),
+            reconcile.SageRecord('b', '2.00', 'A', '7/21/2015', 'B1'),
+            reconcile.SageRecord('c', '3', 'A', None, None),
+            reconcile.SageRecord('e', '5.00', 'A', '7/21/2015', 'B1'),
+        ]
+        ledger = [('a', '1'), ('b', '2.50'), ('c', '3.00'), ('d', '4.00')]
+        results = list(reconcile.reconcile(iter(sage), iter(ledger)))
+        self.assertEqual([(r.status, r.transaction_id) for r in results], [
+            (reconcile.MATCHED, 'a'),
+            (reconcile.AMOUNT_MISMATCH, 'b'),
+            (reconcile.UNSETTLED, 'c'),
+            (reconcile.MISSING_FROM_SAGE, 'd'),
+            (reconcile.MISSING_FROM_LEDGER, 'e'),
+        ])
+        self.assertEqual(reconcile.summarize(results)[reconcile.MATCHED], 1)
+
+    def test_unsorted_input(self):
+        self.assertRaises(ValueError, list, reconcile.reconcile([], [('b', '1'), ('a', '1')]))
+
+    def test_iter_sage_records(self):
+        content = '''<Response_v1>
+            <TransactionStatusQueryResponses>
+                <TransactionStatusQueryResponseType>
+                    <Response><ResponseIndicator>A</ResponseIndicator></Response>
+                    <TransactionResponse>
+                        <TransactionID>a</TransactionID>
+                        <Amount>1.5</Amount>
+                        <TaxAmount>0</TaxAmount>
+                        <ShippingAmount>0</ShippingAmount>
+                    </TransactionResponse>
+                    <TransactionSettlementStatus>
+                        <SettlementDate>7/21/2015</SettlementDate>
+                        <BatchReference>B1</BatchReference>
+                    </TransactionSettlementStatus>
+                </TransactionStatusQueryResponseType>
+            </TransactionStatusQueryResponses>
+        </Response_v1>'''
+        response = sevd.Response()
+        response.from_xml(ET.XML(content))
+        records = list(reconcile.iter_sage_records([response]))
+        self.assertEqual(records, [reconcile.SageRecord('a', sevd.Money(150), 'A', '7/21/2015', 'B1')])
+
+        ledger = list(reconcile.read_ledger_csv(io.StringIO('transaction_id,amount\na,1.50\n')))
+        self.assertEqual([r.status for r in reconcile.reconcile(records, ledger)], [reconcile.MATCHED])
+
+
+BATCH_RESPONSE = b'''<?xml version="1.0" encoding="UTF-8"?>
+<Response_v1>
+    <BatchResponse>
+        <Response>
+            <ResponseIndicator>A</ResponseIndicator>
+        </Response>
+        <BatchNumber>1</BatchNumber>
+        <Net>10.5</Net>
+        <Count>3</Count>
+        <BatchPayment>CREDITCARD</BatchPayment>
+    </BatchResponse>
+</Response_v1>
+'''
+
+
+class TestBatch(TestCase):
+
+    def test_format_cents(self):
+        self.assertEqual(reconcile.format_cents(0), '0.00')
+        self.assertEqual(reconcile.format_cents(1050), '10.50')
+        self.assertEqual(reconcile.format_cents(-5), '-0.05')
+
+    def test_batch_totals(self):
+        totals = reconcile.BatchTotals([('a', '5.00'), ('b', '3.00'), ('c', '-2.00'), ('d', '4.50')])
+        self.assertEqual((totals.net, totals.count), (1050, 4))
+        batch_response = sevd.BatchResponseType(net='6.00', count='3', batch_payment='CREDITCARD')
+        self.assertEqual(totals.compare(batch_response), reconcile.BatchDifference(-450, -1, ['d']))
+        # a credit booked as a sale at Sage
+        batch_response = sevd.BatchResponseType(net='14.50', count='4', batch_payment='CREDITCARD')
+        self.assertEqual(totals.compare(batch_response), reconcile.BatchDifference(400, 0, ['c']))
+
+    def test_close_batch(self):
+        session = FakeSession(BATCH_RESPONSE)
+        response, difference = reconcile.close_batch('APP', 'MID', 'KEY', [('a', '5.00'), ('b', '5.50')], session=session)
+        self.assertEqual(response.batch_response.batch_number, '1')
+        self.assertEqual(difference, reconcile.BatchDifference(0, 1, []))
+        request = session.calls[0][1]['request']
+        self.assertIn('<Net>10.50</Net><Count>2</Count>', request)
+        validate_xml_with_xsd(request.encode('utf-8'))
+
+        sevd.execute_batch_inquiry('APP', 'MID', 'KEY', session=session)
+        self.assertIn('<Net>-1.00</Net><Count>-1</Count>', session.calls[1][1]['request'])
+
+
+class TestMoney(TestCase):
+
+    def test_parse(self):
+        self.assertEqual(sevd.Money.parse('1892.59').cents, 189259)
+        self.assertEqual(sevd.Money.parse('.5').cents, 50)
+        self.assertEqual(sevd.Money.parse('10.500').cents, 1050)
+        self.assertEqual(sevd.Money.parse('-1').cents, -100)
+        self.assertEqual(sevd.Money.parse(' 3 ').cents, 300)
+        self.assertEqual(sevd.Money.parse('1.5E1').cents, 1500)
+        self.assertEqual(sevd.Money.parse(0.1).cents, 10)
+        self.assertEqual(sevd.Money.parse(Decimal('2561.23')).cents, 256123)
+        for value in ('', '.', '1.2.3', 'abc', float('nan')):
+            self.assertRaises(ValueError, sevd.Money.parse, value)
+
+    def test_rounding(self):
+        self.assertEqual(sevd.Money.parse(19.99 * 1.07).cents, 2139)
+        self.assertEqual(sevd.Money.parse(0.1 + 0.2).cents, 30)
+        self.assertEqual(sevd.Money.parse(10.005).cents, 1001)
+        self.assertEqual(sevd.Money.parse('-10.005').cents, -1001)
+        self.assertEqual(sevd.Money.parse('0.004').cents, 0)
+        self.assertEqual(sevd.Money.parse(Decimal('2.675')).cents, 268)
+        for value in ('0.001', 10.005, Decimal('2.675')):
+            self.assertRaises(ValueError, sevd.Money.parse, value, exact=True)
+        self.assertEqual(sevd.Money.parse('10.500', exact=True).cents, 1050)
+
+        transaction = sevd.TransactionResponseType()
+        transaction.amount = 19.99 * 1.07
+        self.assertEqual(transaction.amount, sevd.Money(2139))
+        response = sevd.parse_response(benchmark.payment_responses(1).replace(b'<Amount>1</Amount>', b'<Amount>1.005</Amount>'))
+        self.assertEqual(response.payment_responses.payment_responses.transaction_response.amount, sevd.Money(101))
+
+    def test_arithmetic(self):
+        amounts = [sevd.Money.parse(value) for value in ('0.10', '0.20', '0.30')]
+        self.assertEqual(sum(amounts), sevd.Money(60))
+        self.assertEqual(sevd.Money.sum(['0.10', 0.2, Decimal('0.3')]), sevd.Money(60))
+        self.assertEqual(str(sevd.Money(5) - sevd.Money(10)), '-0.05')
+        self.assertEqual(str(-sevd.Money(1050)), '-10.50')
+        self.assertEqual(sevd.Money(150), Decimal('1.5'))
+        self.assertEqual(sevd.Money(300), 3)
+        self.assertEqual(hash(sevd.Money(300)), hash(3))
+        self.assertNotEqual(sevd.Money(150), '1.50')
+        self.assertEqual(sevd.Money(150), 1.5)
+        self.assertEqual(hash(sevd.Money(150)), hash(1.5))
+        self.assertNotEqual(sevd.Money(10), 0.1)
+        self.assertTrue(sevd.Money(1) < sevd.Money(2))
+        self.assertFalse(sevd.Money(0))
+
+    def test_to_xml(self):
+        transaction = sevd.TransactionBaseType()
+        transaction.trans_id = 'a'
+        transaction.trans_type = '01'
+        transaction.amount = 1.5
+        elem = transaction.to_xml()
+        self.assertEqual(elem.find('Amount').text, '1.50')
+
+        level2 = sevd.Level2Type()
+        level2.customer_number = '1'
+        level2.tax_amount = 0
+        self.assertEqual(level2.to_xml().find('TaxAmount').text, '0.00')
+
+
+class TestRequestSkeleton(TestCase):
+
+    def assertRendersLikeBuild(self, operation, options, values):
+        build, slots = sevd.REQUEST_SKELETONS[operation]
+        skeleton = sevd.get_request_skeleton(operation, 'APP', 'MID', 'K&Y', 'EN', **options)
+        expected = sevd.serialize_request(build(app_id='APP', merchant_id='MID', merchant_key='K&Y', lang_id='EN', **dict(options, **values)))
+        self.assertEqual(skeleton.render(**values), expected)
+        validate_xml_with_xsd(expected.encode('utf-8'))
+
+    def test_render(self):
+        self.assertRendersLikeBuild('vault_operation', {'service': 'DELETE'}, {'vault_guid': 'g', 'vault_id': 'v'})
+        self.assertRendersLikeBuild('vault_status_query', {}, {'vault_id': 'v'})
+        self.assertRendersLikeBuild('transaction_status_query', {}, {'trans_id': '<t>'})
+        self.assertRendersLikeBuild('void', {}, {'trans_id': 't', 'transaction_id': 'x'})
+        self.assertRendersLikeBuild('batch', {'batch_payment': 'CREDITCARD'}, {'net': '10.5', 'count': '2'})
+        address = {'trans_id': 't', 'amount': 3, 'vault_guid': 'g', 'street1': '1 A & B St', 'city': 'C', 'state': 'SC', 'zip_code': '29000'}
+        self.assertRendersLikeBuild('auth_with_vault', {'with_name': False}, address)
+        self.assertRendersLikeBuild('auth_with_vault', {'with_name': True}, dict(address, first_name='F', street2='Apt 1'))
+
+    def test_validation(self):
+        skeleton = sevd.get_request_skeleton('auth_with_vault', 'APP', 'MID', 'KEY', 'EN', with_name=False)
+        values = {'trans_id': 't', 'amount': '1.00', 'vault_guid': 'g', 'street1': 's', 'city': 'C', 'state': 'SC', 'zip_code': '29000'}
+        self.assertIn('<Amount>1.00</Amount>', skeleton.render(**values))
+        self.assertRaises(ValueError, skeleton.render, **dict(values, amount='abc'))
+        self.assertRaises(ValueError, skeleton.render, **dict(values, first_name='F'))
+        del values['trans_id']
+        self.assertRaises(Exception, skeleton.render, **values)
+
+    def test_cached(self):
+        first = sevd.get_request_skeleton('vault_status_query', 'APP', 'MID', 'KEY')
+        self.assertIs(sevd.get_request_skeleton('vault_status_query', 'APP', 'MID', 'KEY'), first)
+        self.assertIsNot(sevd.get_request_skeleton('vault_status_query', 'APP', 'OTHER', 'KEY'), first)
+
+    def test_rendered_request(self):
+        session = FakeSession(VAULT_RESPONSE)
+        calls = []
+        listener = lambda request, response: calls.append(request)
+        sevd.add_response_listener(listener)
+        try:
+            sevd.execute_vault_delete('APP', 'MID', 'KEY', 'GUID', query_first=None, session=session)
+        finally:
+            sevd.remove_response_listener(listener)
+        request = calls[0]
+        self.assertIsInstance(request, sevd.RenderedRequest)
+        self.assertEqual(sevd.to_xml_string(request), session.calls[0][1]['request'])
+        # the Request is built on demand
+        self.assertEqual(request.vault_operation.vault_storage.guid, 'GUID')
+        self.assertEqual(sevd.serialize_request(request._request), request.xml)
+
+
+class FakeSettings(object):
+    SEVD_APPLICATION_ID = 'APP'
+    SEVD_MERCHANT_ID = 'MID'
+    SEVD_MERCHANT_KEY = 'KEY'
+    SEVD_MERCHANTS = {'other': {'MERCHANT_ID': 'MID2', 'MERCHANT_KEY': 'KEY2', 'LANGUAGE_ID': 'ES'}}
+
+
+class TestMerchantRegistry(TestCase):
+
+    def setUp(self):
+        self.settings = sevd.settings
+        sevd.settings = FakeSettings()
+
+    def tearDown(self):
+        sevd.settings = self.settings
+
+    def test_settings(self):
+        registry = sevd.MerchantRegistry()
+        self.assertEqual(registry.get(), sevd.MerchantConfig('APP', 'MID', 'KEY', 'EN'))
+        self.assertEqual(registry.get('other'), sevd.MerchantConfig('APP', 'MID2', 'KEY2', 'ES'))
+        self.assertEqual(registry.find('MID2').merchant_key, 'KEY2')
+        self.assertNotIn('KEY', repr(registry.get()))
+        self.assertRaises(KeyError, registry.get, 'missing')
+
+        # read once, not on every lookup
+        sevd.settings = object()
+        self.assertEqual(registry.get().merchant_id, 'MID')
+        registry.reload()
+        self.assertIsNone(registry.get())
+        self.assertEqual(registry.names(), [])
+
+    def test_settings_not_configured_yet(self):
+        sevd.settings = FakeSettings()
+        sevd.settings.configured = False
+        registry = sevd.MerchantRegistry()
+        self.assertIsNone(registry.get())
+        sevd.settings.configured = True
+        self.assertEqual(registry.get().merchant_id, 'MID')
+
+    def test_register(self):
+        registry = sevd.MerchantRegistry(load_settings=False)
+        self.assertIsNone(registry.get())
+        config = registry.register('shop', sevd.MerchantConfig('APP', 'M3', 'K3'))
+        self.assertIs(registry.get('shop'), config)
+        self.assertIs(registry.find('M3'), config)
+        self.assertIn('shop', registry)
+        self.assertRaises(ValueError, registry.register, 'bad', ('APP', 'M', 'K', 'EN'))
+        registry.unregister('shop')
+        self.assertIsNone(registry.find('M3'))
+
+    def test_defaults(self):
+        sevd.settings = object()
+        registry = sevd.MERCHANTS
+        registry.register(sevd.DEFAULT_MERCHANT, sevd.MerchantConfig('APP', 'MID', 'KEY'))
+        try:
+            self.assertEqual(sevd.ApplicationType().app_id, 'APP')
+            merchant = sevd.MerchantType()
+            self.assertEqual((merchant.merchant_id, merchant.merchant_key), ('MID', 'KEY'))
+
+            # the MerchantKey is taken from the default merchant as well
+            session = FakeSession(VAULT_NOT_FOUND_RESPONSE)
+            sevd.get_uuid('vault', session=session)
+            self.assertIn('<MerchantKey>KEY</MerchantKey>', session.calls[0][1]['request'])
+
+            # but never paired with another merchant's MerchantID
+            self.assertRaises(ValueError, sevd.MerchantType, merchant_id='OTHER')
+            self.assertRaises(ValueError, sevd.MerchantType, merchant_key='KEY')
+            self.assertRaises(ValueError, sevd.get_uuid, 'vault', merchant_id='OTHER', session=session)
+            registry.register('other', sevd.MerchantConfig('APP2', 'OTHER', 'KEY2'))
+            merchant = sevd.MerchantType(merchant_id='OTHER')
+            self.assertEqual((merchant.merchant_id, merchant.merchant_key), ('OTHER', 'KEY2'))
+            session = FakeSession(VAULT_NOT_FOUND_RESPONSE)
+            sevd.get_uuid('vault', merchant_id='OTHER', session=session)
+            self.assertIn('<MerchantKey>KEY2</MerchantKey>', session.calls[0][1]['request'])
+            self.assertIn('<ApplicationID>APP2</ApplicationID>', session.calls[0][1]['request'])
+
+            # requests take the ApplicationID of their own merchant
+            request = sevd.build_vault_status_query_request(None, 'OTHER', None, 'v', lang_id=None)
+            self.assertEqual(request.application.app_id, 'APP2')
+            self.assertEqual(request.vault_status_query.merchant.merchant_key, 'KEY2')
+            request = sevd.build_vault_status_query_request(None, None, None, 'v')
+            self.assertEqual((request.application.app_id, request.vault_status_query.merchant.merchant_id), ('APP', 'MID'))
+            session = FakeSession(VAULT_NOT_FOUND_RESPONSE)
+            sevd.execute_vault_status_query(None, 'OTHER', None, 'v', session=session)
+            self.assertIn('<ApplicationID>APP2</ApplicationID>', session.calls[0][1]['request'])
+        finally:
+            registry.unregister(sevd.DEFAULT_MERCHANT)
+            registry.unregister('other')
+        self.assertIsNone(sevd.ApplicationType().app_id)
+        self.assertRaises(ValueError, sevd.get_uuid, 'vault')
+
+    def test_skeleton_defaults(self):
+        sevd.settings = object()
+        registry = sevd.MERCHANTS
+        registry.register(sevd.DEFAULT_MERCHANT, sevd.MerchantConfig('APP', 'MID', 'KEY'))
+        try:
+            request = sevd.get_request_skeleton('vault_status_query', None, None, None).bind(vault_id='v')
+            self.assertIn('<MerchantKey>KEY</MerchantKey>', request.xml)
+            self.assertEqual(sevd.get_merchant_id(request), 'MID')
+
+            # not baked into the cached skeleton
+            registry.register(sevd.DEFAULT_MERCHANT, sevd.MerchantConfig('APP', 'MID', 'KEY9'))
+            request = sevd.get_request_skeleton('vault_status_query', None, None, None).bind(vault_id='v')
+            self.assertIn('<MerchantKey>KEY9</MerchantKey>', request.xml)
+        finally:
+            registry.unregister(sevd.DEFAULT_MERCHANT)
+
+    @skipUnless(django is not None, 'Django is not installed')
+    def test_vault_form_without_default_merchant(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from .templatetags.sageexchangevirtualdesktop import vault_form
+        self.assertIsNone(sevd.MERCHANTS.get())
+        self.assertRaises(ImproperlyConfigured, vault_form)
+
+
+class TestResponseBody(TestCase):
+
+    def test_find_xml(self):
+        self.assertEqual(sevd.find_xml(b'\xef\xbb\xbf <a/>\r\n'), (4, 8))
+        self.assertEqual(sevd.find_xml(' <a/> '), (1, 5))
+        self.assertIsNone(sevd.find_xml(b'no xml'))
+        self.assertIsNone(sevd.find_xml(b'> <'))
+        self.assertEqual(sevd.trim_xml('x<a>y</a>z'), '<a>y</a>')
+        self.assertIsNone(sevd.trim_xml('> <'))
+
+    def test_xml_body(self):
+        content = b'\x00' * 100000 + b'<a>\xc3\xa9</a>' + b' ' * 100000
+        body = sevd.xml_body(content)
+        self.assertIsInstance(body, memoryview)
+        self.assertIs(body.obj, content)
+        self.assertEqual(ET.XML(body).text, '\xe9')
+        self.assertRaises(ValueError, sevd.xml_body, b'')
+
+    def test_decrypt_response(self):
+        session = FakeSession(b'\xef\xbb\xbf<Response_v1></Response_v1>\r\n')
+        original = sevd.requests
+        sevd.requests = session
+        try:
+            self.assertEqual(sevd.decrypt_response('<x/>'), '<Response_v1></Response_v1>')
+        finally:
+            sevd.requests = original
+
+
+class TestXMLBackends(TestCase):
+
+    def test_same_output(self):
+        if 'lxml' not in sevd.XML_BACKENDS:
+            self.skipTest('lxml is not installed')
+        backends = [sevd.get_xml_backend('etree'), sevd.get_xml_backend('lxml')]
+        request = sevd.build_auth_with_vault_request('APP', 'MID', 'K&Y', 't', 'g', '1.50', '1 <Main> St', 'C', 'SC', '29000', street2='', first_name='F')
+        outputs = [sevd.serialize_request(request, backend) for backend in backends]
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn('<AddressLine2></AddressLine2>', outputs[0])
+
+        for content in (VAULT_STATUS_RESPONSE, BATCH_RESPONSE, b'<Response_v1><!-- note --><VaultResponse><GUID>g</GUID></VaultResponse></Response_v1>'):
+            responses = []
+            for backend in backends:
+                response = sevd.Response()
+                response.from_xml(backend.fromstring(sevd.xml_body(content)))
+                responses.append(sevd.serialize_request(response, backends[0]))
+            self.assertEqual(responses[0], responses[1])
+
+    def test_tostring_leaves_tree_alone(self):
+        for name in sorted(sevd.XML_BACKENDS):
+            backend = sevd.get_xml_backend(name)
+            elem = backend.fromstring(b'<a><b/><c>x</c></a>')
+            self.assertEqual(backend.tostring(elem), '<a><b></b><c>x</c></a>')
+            self.assertIsNone(elem.find('b').text)
+
+    def test_iterparse(self):
+        for name in sorted(sevd.XML_BACKENDS):
+            backend = sevd.get_xml_backend(name)
+            tags = [elem.tag for elem in backend.iterparse(io.BytesIO(VAULT_STATUS_RESPONSE[3:]), ('GUID', 'Last4'))]
+            self.assertEqual(tags, ['GUID', 'Last4'])
+
+    def test_set_backend(self):
+        if 'SEVD_XML_BACKEND' not in os.environ:
+            self.assertEqual(sevd.XML_BACKEND.name, 'lxml')
+        self.assertRaises(ValueError, sevd.get_xml_backend, 'sax')
+        original = sevd.XML_BACKEND
+        try:
+            backend = sevd.set_xml_backend(sorted(sevd.XML_BACKENDS)[-1])
+            self.assertIs(sevd.XML_BACKEND, backend)
+            response = sevd.parse_response(VAULT_STATUS_RESPONSE)
+            self.assertEqual(response.vault_query_response.vault_response.guid, '74e7b7c14839486484071a91f4367bd6')
+        finally:
+            sevd.XML_BACKEND = original
+
+
+class TestLazyResponse(TestCase):
+
+    def test_same_as_eager(self):
+        for content in (VAULT_STATUS_RESPONSE, VAULT_NOT_FOUND_RESPONSE, VAULT_RESPONSE, BATCH_RESPONSE, benchmark.payment_responses(3)):
+            eager = sevd.parse_response(content, lazy=False)
+            lazy = sevd.parse_response(content, lazy=True)
+            self.assertIsInstance(lazy, sevd.Response)
+            self.assertEqual(sevd.serialize_request(lazy), sevd.serialize_request(eager))
+
+    def test_members_load_when_read(self):
+        response = sevd.parse_response(VAULT_STATUS_RESPONSE, lazy=True)
+        self.assertNotIn('_xml_vault_query_response', response.__dict__)
+        vault_response = response.vault_query_response.vault_response
+        self.assertIsInstance(vault_response, sevd.VaultResponseType)
+        self.assertEqual(vault_response.xml_element, 'VaultResponse')
+        self.assertEqual(vault_response.guid, '74e7b7c14839486484071a91f4367bd6')
+        self.assertIn('_xml_vault_query_response', response.__dict__)
+        self.assertNotIn('_xml_last4', vault_response.__dict__)
+        self.assertIs(response.vault_query_response.vault_response, vault_response)
+
+        # missing members and values set by the caller
+        self.assertIsNone(response.payment_responses)
+        vault_response.guid = 'other'
+        self.assertEqual(vault_response.guid, 'other')
+        payments = benchmark.payment_responses(2)
+        response = sevd.parse_response(payments, lazy=True)
+        self.assertEqual([payment.transaction_response.amount for payment in response.payment_responses.payment_responses], [sevd.Money(100), sevd.Money(100)])
+
+    def test_unparsed_tags_warn_when_read(self):
+        response = sevd.parse_response(b'<Response_v1><Unknown/><VaultResponse><GUID>g</GUID></VaultResponse></Response_v1>', lazy=True)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(response.vault_response.guid, 'g')
+        self.assertEqual(len(caught), 1)
+        self.assertIn('Unknown', str(caught[0].message))
+
+    def test_default(self):
+        self.addCleanup(setattr, sevd, 'LAZY_RESPONSES', sevd.LAZY_RESPONSES)
+        sevd.LAZY_RESPONSES = True
+        request = sevd.Request()
+        request.vault_status_query = sevd.VaultStatusQueryType(vault_id='1')
+        response = sevd.send_request(request, session=FakeSession(VAULT_STATUS_RESPONSE))
+        self.assertIsInstance(response, sevd.LazySEVDObject)
+        self.assertEqual(response.vault_query_response.response.response_indicator, 'A')
+
+
+class TestInterning(TestCase):
+
+    def test_low_cardinality_fields_are_interned(self):
+        # built at runtime so it is not the same object as a literal
+        code = sys.intern(''.join(['000', '001']))
+        for lazy in (False, True):
+            first, second = sevd.parse_response(benchmark.payment_responses(2), lazy=lazy).payment_responses.payment_responses
+            self.assertIs(first.response.response_code, code)
+            self.assertIs(second.response.response_code, code)
+            # free text and identifiers are not interned
+            self.assertIsNot(first.response.response_message, second.response.response_message)
+            self.assertIsNot(first.transaction_response.transaction_id, second.transaction_response.transaction_id)
+
+    def test_element_text(self):
+        elem = ET.fromstring('<Code>%s</Code>' % ('X' * 40))
+        self.assertIs(sevd.element_text(elem, True), sys.intern('X' * 40))
+        self.assertIsNone(sevd.element_text(ET.fromstring('<Code/>'), True))
+
+
+UNKNOWN_ELEMENTS_RESPONSE = b'''<Response_v1>
+    <VaultResponse>
+        <GUID>g</GUID>
+        <Token>t</Token>
+        <Token>u</Token>
+    </VaultResponse>
+    <Extra/>
+</Response_v1>'''
+
+
+class TestUnknownElements(TestCase):
+
+    def setUp(self):
+        sevd.UNKNOWN_ELEMENTS.reset()
+        self.addCleanup(sevd.UNKNOWN_ELEMENTS.reset)
+
+    def parse(self, policy, lazy=False):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            response = sevd.parse_response(UNKNOWN_ELEMENTS_RESPONSE, lazy=lazy, unknown=policy)
+            self.assertEqual(response.vault_response.guid, 'g')
+        return response, [str(warning.message) for warning in caught]
+
+    def test_policies(self):
+        response, caught = self.parse(None)
+        self.assertEqual(len(caught), 3)
+        self.assertEqual(sevd.UNKNOWN_ELEMENTS.metrics(), {'VaultResponse/Token': 2, 'Response_v1/Extra': 1})
+
+        sevd.UNKNOWN_ELEMENTS.reset()
+        response, caught = self.parse('warn_once')
+        self.assertEqual(len(caught), 2)
+        response, caught = self.parse('warn_once')
+        self.assertEqual(caught, [])
+        self.assertEqual(sevd.UNKNOWN_ELEMENTS.metrics(), {'VaultResponse/Token': 4, 'Response_v1/Extra': 2})
+
+        response, caught = self.parse('count')
+        self.assertEqual(caught, [])
+        self.assertEqual(sevd.UNKNOWN_ELEMENTS.metrics()['Response_v1/Extra'], 3)
+
+        sevd.UNKNOWN_ELEMENTS.reset()
+        response, caught = self.parse('ignore')
+        self.assertEqual(caught, [])
+        self.assertEqual(sevd.UNKNOWN_ELEMENTS.metrics(), {})
+
+        response, caught = self.parse('preserve')
+        self.assertEqual([el.tag for el in response.unknown_elements], ['Extra'])
+        self.assertEqual([el.text for el in response.vault_response.unknown_elements], ['t', 'u'])
+
+        self.assertRaises(sevd.UnknownElementError, sevd.parse_response, UNKNOWN_ELEMENTS_RESPONSE, unknown='strict')
+        self.assertRaises(ValueError, sevd.parse_response, UNKNOWN_ELEMENTS_RESPONSE, unknown='loud')
+
+    def test_lazy(self):
+        response, caught = self.parse('count', lazy=True)
+        self.assertEqual(caught, [])
+        self.assertEqual(sevd.UNKNOWN_ELEMENTS.metrics(), {'VaultResponse/Token': 2, 'Response_v1/Extra': 1})
+        response, caught = self.parse('preserve', lazy=True)
+        self.assertEqual([el.tag for el in response.unknown_elements], ['Extra'])
+        self.assertEqual(len(response.vault_response.unknown_elements), 2)
+        # strict is checked while parsing, not on first read
+        self.assertRaises(sevd.UnknownElementError, sevd.parse_response, UNKNOWN_ELEMENTS_RESPONSE, lazy=True, unknown='strict')
+        response = sevd.parse_response(VAULT_STATUS_RESPONSE, lazy=True, unknown='strict')
+        self.assertEqual(response.vault_query_response.vault_response.last4, 'XXXXXXXXXXXX1111')
+
+
+class TestPickling(TestCase):
+
+    def test_round_trip(self):
+        for content in (VAULT_STATUS_RESPONSE, VAULT_RESPONSE, BATCH_RESPONSE, benchmark.payment_responses(3)):
+            for lazy in (False, True):
+                response = sevd.parse_response(content, lazy=lazy)
+                loaded = pickle.loads(pickle.dumps(response))
+                self.assertIs(type(loaded), sevd.Response)
+                self.assertEqual(sevd.serialize_request(loaded), sevd.serialize_request(sevd.parse_response(content, lazy=False)))
+
+    def test_compact_format(self):
+        response = sevd.parse_response(benchmark.payment_responses(2))
+        packed = sevd.pack(response)
+        self.assertIs(packed[0], sevd.Response)
+        members = [child.member_name for child in sevd.Response.xml_children]
+        self.assertEqual(len(packed[1]), members.index('payment_responses') + 1)
+        self.assertIs(packed[1][members.index('payment_responses')][0], sevd.PaymentResponsesType)
+        loaded = pickle.loads(pickle.dumps(response))
+        payment = loaded.payment_responses.payment_responses[1]
+        self.assertEqual(payment.transaction_response.amount, sevd.Money(100))
+        self.assertEqual(payment.xml_element, response.payment_responses.payment_responses[1].xml_element)
+        # values are restored without the setters but still go through them afterwards
+        self.assertRaises(ValueError, setattr, payment.transaction_response, 'amount', 'abc')
+
+    def test_instance_state(self):
+        request = sevd.Request()
+        request.vault_status_query = sevd.VaultStatusQueryType(vault_id='1')
+        request.xml_element = 'Request_v2'
+        loaded = pickle.loads(pickle.dumps(request))
+        self.assertEqual(loaded.xml_element, 'Request_v2')
+        self.assertEqual(loaded.vault_status_query.vault_id, '1')
+        self.assertIsNone(loaded.vault_operation)
+
+        for lazy in (False, True):
+            response = sevd.parse_response(UNKNOWN_ELEMENTS_RESPONSE, lazy=lazy, unknown='preserve')
+            loaded = pickle.loads(pickle.dumps(response))
+            self.assertEqual([el.tag for el in loaded.unknown_elements], ['Extra'])
+            self.assertEqual([el.text for el in loaded.vault_response.unknown_elements], ['t', 'u'])
+
+    def test_classes_defined_elsewhere(self):
+        loaded = pickle.loads(pickle.dumps(PickledType(guid='g', amount='1.00')))
+        self.assertIsInstance(loaded, PickledType)
+        self.assertEqual((loaded.guid, loaded.amount), ('g', sevd.Money(100)))
+
+
+class PickledType(sevd.BaseSEVDObject):
+    xml_element = 'Pickled'
+    xml_children = [
+        sevd.SEVDChild('GUID', 'guid'),
+        sevd.SEVDChild('Amount', 'amount', valid_values=sevd.money_set_func),
+    ]
+
+
+class TestSelect(TestCase):
+
+    def test_single_and_multiple_children(self):
+        for count in (1, 3):
+            for lazy in (False, True):
+                response = sevd.parse_response(benchmark.payment_responses(count), lazy=lazy)
+                self.assertEqual(response.select('PaymentResponses/*/TransactionResponse/VANReference'), ['F7KFBmgfX0'] * count)
+                self.assertEqual(response.select('/PaymentResponses/PaymentResponseType/Response/ResponseIndicator/'), ['A'] * count)
+                self.assertEqual(len(response.select('PaymentResponses/*/*')), 3 * count)
+
+        response = sevd.parse_response(VAULT_STATUS_RESPONSE)
+        self.assertEqual(response.select('*/VaultResponse/GUID'), ['74e7b7c14839486484071a91f4367bd6'])
+        self.assertEqual(response.select('PaymentResponses/*/VANReference'), [])
+        self.assertEqual(response.select('VaultStatusQueryResponse/Nothing'), [])
+        self.assertEqual(response.select_one('VaultStatusQueryResponse/VaultResponse/Last4'), 'XXXXXXXXXXXX1111')
+        self.assertEqual(response.select_one('BatchResponse/Net', sevd.Money(0)), sevd.Money(0))
+        self.assertRaises(ValueError, response.select, 'PaymentResponses//Response')
+        self.assertIs(sevd.compile_query('BatchResponse/Net'), sevd.compile_query('BatchResponse/Net'))
+
+    def test_by_transaction_id(self):
+        payments = [
+            sevd.PaymentResponseType(transaction_response=sevd.TransactionResponseType(transaction_id=str(i), amount=i))
+            for i in range(3)
+        ]
+        status = sevd.TransactionStatusQueryResponseType(transaction_response=sevd.TransactionResponseType(transaction_id='9', amount=9))
+        response = sevd.Response(
+            payment_responses=sevd.PaymentResponsesType(payment_responses=payments),
+            transaction_query_responses=sevd.TransactionStatusQueryResponsesType(transaction_status_query_responses=status),
+        )
+        self.assertIs(response.by_transaction_id('2'), payments[2])
+        self.assertIs(response.by_transaction_id('9'), status)
+        self.assertIsNone(response.by_transaction_id('5'))
+        self.assertEqual(sorted(response._transaction_index), ['0', '1', '2', '9'])
+
+        # replacing the results drops the index
+        other = sevd.PaymentResponseType(transaction_response=sevd.TransactionResponseType(transaction_id='5', amount=5))
+        response.payment_responses = sevd.PaymentResponsesType(payment_responses=[other])
+        self.assertIs(response.by_transaction_id('5'), other)
+        self.assertIsNone(response.by_transaction_id('2'))
+        response.transaction_query_responses = None
+        self.assertIsNone(response.by_transaction_id('9'))
+
+        lazy = sevd.parse_response(benchmark.payment_responses(1), lazy=True)
+        self.assertIsNotNone(lazy.by_transaction_id(lazy.select_one('PaymentResponses/*/TransactionResponse/TransactionID')))
+        lazy.payment_responses = None
+        self.assertEqual(lazy.__dict__.get('_transaction_index'), None)
+
+
+class TestFieldExtractor(TestCase):
+
+    def test_matches_response(self):
+        for content in (VAULT_STATUS_RESPONSE, VAULT_NOT_FOUND_RESPONSE):
+            response = sevd.parse_response(content).vault_query_response
+            record = sevd.VAULT_STATUS_RESULT.extract(content)
+            self.assertEqual(record, (
+                response.response.response_indicator, response.response.response_code, response.response.response_message,
+                response.vault_response.guid if response.vault_response else None,
+                response.vault_response.expiration_date if response.vault_response else None,
+                response.vault_response.last4 if response.vault_response else None,
+            ))
+        self.assertEqual(sevd.VAULT_RESULT.extract(VAULT_RESPONSE).guid, sevd.parse_response(VAULT_RESPONSE).vault_response.guid)
+
+        record = sevd.PAYMENT_RESULT.extract(benchmark.payment_responses(1))
+        self.assertEqual(record.response_indicator, 'A')
+        self.assertEqual(record.van_reference, 'F7KFBmgfX0')
+        self.assertEqual(record.amount, sevd.Money(100))
+        self.assertIsNone(record.guid)
+
+    def test_first_element_at_each_step(self):
+        content = (
+            b'<?xml version="1.0"?>\n<Response_v1><!-- <PaymentResponses> -->'
+            b'<PaymentResponses><PaymentResponseType>'
+            b'<Customer><Response><ResponseIndicator>X</ResponseIndicator></Response></Customer>'
+            b'<Response><ResponseIndicator>A&amp;B</ResponseIndicator><ResponseCode/><ResponseMessage><![CDATA[<ok>]]></ResponseMessage></Response>'
+            b'<Response><ResponseIndicator>Y</ResponseIndicator></Response>'
+            b'</PaymentResponseType><PaymentResponseType>'
+            b'<TransactionResponse><VANReference>V2</VANReference></TransactionResponse>'
+            b'</PaymentResponseType></PaymentResponses></Response_v1>'
+        )
+        record = sevd.PAYMENT_RESULT.extract(content)
+        self.assertEqual(record.response_indicator, 'A&B')
+        self.assertIsNone(record.response_code)
+        self.assertEqual(record.response_message, '<ok>')
+        # the second payment is not looked into
+        self.assertIsNone(record.van_reference)
+
+    def test_tag_names_and_nesting(self):
+        content = (
+            b'<Response_v1 xmlns:x="u"><VaultResponse>'
+            b'<ResponseCode>1</ResponseCode><Responses><Response>n</Response></Responses>'
+            b'<Other><Other><GUID>x</GUID></Other></Other>'
+            b'<Response kind="a"><ResponseIndicator>A</ResponseIndicator><ResponseCode>2</ResponseCode></Response>'
+            b'<GUID>g</GUID></VaultResponse></Response_v1>'
+        )
+        for body in (content, bytearray(content), memoryview(content)):
+            record = sevd.VAULT_RESULT.extract(body)
+            self.assertEqual((record.response_indicator, record.response_code, record.guid), ('A', '2', 'g'))
+            self.assertIsNone(record.expiration_date)
+        self.assertEqual(sevd.skip_element(content, b'Other', content.index(b'<Other>') + 7), content.index(b'<Response kind'))
+        self.assertIsNone(sevd.VAULT_RESULT.extract(b'<Response_v1/>').guid)
+
+    def test_custom_fields(self):
+        extractor = sevd.FieldExtractor('Totals', net=('BatchResponse/Net', sevd.Money.parse), count=('BatchResponse/Count', int))
+        self.assertEqual(extractor.extract(BATCH_RESPONSE), (sevd.parse_response(BATCH_RESPONSE).batch_response.net, int(sevd.parse_response(BATCH_RESPONSE).batch_response.count)))
+        self.assertRaises(ValueError, sevd.FieldExtractor, 'Twice', a='VaultResponse/GUID', b='/VaultResponse/GUID/')
+        self.assertRaises(ValueError, extractor.extract, b'no xml')
+
+
+class TestSchemaValidator(TestCase):
+
+    def test_valid_request(self):
+        request = sevd.build_auth_with_vault_request('APP', 'MID', 'KEY', 't', 'g', '1.50', '1 Main St', 'C', 'SC', '29000')
+        self.assertEqual(sevd.get_schema_validator().validate(request), [])
+        sevd.validate_request(request)
+
+    def test_reports_every_violation(self):
+        recurring = sevd.RecurringType(schedule='DAILY', interval=1, day_of_month=1, amount='5.00', times_to_process=1, non_business_day='AFTER')
+        recurring._xml_schedule = 'WEEKLY'
+        recurring._xml_interval = 'x'
+        merchant = sevd.MerchantType(merchant_id='MID', merchant_key='KEY')
+        payment = sevd.PaymentType(merchant=merchant, transaction_base=sevd.TransactionBaseType(trans_id='1'), recurring=recurring)
+        request = sevd.Request(payments=sevd.Payments(payment_type=[payment]), batch=sevd.BatchType(merchant=merchant, net='1.00', batch_payment='CREDITCARD'))
+        with self.assertRaises(sevd.SchemaViolation) as context:
+            sevd.validate_request(request)
+        self.assertEqual(context.exception.violations, [
+            sevd.Violation('Request_v1/Payments/PaymentType[0]/TransactionBase/TransactionType', 'Missing required element.'),
+            sevd.Violation('Request_v1/Payments/PaymentType[0]/Recurring/Schedule', '"WEEKLY" is not one of DAILY, MONTHLY.'),
+            sevd.Violation('Request_v1/Payments/PaymentType[0]/Recurring/Interval', '"x" is not an xs:int.'),
+            sevd.Violation('Request_v1/Batch/Count', 'Missing required element.'),
+        ])
+
+        # nothing is sent
+        session = FakeSession(VAULT_STATUS_RESPONSE)
+        self.assertRaises(sevd.SchemaViolation, sevd.send_request, request, session=session)
+        self.assertEqual(session.calls, [])
+
+    def test_element_order(self):
+        class ReversedName(sevd.BaseSEVDObject):
+            xml_element = 'Name'
+            xml_children = [
+                sevd.SEVDChild('LastName', 'last_name'),
+                sevd.SEVDChild('FirstName', 'first_name'),
+                sevd.SEVDChild('Nickname', 'nickname'),
+            ]
+        validator = sevd.get_schema_validator()
+        self.assertEqual(validator.validate(ReversedName(last_name='L'), 'NameType'), [])
+        self.assertEqual(validator.validate(ReversedName(last_name='L', first_name='F', nickname='N'), 'NameType'), [
+            sevd.Violation('Name/FirstName', 'Element must come before LastName.'),
+            sevd.Violation('Name/Nickname', 'Element is not allowed in NameType.'),
+        ])
+
+        # PaymentType renders its children in the order of the schema
+        payment = sevd.PaymentType(
+            merchant=sevd.MerchantType(merchant_id='MID', merchant_key='KEY'), transaction_base=sevd.TransactionBaseType(trans_id='1', trans_type='11'),
+            recurring=sevd.RecurringType(schedule='DAILY', interval=1, day_of_month=1, amount='5.00', times_to_process=1, non_business_day='AFTER'),
+            vault_storage=sevd.VaultStorageType(service='CREATE'),
+        )
+        self.assertEqual(validator.validate(payment), [])
+        self.assertEqual([elem.tag for elem in payment.to_xml()], ['Merchant', 'TransactionBase', 'Recurring', 'VaultStorage'])
+
+    def test_skeletons_are_validated_when_compiled(self):
+        def build(net):
+            # Count is required by the schema
+            merchant = sevd.MerchantType(merchant_id='MID', merchant_key='KEY')
+            return sevd.Request(batch=sevd.BatchType(merchant=merchant, net=net, batch_payment='CREDITCARD'))
+        slots = {'net': ('batch', 'net')}
+        with self.assertRaises(sevd.SchemaViolation) as caught:
+            sevd.RequestSkeleton(build, slots)
+        self.assertEqual(caught.exception.violations, [sevd.Violation('Request_v1/Batch/Count', 'Missing required element.')])
+
+        self.addCleanup(setattr, sevd, 'VALIDATE_REQUESTS', sevd.VALIDATE_REQUESTS)
+        sevd.VALIDATE_REQUESTS = False
+        self.assertIn('<Net>1.00</Net>', sevd.RequestSkeleton(build, slots).render(net='1'))
+
+
 class TestXML(TestCase):
 
     def test_sale_request_parse(self):
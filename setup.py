@@ -8,7 +8,7 @@ setup(
     author="Positive Action for Christ",
     author_email="netadmin@positiveaction.org",
     url="https://positiveaction.org",
-    packages=["sageexchangevirtualdesktop", "sageexchangevirtualdesktop.templatetags"],
+    packages=["sageexchangevirtualdesktop", "sageexchangevirtualdesktop.migrations", "sageexchangevirtualdesktop.templatetags"],
     package_data={'sageexchangevirtualdesktop': ['schema.xsd',]},
     #ext_package='sageexchangevirtualdesktop',
     install_requires=['requests'],